@@ -1,5 +1,63 @@
+from logging import getLogger
 import sqlite3
 from os.path import realpath
+from ayeaye.compress import migrateCompression, migrateSearchContent
+from ayeaye.search import migrateSearchIndex
+from ayeaye.stats import migrateStats
+
+
+LOGGER = getLogger('ayeaye')
+
+
+def addColumns(table, columns):
+    ''' Migration adding columns to a table, if the table exists already. '''
+    def migrate(db):
+        existing = [r[1] for r in db.execute('PRAGMA table_info({})'.format(table))]
+        if len(existing) == 0:
+            return
+        for (name, definition) in columns:
+            if name not in existing:
+                db.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table, name, definition))
+        db.commit()
+    return migrate
+
+
+def addIndex(table, name, columns):
+    ''' Migration adding an index to a table, if the table exists already. '''
+    def migrate(db):
+        if len(db.execute('PRAGMA table_info({})'.format(table)).fetchall()) == 0:
+            return
+        db.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(name, table, columns))
+        db.commit()
+    return migrate
+
+
+# Databases created by schema.sql are always up to date. Existing databases
+# record their schema version in user_version and are upgraded by running
+# the migrations newer than that version before schema.sql is applied. A
+# migration is either an SQL script or a function taking the connection.
+SCHEMA_VERSION = 9
+MIGRATIONS = {
+    1: '''
+        CREATE INDEX IF NOT EXISTS notification_archive_topic_time
+            ON notification_archive (topic, time);
+        CREATE INDEX IF NOT EXISTS notification_archive_time
+            ON notification_archive (time);
+        ANALYZE notification_archive;
+    ''',
+    2: addColumns('notification_queue', [
+        ('attempts', 'INTEGER DEFAULT 0'),
+        ('next_attempt', 'INTEGER DEFAULT 0')]),
+    3: migrateSearchIndex,
+    4: migrateStats,
+    5: migrateCompression,
+    6: addColumns('notification_digest', [
+        ('claimed', 'INTEGER DEFAULT 0'),
+        ('size', 'INTEGER DEFAULT 0')]),
+    7: migrateSearchContent,
+    8: addColumns('notification_dedup', [('claimed', 'INTEGER DEFAULT 0')]),
+    9: addIndex('notification_attachment', 'notification_attachment_time', 'time'),
+}
 
 
 def initializeDatabase(databasePath):
@@ -9,10 +67,30 @@ def initializeDatabase(databasePath):
 
     try:
         db = sqlite3.connect(databasePath)
+        migrateDatabase(db)
         db.executescript(schema)
+        db.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
     except:
         raise
     finally:
         db.close()
 
     return True
+
+
+def migrateDatabase(db):
+    version = db.execute('PRAGMA user_version').fetchone()[0]
+    exists = db.execute('''
+        SELECT count(*) FROM sqlite_master
+            WHERE type = 'table' AND name = 'notification_archive'
+        ''').fetchone()[0]
+    if not exists:
+        return
+
+    for v in range(version + 1, SCHEMA_VERSION + 1):
+        LOGGER.info('Migrating database to schema version {}'.format(v))
+        if callable(MIGRATIONS[v]):
+            MIGRATIONS[v](db)
+        else:
+            db.executescript(MIGRATIONS[v])
+        db.execute('PRAGMA user_version = {}'.format(v))
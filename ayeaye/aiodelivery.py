@@ -0,0 +1,146 @@
+from ayeaye.appsvc import NotificationService
+from ayeaye.attachments import closeAttachments
+from ayeaye.delivery import DeliveryService
+from ayeaye.error import ArchiveError
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import json
+from logging import getLogger
+import sqlite3
+from threading import Thread
+
+
+LOGGER = getLogger('aiodelivery')
+
+
+class AsyncDeliveryService(DeliveryService):
+    ''' Drains the notification_queue table like the DeliveryService, but
+    sends the notifications from a single asyncio event loop.
+
+    Up to maxInFlight notifications are sent concurrently with aiosmtplib,
+    thus waiting on slow mail relays doesn't tie up a thread per
+    notification. All database access, i.e. claiming, resolving handlers and
+    archiving, is done by one dedicated thread owning the connection, which
+    keeps the blocking sqlite3 calls off the event loop.
+    '''
+
+    def __init__(self, databasePath, attachmentsDir=None, maxInFlight=1000, **kwargs):
+        super().__init__(databasePath, attachmentsDir, workers=1, **kwargs)
+        self.maxInFlight = maxInFlight
+        self._loop = None
+        self._wakeup = None
+        self._executor = None
+        self._db = None
+
+
+    def start(self):
+        # aiosmtplib is optional, fail early instead of with every notification.
+        import aiosmtplib
+
+        self._running = True
+        self._loop = asyncio.new_event_loop()
+        self._wakeup = asyncio.Event()
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                thread_name_prefix='async-delivery-db')
+        t = Thread(target=self._loop.run_until_complete, args=(self._main(), ),
+                name='async-delivery', daemon=True)
+        t.start()
+        self._threads.append(t)
+        LOGGER.info('Started asyncio delivery with up to {} notifications in flight'.format(
+            self.maxInFlight))
+
+
+    def stop(self):
+        ''' Stop claiming notifications and wait for the ones in flight. '''
+        self._running = False
+        self._loop.call_soon_threadsafe(self._wakeup.set)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+        self._executor.shutdown()
+        self._loop.close()
+
+
+    def notify(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+
+    def _call(self, func, *args, **kwargs):
+        ''' Run func on the database thread. '''
+        return self._loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+
+    async def _main(self):
+        self._db = await self._call(self._connect)
+        slots = asyncio.Semaphore(self.maxInFlight)
+        inFlight = set()
+        try:
+            while self._running:
+                await slots.acquire()
+                # Cleared before claiming, thus a notification queued meanwhile
+                # isn't missed.
+                self._wakeup.clear()
+                try:
+                    queued = await self._call(self._claim, self._db)
+                except sqlite3.Error as e:
+                    LOGGER.error('Failed to claim notification: {}'.format(str(e)))
+                    queued = None
+
+                if queued is None:
+                    slots.release()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), self.pollInterval)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                task = asyncio.ensure_future(self._deliverAsync(queued))
+                inFlight.add(task)
+                task.add_done_callback(inFlight.discard)
+                task.add_done_callback(lambda t: slots.release())
+
+            if len(inFlight) > 0:
+                await asyncio.gather(*inFlight)
+        finally:
+            await self._call(self._db.close)
+
+
+    async def _deliverAsync(self, queued):
+        attempts = queued['attempts'] + 1
+        error = None
+        retry = False
+        notification = {}
+        try:
+            notification = json.loads(queued['notification'])
+            ns = NotificationService(queued['topic'], self._db,
+                    attachmentsDir=self.attachmentsDir, archiveWriter=self.archiveWriter)
+            (handler, coalesced, window) = await self._call(self._prepare, ns, notification)
+            # Repeated and digested notifications aren't sent on their own.
+            if coalesced is None:
+                try:
+                    await handler.sendNotificationAsync(notification)
+                except Exception as e:
+                    sendError = e
+                else:
+                    sendError = None
+                await self._call(ns._completeNotification, notification, sendError,
+                        archiveFailed=attempts >= self.maxAttempts, window=window)
+        except ArchiveError as e:
+            # It was sent, retrying would send it again.
+            self._archiveFailed(queued, e)
+        except Exception as e:
+            error = str(e)
+            retry = self._retryable(e, attempts)
+        finally:
+            closeAttachments(notification)
+
+        await self._call(self._finish, self._db, queued, attempts, error, retry)
+
+
+    @staticmethod
+    def _prepare(ns, notification):
+        # Uploaded attachments were queued as references to the store.
+        ns._loadStoredAttachments(notification)
+        return ns._prepareNotification(notification)
@@ -1,6 +1,16 @@
+from ayeaye.aiodelivery import AsyncDeliveryService
 from ayeaye.appsvc import GlobalSettingsService, NotificationHandlerService, \
-    NotificationService
+    NotificationService, NotificationBatchService, HANDLER_CACHE
+from ayeaye.archive import ArchiveWriter
+from ayeaye.attachments import Attachment
+from ayeaye.coalesce import CoalesceService
+from ayeaye.compress import CONTENT_COMPRESSOR
+from ayeaye.database import ConnectionPool
+from ayeaye.delivery import DeliveryService
 from ayeaye.error import Error, InternalError, TeapotError, NotFoundError, BadRequestError
+from ayeaye.fanout import TARGET_EXECUTOR
+from ayeaye.mtemail import SMTP_POOL
+from ayeaye.partition import ARCHIVE_PARTITIONS
 from flask import Flask, request, Response, g
 from flask_cors import CORS
 from functools import wraps
@@ -12,12 +22,85 @@ import sqlite3
 LOGGER = getLogger('api')
 APP = Flask("ayeaye")
 CORS(APP)
+APP.config['ASYNC_DELIVERY'] = False
+DELIVERY = None
+POOL = None
+ARCHIVE_WRITER = None
+COALESCE = None
 
 def runApi(args):
+    startApi(args)
+    try:
+        APP.run(host=args.listen, port=args.port)
+    finally:
+        stopApi()
+
+
+def startApi(args):
+    ''' Configure the app and start the background services of this process.
+    Called once per process, i.e. in every worker of the gunicorn server. '''
+    global DELIVERY, POOL, ARCHIVE_WRITER, COALESCE
+
     APP.config['DATABASE'] = args.database
     APP.config['MAX_CONTENT_LENGTH'] = args.maxLen * 1024 * 1024
     APP.config['ATTACHMENTS_DIR'] = args.attachmentsDir
-    APP.run(host=args.listen, port=args.port)
+    APP.config['ASYNC_DELIVERY'] = args.workers > 0
+    SMTP_POOL.maxMessages = args.smtpMaxMessages
+    SMTP_POOL.maxIdle = args.smtpMaxIdle
+    SMTP_POOL.maxWait = args.smtpMaxWait
+    # The SMTP limits are kept per process.
+    SMTP_POOL.processes = args.processes if args.server == 'gunicorn' else 1
+    HANDLER_CACHE.ttl = args.handlerCacheTtl
+    TARGET_EXECUTOR.maxThreads = args.targetThreads
+    ARCHIVE_PARTITIONS.configure(args.archivePartition)
+    CONTENT_COMPRESSOR.configure(args.archiveCompression)
+    POOL = ConnectionPool(args.database, size=args.poolSize,
+            journalMode=args.journalMode, synchronous=args.synchronous,
+            busyTimeout=args.busyTimeout, cacheSize=args.cacheSize,
+            mmapSize=args.mmapSize)
+
+    if args.archiveBatchSize > 1:
+        ARCHIVE_WRITER = ArchiveWriter(POOL.connect, maxBatch=args.archiveBatchSize,
+                maxDelay=args.archiveMaxDelay / 1000)
+        ARCHIVE_WRITER.start()
+
+    if APP.config['ASYNC_DELIVERY'] and args.deliveryEngine == 'asyncio':
+        DELIVERY = AsyncDeliveryService(args.database, args.attachmentsDir,
+                maxInFlight=args.maxInFlight, pool=POOL, archiveWriter=ARCHIVE_WRITER,
+                maxAttempts=args.maxAttempts, retryDelay=args.retryDelay,
+                retryMaxDelay=args.retryMaxDelay)
+        DELIVERY.start()
+    elif APP.config['ASYNC_DELIVERY']:
+        DELIVERY = DeliveryService(args.database, args.attachmentsDir,
+                workers=args.workers, pool=POOL, archiveWriter=ARCHIVE_WRITER,
+                maxAttempts=args.maxAttempts, retryDelay=args.retryDelay,
+                retryMaxDelay=args.retryMaxDelay)
+        DELIVERY.start()
+
+    COALESCE = CoalesceService(POOL.connect, args.attachmentsDir,
+            archiveWriter=ARCHIVE_WRITER, interval=args.coalesceInterval,
+            delivery=DELIVERY)
+    COALESCE.start()
+
+
+def stopApi():
+    ''' Stop the background services, committing what is left to archive. '''
+    global DELIVERY, POOL, ARCHIVE_WRITER, COALESCE
+
+    if COALESCE is not None:
+        COALESCE.stop()
+        COALESCE = None
+    if DELIVERY is not None:
+        DELIVERY.stop()
+        DELIVERY = None
+    if ARCHIVE_WRITER is not None:
+        ARCHIVE_WRITER.stop()
+        ARCHIVE_WRITER = None
+    TARGET_EXECUTOR.shutdown()
+    SMTP_POOL.closeAll()
+    if POOL is not None:
+        POOL.closeAll()
+        POOL = None
 
 
 def responseMiddleware(func):
@@ -25,10 +108,22 @@ def responseMiddleware(func):
     def wrapper(*args, **kwargs):
         try:
             result = func(*args, **kwargs)
+            if isinstance(result, Response):
+                return result
+
+            status = 200
+            headers = None
+            if isinstance(result, tuple) and len(result) == 3:
+                result, status, headers = result
+            elif isinstance(result, tuple):
+                result, status = result
+
             if isinstance(result, (dict, list)):
-                return Response(json.dumps(result), content_type='application/json')
+                return Response(json.dumps(result), status=status,
+                        headers=headers, content_type='application/json')
             else:
-                return Response(content_type='application/json')
+                return Response(status=status, headers=headers,
+                        content_type='application/json')
         except Error as e:
             LOGGER.error(e)
             return Response(json.dumps(e.toDict()), status=e.code,
@@ -42,24 +137,33 @@ def responseMiddleware(func):
 
 
 # We can't rely on the fact that sqlite3 is always compiled for threadsafe
-# operations. Thus we either use a queue or use the strange app context,
-# which the doc recommends for db connection even though it gets created &
-# destroyed for each individual request Oo.
-# Go with app context first because it's easier and can also be changed
-# easily in the future if we encounter any performance issues.
+# operations. Thus a request takes a connection from the pool (a queue) and
+# keeps it in the app context for its lifetime, so that a connection is only
+# ever used by one thread at a time. Without a pool (i.e. in tests) a
+# connection gets created & destroyed for each individual request.
 def getDatabase():
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(APP.config['DATABASE'])
-        db.row_factory = sqlite3.Row
+        if POOL is not None:
+            db = g._database = POOL.acquire()
+        else:
+            db = g._database = sqlite3.connect(APP.config['DATABASE'])
+            db.row_factory = sqlite3.Row
     return db
 
 
+def releaseDatabase(db):
+    if POOL is not None:
+        POOL.release(db)
+    else:
+        db.close()
+
+
 @APP.teardown_appcontext
 def teardownDatabase(exception):
     db = getattr(g, '_database', None)
     if db is not None:
-        db.close()
+        releaseDatabase(db)
 
 
 from werkzeug.local import LocalProxy
@@ -138,17 +242,128 @@ def emailHandlerByTopic(topic=''):
         return nhs.addEmailHandler(handler)
 
 
-@APP.route('/notifications/', methods=['GET','DELETE'])
+# If set the response is only sent after the notification got archived,
+# instead of leaving it to the archive writer to commit it shortly after.
+def wantsDurable():
+    return request.args.get('durable') in ['1', 'true']
+
+
+# A notification can also be posted as multipart/form-data, with the title
+# and content as fields and the attachments as files. Werkzeug spools large
+# files to temporary files while parsing, thus uploads aren't held in memory.
+def formNotification():
+    notification = dict([(k, request.form[k]) for k in ['title', 'content'] if k in request.form])
+    attachments = []
+    for (field, backup) in [('attachments', False), ('backup', True)]:
+        for f in request.files.getlist(field):
+            if f.filename:
+                attachments.append(Attachment.fromFile(f.filename, f.stream, backup))
+    if len(attachments) > 0:
+        notification['attachments'] = attachments
+    return notification
+
+
+NDJSON = 'application/x-ndjson'
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def wantsStream():
+    return request.accept_mimetypes.best_match(['application/json', NDJSON]) == NDJSON \
+        or request.args.get('stream') in ['1', 'true']
+
+
+# Encodes the notifications one by one while they are fetched from the
+# database, either as NDJSON or as a JSON array, and sends them in chunks.
+# The response is sent after the app context got torn down, thus the stream
+# takes over the database connection and releases it once it's done.
+def streamResponse(notifications):
+    ndjson = request.accept_mimetypes.best_match(['application/json', NDJSON]) == NDJSON
+    db = getattr(g, '_database', None)
+    g._database = None
+
+    def generate():
+        try:
+            chunk = [] if ndjson else ['[']
+            size = 0
+            for idx, n in enumerate(notifications):
+                if ndjson:
+                    encoded = json.dumps(n) + '\n'
+                else:
+                    encoded = json.dumps(n) if idx == 0 else ', ' + json.dumps(n)
+                chunk.append(encoded)
+                size += len(encoded)
+                if size >= STREAM_CHUNK_SIZE:
+                    yield ''.join(chunk)
+                    chunk = []
+                    size = 0
+            if not ndjson:
+                chunk.append(']')
+            if len(chunk) > 0:
+                yield ''.join(chunk)
+        finally:
+            notifications.close()
+            if db is not None:
+                releaseDatabase(db)
+
+    return Response(generate(), content_type=NDJSON if ndjson else 'application/json')
+
+
+def notificationHistoryPage(ns, args, topic=None):
+    page = {}
+    list(map(
+        lambda t: page.update({t[0] : t[1]}),
+        [t for t in args.items() if t[0] in ['fromTime', 'toTime', 'after', 'limit']]))
+    notifications, nextAfter = ns.aNotificationHistoryPage(topic, **page)
+    headers = {}
+    if nextAfter is not None:
+        headers['X-Next-After'] = nextAfter
+    return notifications, 200, headers
+
+
+def notificationSearch(ns, args, topic=None):
+    search = {}
+    list(map(
+        lambda t: search.update({t[0] : t[1]}),
+        [t for t in args.items() if t[0] in ['fromTime', 'toTime', 'offset', 'limit']]))
+    notifications, nextOffset = ns.searchNotifications(args['q'], topic, **search)
+    headers = {}
+    if nextOffset is not None:
+        headers['X-Next-Offset'] = str(nextOffset)
+    return notifications, 200, headers
+
+
+@APP.route('/notifications/', methods=['GET', 'POST', 'DELETE'])
 @responseMiddleware
 def notifications():
     if request.method == 'GET':
         ns = NotificationService(database=DATABASE)
         args = request.args.to_dict()
+        if 'q' in args:
+            return notificationSearch(ns, args)
+        if 'after' in args:
+            return notificationHistoryPage(ns, args)
         timeRange = {}
         list(map(
             lambda t: timeRange.update({t[0] : t[1]}),
             [t for t in args.items() if t[0] in ['fromTime', 'toTime', 'offset',  'limit']]))
+        if wantsStream():
+            return streamResponse(ns.aNotificationHistoryByTime(stream=True, **timeRange))
         return ns.aNotificationHistoryByTime(**timeRange)
+    elif request.method == 'POST':
+        # Not cached, thus the raw body can be freed once it's parsed.
+        json_data = request.get_json(cache=False)
+        if json_data is None:
+            raise BadRequestError('Data must be provided in JSON format.')
+
+        nbs = NotificationBatchService(DATABASE, attachmentsDir=APP.config['ATTACHMENTS_DIR'],
+                archiveWriter=ARCHIVE_WRITER)
+        if APP.config['ASYNC_DELIVERY']:
+            results = nbs.queueNotifications(json_data)
+            if DELIVERY is not None:
+                DELIVERY.notify()
+            return results
+        else:
+            return nbs.sendNotifications(json_data, durable=wantsDurable())
     elif request.method == 'DELETE':
         ns = NotificationService(database=DATABASE)
         ns.deleteAllNotifications()
@@ -156,26 +371,64 @@ def notifications():
         raise TeapotError('I\'m a teapot')
 
 
+@APP.route('/notifications/stats', methods=['GET'])
+@responseMiddleware
+def notificationStats():
+    ns = NotificationService(database=DATABASE)
+    args = request.args.to_dict()
+    stats = {}
+    list(map(
+        lambda t: stats.update({t[0] : t[1]}),
+        [t for t in args.items() if t[0] in ['topic', 'fromTime', 'toTime', 'interval']]))
+    return ns.aNotificationStats(**stats)
+
+
+@APP.route('/notifications/queue/<int:notificationId>', methods=['GET'])
+@responseMiddleware
+def queuedNotification(notificationId):
+    ns = NotificationService(database=DATABASE)
+    return ns.aQueuedNotification(notificationId)
+
+
 @APP.route('/notifications/<topic>', methods=['POST', 'GET'])
 @responseMiddleware
 def notificationByTopic(topic=''):
     if request.method == 'POST':
-        json_data = request.get_json()
+        if request.mimetype == 'multipart/form-data':
+            json_data = formNotification()
+        else:
+            json_data = request.get_json(cache=False)
         if json_data is None:
             raise BadRequestError('Data must be provided in JSON format.')
 
-        ns = NotificationService(topic, DATABASE, attachmentsDir=APP.config['ATTACHMENTS_DIR'])
-        return ns.sendNotification(json_data)
+        ns = NotificationService(topic, DATABASE, attachmentsDir=APP.config['ATTACHMENTS_DIR'],
+                archiveWriter=ARCHIVE_WRITER)
+        if APP.config['ASYNC_DELIVERY']:
+            notificationId = ns.queueNotification(json_data)
+            if DELIVERY is not None:
+                DELIVERY.notify()
+            return {'id': notificationId}, 202
+        else:
+            return ns.sendNotification(json_data, durable=wantsDurable())
     elif request.method == 'GET':
         ns = NotificationService(topic, DATABASE)
         args = request.args.to_dict()
-        if 'fromTime' in args or 'toTime' in args:
+        if 'q' in args:
+            return notificationSearch(ns, args, topic)
+        elif 'after' in args:
+            return notificationHistoryPage(ns, args, topic)
+        elif 'fromTime' in args or 'toTime' in args:
             timeRange = {}
             list(map(
                 lambda t: timeRange.update({t[0] : t[1]}),
                 [t for t in args.items() if t[0] in ['fromTime', 'toTime']]))
                 # from time to time teehee
+            if wantsStream():
+                return streamResponse(ns.aNotificationHistoryByTopicAndTime(
+                    topic, stream=True, **timeRange))
             return ns.aNotificationHistoryByTopicAndTime(topic, **timeRange)
+        elif wantsStream():
+            return streamResponse(ns.aNotificationHistory(stream=True))
         else:
             return ns.aNotificationHistory()
     else:
@@ -1,10 +1,19 @@
-from ayeaye.error import InternalError, UnavailableError, NotFoundError, MissingAttributeError, BadRequestError
+from ayeaye.archive import insertNotifications
+from ayeaye.attachments import Attachment, AttachmentStore, loadAttachments, \
+        closeAttachments
+from ayeaye.coalesce import DedupService, DigestService, attachmentsSize
+from ayeaye.compress import CONTENT_COMPRESSOR
+from ayeaye.error import Error, ArchiveError, InternalError, UnavailableError, \
+        NotFoundError, MissingAttributeError, BadRequestError
+from ayeaye.fanout import FanOutNotificationService, targetSettings
+from ayeaye.partition import ArchivePartitions, ARCHIVE_PARTITIONS
+from ayeaye.stats import BUCKET_SIZE, INTERVALS
+from ayeaye.template import MessageTemplate
 import json
 from logging import getLogger
-from ayeaye.mtemail import EmailNotificationService
+from ayeaye.mtemail import EmailNotificationService, SmtpConnectionPool
 import sqlite3
-from base64 import b64decode
-import os
+from threading import Lock
 from time import time
 
 
@@ -18,6 +27,62 @@ def rowToDict(row):
     return aDict
 
 
+# Archive rows are selected with their content_format and content_dict, the
+# notification has the decompressed content instead.
+ARCHIVE_CONTENT = 'content, content_format, content_dict'
+
+
+def archivedToDict(db, row):
+    notification = rowToDict(row)
+    try:
+        notification['content'] = CONTENT_COMPRESSOR.decompress(db, notification['content'],
+                notification.pop('content_format'), notification.pop('content_dict'))
+    except (ValueError, sqlite3.Error) as e:
+        LOGGER.error(str(e))
+        raise InternalError('Failed to decompress notification')
+    return notification
+
+
+class HandlerCache(object):
+    ''' In-process cache of resolved notification handlers by topic.
+
+    Entries are tagged with the settings_version of the database they were
+    resolved from and expire after ttl seconds. Thus changes done by other
+    processes are picked up as soon as the version changed.
+    '''
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl # In seconds
+        self._handlers = {}
+        self._lock = Lock()
+
+
+    def get(self, topic, version):
+        with self._lock:
+            entry = self._handlers.get(topic)
+
+        if entry is None:
+            return None
+
+        (entryVersion, expires, handler) = entry
+        if entryVersion != version or expires < time():
+            return None
+        return handler
+
+
+    def put(self, topic, version, handler):
+        with self._lock:
+            self._handlers[topic] = (version, time() + self.ttl, handler)
+
+
+    def invalidate(self):
+        with self._lock:
+            self._handlers = {}
+
+
+HANDLER_CACHE = HandlerCache()
+
+
 class GlobalSettingsService(object):
 
     def __init__(self, db):
@@ -61,6 +126,7 @@ class GlobalSettingsService(object):
         finally:
             cur.close()
 
+        HANDLER_CACHE.invalidate()
         return settings
 
 
@@ -98,6 +164,14 @@ class NotificationHandlerService(object):
         # Check arguments
         if set(handler.keys()).issuperset({'topic', 'settings'}) is False:
             raise MissingAttributeError('Required attributes: topic and settings')
+        if 'targets' in handler['settings']:
+            targetSettings(handler['settings'])
+        for setting in ['dedupWindow', 'digestInterval', 'digestSize']:
+            if setting in handler['settings'] and \
+                    (type(handler['settings'][setting]) is not int
+                     or handler['settings'][setting] < 0):
+                raise BadRequestError('{} must be a positive number'.format(setting))
+        MessageTemplate.fromSettings(handler['settings'])
 
         try:
             cur = self.db.cursor()
@@ -114,6 +188,7 @@ class NotificationHandlerService(object):
         finally:
             cur.close()
 
+        HANDLER_CACHE.invalidate()
         return handler
 
 
@@ -140,108 +215,299 @@ class NotificationHandlerService(object):
 
 class NotificationService(object):
 
-    def __init__(self, topic='', database=None, attachmentsDir=None):
+    def __init__(self, topic='', database=None, attachmentsDir=None, archiveWriter=None):
         self.db = database
         self.attachmentsDir = attachmentsDir
+        self.archiveWriter = archiveWriter
         self.topic = topic.lower()
-        # TODO: Would make sense to have a fallback/default notification handler
-        if len(topic) > 0:
-            self.notificationHandler = self.__getNotificationHandler(topic)
+        self._notificationHandler = None
+
+
+    # The handler is only resolved once it's needed, history queries don't
+    # need one at all.
+    # TODO: Would make sense to have a fallback/default notification handler
+    @property
+    def notificationHandler(self):
+        if self._notificationHandler is None and len(self.topic) > 0:
+            self._notificationHandler = self.__getNotificationHandler(self.topic)
+        return self._notificationHandler
+
+
+    def aNotificationHistory(self, stream=False):
+        (qry, params) = self._archiveQuery('time, topic, title, ' + ARCHIVE_CONTENT,
+                ['topic = ?'], [self.topic])
+        return self._history(qry, params, stream)
+
+
+    def aNotificationHistoryByTopicAndTime(self, topic, fromTime=None, toTime=None,
+            stream=False):
+        if fromTime is None and toTime is None:
+            raise MissingAttributeError('Missing fromTime/toTime')
+
+        (conditions, params) = self._timeConditions(fromTime, toTime)
+        (qry, params) = self._archiveQuery('time, topic, title, send_failed, ' + ARCHIVE_CONTENT,
+                ['topic = ?'] + conditions, [topic.lower()] + params, fromTime, toTime)
+        return self._history(qry, params, stream)
+
+
+    def aNotificationHistoryByTime(self, fromTime=None, toTime=None, offset=0, limit=-1,
+            stream=False):
+        (conditions, params) = self._timeConditions(fromTime, toTime)
+        (qry, params) = self._archiveQuery('id, time, topic, title, send_failed, ' + ARCHIVE_CONTENT,
+                conditions, params, fromTime, toTime)
+        if toTime is not None and fromTime is None:
+            qry += ' LIMIT ? OFFSET ?'
         else:
-            self.notificationHandler = None
+            qry += ' ORDER BY time DESC LIMIT ? OFFSET ?'
+
+        return self._history(qry, params + [limit, offset], stream)
 
 
-    def aNotificationHistory(self):
+    @staticmethod
+    def _timeConditions(fromTime, toTime):
+        conditions = []
+        params = []
+        if fromTime is not None:
+            conditions.append('time >= ?')
+            params.append(fromTime)
+        if toTime is not None:
+            conditions.append('time <= ?')
+            params.append(toTime)
+        return (conditions, params)
+
+
+    def _archiveQuery(self, columns, conditions, params, fromTime=None, toTime=None,
+            source='{0}'):
+        ''' Select columns of the rows matching conditions from the archive
+        tables that may hold notifications from fromTime to toTime. Ordering
+        and limits can be appended to the query. In source, columns and
+        conditions {0} is replaced by the name of each table. Returns the
+        query and its parameters. '''
         try:
-            cur = self.db.cursor()
-            cur.execute('''
-                SELECT time, topic, title, content FROM notification_archive
-                    WHERE topic = ?
-                ''', (self.topic, ))
-            notifications = cur.fetchall()
+            tables = ArchivePartitions.tables(self.db, fromTime, toTime)
         except sqlite3.Error as e:
             LOGGER.error(str(e))
             raise InternalError('Failed to get notifications')
+
+        where = ''
+        if len(conditions) > 0:
+            where = ' WHERE ' + ' AND '.join(conditions)
+        select = 'SELECT ' + columns + ' FROM ' + source + where
+        qry = ' UNION ALL '.join([select.format(table) for table in tables])
+        return (qry, list(params) * len(tables))
+
+
+    def aNotificationStats(self, topic=None, fromTime=None, toTime=None, interval='hour'):
+        ''' The number of archived and of failed notifications per topic and
+        interval, i.e. hour, day or total for the whole time range. The
+        counts are kept per hour, thus the range is extended to whole hours. '''
+        if interval not in INTERVALS:
+            raise BadRequestError('Interval must be one of {}'.format(', '.join(INTERVALS)))
+        (fromTime, toTime) = self.parseTimes(fromTime, toTime)
+
+        conditions = []
+        params = []
+        if topic is not None:
+            conditions.append('topic = ?')
+            params.append(topic.lower())
+        if fromTime is not None:
+            conditions.append('bucket >= ?')
+            params.append(fromTime - fromTime % BUCKET_SIZE)
+        if toTime is not None:
+            conditions.append('bucket <= ?')
+            params.append(toTime)
+        where = ''
+        if len(conditions) > 0:
+            where = ' WHERE ' + ' AND '.join(conditions)
+
+        size = INTERVALS[interval]
+        if size is None:
+            qry = '''SELECT topic, SUM(count) AS count, SUM(failed) AS failed
+                FROM notification_stats{} GROUP BY topic ORDER BY topic'''.format(where)
+        else:
+            qry = '''SELECT topic, bucket - bucket % ? AS time, SUM(count) AS count,
+                    SUM(failed) AS failed
+                FROM notification_stats{} GROUP BY topic, 2 ORDER BY 2, topic'''.format(where)
+            params.insert(0, size)
+
+        try:
+            cur = self.db.cursor()
+            cur.execute(qry, params)
+            return [rowToDict(row) for row in cur.fetchall()]
+        except sqlite3.Error as e:
+            LOGGER.error(str(e))
+            raise InternalError('Failed to get notification statistics')
         finally:
             cur.close()
 
-        if notifications is None:
-            return []
-        else:
-            return [rowToDict(row) for row in notifications]
 
+    def searchNotifications(self, query, topic=None, fromTime=None, toTime=None, offset=0,
+            limit=100):
+        ''' The notifications matching the FTS5 query, e.g. "pump AND bed",
+        best matches first. Returns the notifications and the offset of the
+        next page, which is None if there are no more notifications. '''
+        try:
+            (offset, limit) = (int(offset), int(limit))
+        except ValueError:
+            raise BadRequestError('Offset and limit must be numbers')
+        if limit <= 0 or offset < 0:
+            raise BadRequestError('Limit must be greater than 0 and offset at least 0')
+        if len(query.strip()) == 0:
+            raise BadRequestError('Missing search query')
+
+        conditions = ['{0}_fts MATCH ?']
+        params = [query]
+        if topic is not None:
+            conditions.append('a.topic = ?')
+            params.append(topic.lower())
+        (timeConditions, timeParams) = self._timeConditions(fromTime, toTime)
+        conditions.extend(['a.' + c for c in timeConditions])
+        params.extend(timeParams)
+
+        (qry, params) = self._archiveQuery(
+                'a.id, a.time, a.topic, a.title, a.content, a.content_format, a.content_dict, '
+                'a.send_failed, bm25({0}_fts) AS score',
+                conditions, params, fromTime, toTime,
+                source='{0}_fts JOIN {0} AS a ON a.id = {0}_fts.rowid')
+        qry += ' ORDER BY score, time DESC LIMIT ? OFFSET ?'
+        params.extend([limit, offset])
 
-    def aNotificationHistoryByTopicAndTime(self, topic, fromTime=None, toTime=None):
         try:
             cur = self.db.cursor()
-            topic = topic.lower()
-
-            if toTime is not None and fromTime is None:
-                qry = '''SELECT time, topic, title, content, send_failed
-                    FROM notification_archive
-                    WHERE topic = ? and time <= ?'''
-                cur.execute(qry, (topic, toTime, ))
-            elif toTime is not None and fromTime is not None:
-                qry = '''SELECT time, topic, title, content, send_failed
-                    FROM notification_archive
-                    WHERE topic = ? and time >= ? and time <= ?'''
-                cur.execute(qry, (topic, fromTime, toTime, ))
-            elif toTime is None and fromTime is not None:
-                qry = '''SELECT time, topic, title, content, send_failed
-                    FROM notification_archive
-                    WHERE topic = ? and time >= ?'''
-                cur.execute(qry, (topic, fromTime, ))
-            else:
-                raise MissingAttributeError('Missing fromTime/toTime')
-
-            notifications = cur.fetchall()
+            cur.execute(qry, params)
+            notifications = [archivedToDict(self.db, row) for row in cur.fetchall()]
+        except sqlite3.OperationalError as e:
+            # Syntax errors of the query are reported by FTS5 when it's run.
+            if str(e).startswith('no such') or 'locked' in str(e):
+                LOGGER.error(str(e))
+                raise InternalError('Failed to search notifications')
+            raise BadRequestError('Invalid search query: {}'.format(str(e)))
         except sqlite3.Error as e:
             LOGGER.error(str(e))
-            raise InternalError('Failed to get notifications')
+            raise InternalError('Failed to search notifications')
         finally:
             cur.close()
 
-        if notifications is None:
-            return []
-        else:
-            return [rowToDict(row) for row in notifications]
+        for n in notifications:
+            del n['score']
+        return notifications, offset + limit if len(notifications) == limit else None
 
 
-    def aNotificationHistoryByTime(self, fromTime=None, toTime=None, offset=0, limit=-1):
+    def _history(self, qry, params, stream=False):
+        ''' Run a history query. Returns a list of notifications or, if stream
+        is set, a generator that fetches and converts the rows in chunks so
+        that memory use doesn't depend on the number of notifications. '''
         try:
             cur = self.db.cursor()
+            cur.execute(qry, params)
+            if not stream:
+                notifications = cur.fetchall()
+        except sqlite3.Error as e:
+            LOGGER.error(str(e))
+            cur.close()
+            raise InternalError('Failed to get notifications')
 
-            if toTime is not None and fromTime is None:
-                qry = '''SELECT id, time, topic, title, content, send_failed
-                    FROM notification_archive
-                    WHERE time <= ? LIMIT ? OFFSET ?'''
-                cur.execute(qry, (toTime, limit, offset))
-            elif toTime is not None and fromTime is not None:
-                qry = '''SELECT id, time, topic, title, content, send_failed
-                    FROM notification_archive
-                    WHERE time >= ? and time <= ? ORDER BY time DESC LIMIT ? OFFSET ?'''
-                cur.execute(qry, (fromTime, toTime, limit, offset))
-            elif toTime is None and fromTime is not None:
-                qry = '''SELECT id, time, topic, title, content, send_failed
-                    FROM notification_archive
-                    WHERE time >= ? ORDER BY time DESC LIMIT ? OFFSET ?'''
-                cur.execute(qry, (fromTime, limit, offset))
-            else:
-                qry = '''SELECT id, time, topic, title, content, send_failed
-                    FROM notification_archive ORDER BY time DESC LIMIT ? OFFSET ?'''
-                cur.execute(qry, (limit, offset))
+        if stream:
+            return self._iterHistory(cur)
+
+        cur.close()
+        return [archivedToDict(self.db, row) for row in notifications]
 
-            notifications = cur.fetchall()
+
+    @staticmethod
+    def _iterHistory(cur, size=500):
+        try:
+            while True:
+                notifications = cur.fetchmany(size)
+                if len(notifications) == 0:
+                    break
+                for row in notifications:
+                    yield archivedToDict(cur.connection, row)
         except sqlite3.Error as e:
             LOGGER.error(str(e))
             raise InternalError('Failed to get notifications')
         finally:
             cur.close()
 
-        if notifications is None:
-            return []
+
+    def aNotificationHistoryPage(self, topic=None, fromTime=None, toTime=None,
+            after=None, limit=100):
+        ''' A page of notifications, newest first, that starts right after
+        the notification identified by the cursor after (i.e. "<time>,<id>").
+        Returns the notifications and the cursor of the next page, which is
+        None if there are no more notifications. '''
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise BadRequestError('Limit must be a number')
+        if limit <= 0:
+            raise BadRequestError('Limit must be greater than 0')
+        (fromTime, toTime) = self.parseTimes(fromTime, toTime)
+
+        (qry, params) = self._historyPageQuery(topic, fromTime, toTime,
+                self.parseCursor(after), limit)
+        try:
+            cur = self.db.cursor()
+            cur.execute(qry, params)
+            notifications = [archivedToDict(self.db, row) for row in cur.fetchall()]
+        except sqlite3.Error as e:
+            LOGGER.error(str(e))
+            raise InternalError('Failed to get notifications')
+        finally:
+            cur.close()
+
+        if len(notifications) < limit:
+            return notifications, None
         else:
-            return [rowToDict(row) for row in notifications]
+            last = notifications[-1]
+            return notifications, '{},{}'.format(last['time'], last['id'])
+
+
+    @staticmethod
+    def parseTimes(fromTime, toTime):
+        ''' The epoch times fromTime and toTime of a query as numbers. '''
+        try:
+            fromTime = None if fromTime is None else int(fromTime)
+            toTime = None if toTime is None else int(toTime)
+        except ValueError:
+            raise BadRequestError('fromTime and toTime must be numbers')
+        return (fromTime, toTime)
+
+
+    @staticmethod
+    def parseCursor(after):
+        if after is None or len(after) == 0:
+            return None
+
+        try:
+            (t, i) = after.split(',')
+            return (int(t), int(i))
+        except ValueError:
+            raise BadRequestError('Invalid cursor: {}'.format(after))
+
+
+    def _historyPageQuery(self, topic, fromTime, toTime, cursor, limit):
+        conditions = []
+        params = []
+        if topic is not None:
+            conditions.append('topic = ?')
+            params.append(topic.lower())
+        (timeConditions, timeParams) = self._timeConditions(fromTime, toTime)
+        conditions.extend(timeConditions)
+        params.extend(timeParams)
+        if cursor is not None:
+            # A row value comparison, so that SQLite can seek the time index.
+            conditions.append('(time, id) < (?, ?)')
+            params.extend(cursor)
+            # Partitions newer than the cursor don't need to be read.
+            toTime = cursor[0] if toTime is None else min(toTime, cursor[0])
+
+        (qry, params) = self._archiveQuery('id, time, topic, title, send_failed, ' + ARCHIVE_CONTENT,
+                conditions, params, fromTime, toTime)
+        qry += ' ORDER BY time DESC, id DESC LIMIT ?'
+        params.append(limit)
+
+        return qry, params
 
 
     def deleteAllNotifications(self):
@@ -252,7 +518,11 @@ class NotificationService(object):
             raise InternalError('Failed to get database cursor while deleting all notifications')
 
         try:
-            cur.execute('''DELETE FROM notification_archive''')
+            for table in ArchivePartitions.tables(self.db):
+                cur.execute('DELETE FROM {}'.format(table))
+                # Also drops compressed contents, which the trigger leaves.
+                cur.execute("INSERT INTO {0}_fts ({0}_fts) VALUES ('delete-all')".format(table))
+            cur.execute('DELETE FROM notification_stats')
             self.db.commit()
         except sqlite3.Error as e:
             LOGGER.error(str(e))
@@ -261,36 +531,247 @@ class NotificationService(object):
             cur.close()
 
 
-    def sendNotification(self, notification):
-        if any(list(map(lambda k: k not in notification.keys(), ['title', 'content']))):
-            raise MissingAttributeError('Required attributes: title and content')
+    # Attachments are decoded once, for sending as well as for archiving.
+    def sendNotification(self, notification, durable=False, archiveFailed=True):
+        (handler, coalesced, window) = self._prepareNotification(notification)
+        if coalesced is not None:
+            return coalesced
 
         try:
-            result = self.notificationHandler.sendNotification(notification)
-        except Exception as e:
-            LOGGER.error(str(e))
-            self._archiveNotification(notification, failed=True)
+            try:
+                result = handler.sendNotification(notification)
+            except Exception as e:
+                self._completeNotification(notification, e, durable, archiveFailed, window)
+            else:
+                self._completeNotification(notification, None, durable)
+        finally:
+            closeAttachments(notification)
+
+        # The status of every target, if the topic has several.
+        return result if isinstance(result, dict) else None
+
+
+    def _prepareNotification(self, notification):
+        ''' Validate the notification and decode its attachments, which must
+        be closed once it's sent. Returns the notification handler, the
+        response for it if it isn't sent on its own, and the dedup window it
+        opened, which must be released if sending it fails. '''
+        self._validateNotification(notification)
+        handler = self.notificationHandler
+        (coalesced, window) = self._coalesceNotification(notification, handler)
+        try:
+            if coalesced is None:
+                self._loadAttachments(notification)
+        except:
+            self._releaseWindow(window)
+            raise
+        return (handler, coalesced, window)
+
+
+    def _coalesceNotification(self, notification, handler):
+        (duplicate, window) = self._isDuplicate(notification, handler)
+        if duplicate:
+            return ({'duplicate': True}, None)
+        try:
+            if self._isDigested(notification, handler):
+                return ({'digest': True}, window)
+        except:
+            self._releaseWindow(window)
+            raise
+        return (None, window)
+
+
+    def _releaseWindow(self, window):
+        ''' Release the dedup window opened by a notification that wasn't
+        sent, thus retrying it doesn't count as a repeat. '''
+        if window is not None:
+            DedupService(self.db).release(window)
+
+
+    def _isDuplicate(self, notification, handler):
+        window = handler.settings.get('dedupWindow')
+        if not window or notification.get('dedup') is False:
+            return (False, None)
+        dedup = DedupService(self.db)
+        return (dedup.track(self.topic, window, notification), dedup.opened)
+
+
+    def _isDigested(self, notification, handler):
+        if not (handler.settings.get('digestInterval') or handler.settings.get('digestSize')) \
+                or notification.get('digest') is False:
+            return False
+
+        size = attachmentsSize(notification)
+        try:
+            self._storeAttachments(notification)
+        finally:
+            closeAttachments(notification)
+        DigestService(self.db).buffer(self.topic, notification, size)
+        return True
+
+
+    # A failed notification that is going to be retried isn't archived.
+    def _completeNotification(self, notification, error=None, durable=False,
+            archiveFailed=True, window=None):
+        ''' Archive the notification and its attachments once it's sent, or
+        raise an InternalError if sending it failed with error. Raises an
+        ArchiveError if it was sent but its attachments couldn't be archived. '''
+        if error is not None:
+            LOGGER.error(str(error))
+            self._releaseWindow(window)
+            if archiveFailed:
+                self._archiveNotification(notification, failed=True, durable=durable)
             raise InternalError('Failed to send notification')
-        else:
-            self._archiveNotification(notification)
-        
+
+        self._archiveNotification(notification, durable=durable)
+
         if 'attachments' in notification:
             try:
                 self._archiveAttachments(notification)
             except Exception as e:
-                raise InternalError('Failed to archive attachments: {}'.format(str(e)))
+                raise ArchiveError('Failed to archive attachments: {}'.format(str(e)))
+
+
+    # Uploaded attachments are queued as references to the attachment store.
+    def queueNotification(self, notification):
+        self._validateNotification(notification)
+        # Make sure there is a handler for the topic before accepting it.
+        self.notificationHandler
 
+        try:
+            self._storeAttachments(notification)
+        finally:
+            closeAttachments(notification)
 
-    def _archiveNotification(self, notification, failed=False):
         try:
             cur = self.db.cursor()
             cur.execute('''
-                INSERT INTO notification_archive (time, topic, title, content, send_failed)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (int(time()), self.topic, notification['title'], notification['content'], failed, ))
+                INSERT INTO notification_queue (time, topic, notification)
+                    VALUES (?, ?, ?)
+                ''', (int(time()), self.topic, json.dumps(notification), ))
             self.db.commit()
         except sqlite3.Error as e:
             LOGGER.error(str(e))
+            raise InternalError('Failed to queue notification')
+        else:
+            return cur.lastrowid
+        finally:
+            cur.close()
+
+
+    def _storeAttachments(self, notification):
+        attachments = notification.get('attachments', [])
+        if not any([isinstance(a, Attachment) for a in attachments]):
+            return
+        if self.attachmentsDir is None:
+            raise InternalError('No directory for storing attachments')
+
+        store = AttachmentStore(self.attachmentsDir)
+        references = []
+        for attachment in attachments:
+            if isinstance(attachment, Attachment):
+                try:
+                    store.putAttachment(attachment)
+                except Exception as e:
+                    msg = 'Unable to store attachment {}: {}'.format(
+                            attachment.filename, str(e))
+                    LOGGER.error(msg)
+                    raise InternalError(msg)
+                attachment = attachment.toReference()
+            references.append(attachment)
+        notification['attachments'] = references
+
+
+    def aQueuedNotification(self, notificationId):
+        try:
+            cur = self.db.cursor()
+            cur.execute('''
+                SELECT id, time, topic, state, attempts, next_attempt
+                    FROM notification_queue WHERE id = ?
+                ''', (notificationId, ))
+            queued = cur.fetchone()
+            if queued is not None:
+                cur.execute('''
+                    SELECT time, error FROM notification_attempt
+                        WHERE queue_id = ? ORDER BY id
+                    ''', (notificationId, ))
+                history = cur.fetchall()
+        except sqlite3.Error as e:
+            LOGGER.error(str(e))
+            raise InternalError('Failed to get queued notification')
+        finally:
+            cur.close()
+
+        if queued is None:
+            raise NotFoundError('No such queued notification {}'.format(notificationId))
+
+        queued = rowToDict(queued)
+        queued.update(dict(history=[rowToDict(row) for row in history]))
+        return queued
+
+
+    @staticmethod
+    def _validateNotification(notification):
+        if any(list(map(lambda k: k not in notification.keys(), ['title', 'content']))):
+            raise MissingAttributeError('Required attributes: title and content')
+
+        if 'attachments' in notification:
+            if type(notification['attachments']) is not list:
+                raise BadRequestError('Attachments must be a list')
+            for f in notification['attachments']:
+                if isinstance(f, Attachment):
+                    continue
+                if type(f) is not dict:
+                    raise BadRequestError('Attachments must be JSON maps')
+                if not ('filename' in f and 'content' in f):
+                    raise BadRequestError('One of the file is missing filename or content')
+                # References to the attachment store are only made by the service.
+                if 'sha256' in f:
+                    raise BadRequestError('Unknown attachment attribute sha256')
+
+
+    def _loadAttachments(self, notification):
+        try:
+            return loadAttachments(notification)
+        except ValueError as e:
+            raise BadRequestError(str(e))
+
+
+    def _loadStoredAttachments(self, notification):
+        ''' Open the attachments of a notification that was queued or
+        buffered for a digest, which reference the attachment store. '''
+        store = None if self.attachmentsDir is None else AttachmentStore(self.attachmentsDir)
+        try:
+            return loadAttachments(notification, store)
+        except ValueError as e:
+            raise BadRequestError(str(e))
+
+
+    def _archiveNotification(self, notification, failed=False, durable=False):
+        return self._archiveNotifications(self.db, [
+            (int(time()), self.topic, notification['title'], notification['content'], failed)],
+            self.archiveWriter, durable)
+
+
+    @staticmethod
+    def _archiveNotifications(db, rows, archiveWriter=None, durable=False):
+        ''' Archive rows of (time, topic, title, content, send_failed) within a
+        single transaction, or hand them to the archive writer which commits
+        them together with the rows of other requests. '''
+        if archiveWriter is not None:
+            if archiveWriter.submit(rows, durable):
+                return True
+            return
+
+        try:
+            cur = db.cursor()
+            insertNotifications(cur, rows)
+            db.commit()
+        except sqlite3.Error as e:
+            LOGGER.error(str(e))
+            db.rollback()
+            CONTENT_COMPRESSOR.reset()
+            ARCHIVE_PARTITIONS.reset()
         else:
             return True
         finally:
@@ -298,29 +779,63 @@ class NotificationService(object):
 
 
     def _archiveAttachments(self, notification):
-        dir = os.path.join(self.attachmentsDir, self.topic)
         try:
-            os.makedirs(os.path.join(self.attachmentsDir, self.topic), exist_ok=True)
-        except Exception as e:
-            msg = 'Unable to create directory for storing attachments: {}'.format(str(e))
+            attachments = loadAttachments(notification)
+        except ValueError as e:
+            msg = 'Unable to store attachments: {}'.format(str(e))
             LOGGER.error(msg)
             raise InternalError(msg)
 
-        for attachment in notification['attachments']:
-            if attachment.get('backup') is True:
+        store = AttachmentStore(self.attachmentsDir)
+        files = []
+        for attachment in attachments:
+            if attachment.backup:
                 try:
-                    fileName = self._incrementNameIfExist(dir, attachment['filename'])
-                    fileData = b64decode(attachment['content'])
-                    with open(os.path.join(dir, fileName), 'wb') as f:
-                        f.write(fileData)
+                    (digest, size) = store.putAttachment(attachment)
                 except Exception as e:
                     msg = 'Unable to store attachment {}: {}'.format(
-                            attachment['filename'], str(e))
+                            attachment.filename, str(e))
                     LOGGER.error(msg)
                     raise InternalError(msg)
+                files.append((attachment.filename, digest, size))
+
+        if len(files) == 0:
+            return
+
+        try:
+            store.record(self.db, self.topic, int(time()), files)
+            self.db.commit()
+        except sqlite3.Error as e:
+            self.db.rollback()
+            msg = 'Unable to record attachments: {}'.format(str(e))
+            LOGGER.error(msg)
+            raise InternalError(msg)
 
 
     def __getNotificationHandler(self, topic):
+        version = self.__getSettingsVersion()
+        handler = HANDLER_CACHE.get(topic, version)
+        if handler is None:
+            handler = self.__resolveNotificationHandler(topic)
+            HANDLER_CACHE.put(topic, version, handler)
+        return handler
+
+
+    def __getSettingsVersion(self):
+        try:
+            cur = self.db.cursor()
+            cur.execute('SELECT version FROM settings_version WHERE id = 1')
+            version = cur.fetchone()
+        except sqlite3.Error as e:
+            LOGGER.error(str(e))
+            raise InternalError(str(e))
+        finally:
+            cur.close()
+
+        return None if version is None else version[0]
+
+
+    def __resolveNotificationHandler(self, topic):
         try:
             cur = self.db.cursor()
             cur.execute('''
@@ -356,28 +871,142 @@ class NotificationService(object):
         else:
             settings = json.loads(handler[1])
 
-        if handler[0] == 'email':
+        if handler[0] == 'email' and 'targets' in settings:
+            return FanOutNotificationService(
+                    [EmailNotificationService(t) for t in targetSettings(settings)], settings)
+        elif handler[0] == 'email':
             return EmailNotificationService(settings)
         else:
             raise UnavailableError('No notification handler found for topic')
 
 
-    # Append a number if the file name exists
-    # Ex: if 'filename.csv'  exists in path, it will become 'filename_1.csv'
+class NotificationBatchService(object):
+    ''' Sends or queues many notifications, of possibly different topics, at
+    once. Every notification gets its own status, a failing one doesn't
+    affect the others. '''
+
+    def __init__(self, database=None, attachmentsDir=None, archiveWriter=None):
+        self.db = database
+        self.attachmentsDir = attachmentsDir
+        self.archiveWriter = archiveWriter
+        self._services = {}
+
+
+    def sendNotifications(self, notifications, durable=False):
+        (results, accepted) = self._accept(notifications)
+
+        # Deliver grouped by SMTP server, so that consecutive notifications
+        # go over the same pooled session.
+        accepted.sort(key=lambda a: self._smtpKey(a[1].notificationHandler))
+        now = int(time())
+        rows = []
+        delivered = []
+        try:
+            for (idx, ns, notification) in accepted:
+                try:
+                    (handler, coalesced, window) = ns._prepareNotification(notification)
+                except Error as e:
+                    results[idx] = self._status(e)
+                    continue
+                if coalesced is not None:
+                    results[idx] = dict(coalesced, status=200)
+                    continue
+
+                try:
+                    result = handler.sendNotification(notification)
+                except Exception as e:
+                    LOGGER.error(str(e))
+                    if window is not None:
+                        DedupService(self.db).release(window)
+                    rows.append((now, ns.topic, notification['title'], notification['content'], True))
+                    results[idx] = self._status(InternalError('Failed to send notification'))
+                else:
+                    rows.append((now, ns.topic, notification['title'], notification['content'], False))
+                    results[idx] = result if isinstance(result, dict) else {}
+                    results[idx]['status'] = 200
+                    delivered.append((idx, ns, notification))
+
+            NotificationService._archiveNotifications(self.db, rows, self.archiveWriter, durable)
+
+            for (idx, ns, notification) in delivered:
+                if 'attachments' in notification:
+                    try:
+                        ns._archiveAttachments(notification)
+                    except Exception as e:
+                        results[idx] = self._status(ArchiveError(
+                            'Failed to archive attachments: {}'.format(str(e))))
+        finally:
+            for (idx, ns, notification) in accepted:
+                closeAttachments(notification)
+
+        return results
+
+
+    def queueNotifications(self, notifications):
+        (results, accepted) = self._accept(notifications)
+
+        now = int(time())
+        try:
+            cur = self.db.cursor()
+            for (idx, ns, notification) in accepted:
+                cur.execute('''
+                    INSERT INTO notification_queue (time, topic, notification)
+                        VALUES (?, ?, ?)
+                    ''', (now, ns.topic, json.dumps(notification), ))
+                results[idx] = {'status': 202, 'id': cur.lastrowid}
+            self.db.commit()
+        except sqlite3.Error as e:
+            LOGGER.error(str(e))
+            self.db.rollback()
+            raise InternalError('Failed to queue notifications')
+        finally:
+            cur.close()
+
+        return results
+
+
+    def _accept(self, notifications):
+        ''' Validate the notifications and resolve their handlers, once per
+        topic. Returns the list of results, which is filled with the status of
+        rejected notifications, and the accepted notifications. '''
+        if type(notifications) is not list:
+            raise BadRequestError('Notifications must be a list')
+
+        results = [None] * len(notifications)
+        accepted = []
+        for idx, notification in enumerate(notifications):
+            try:
+                if type(notification) is not dict:
+                    raise BadRequestError('Notification must be a JSON map')
+                if type(notification.get('topic', '')) is not str:
+                    raise BadRequestError('Topic must be a string')
+                if len(notification.get('topic', '')) == 0:
+                    raise MissingAttributeError('Required attributes: topic, title and content')
+                ns = self._service(notification['topic'])
+                NotificationService._validateNotification(notification)
+                ns.notificationHandler
+            except Error as e:
+                results[idx] = self._status(e)
+            else:
+                accepted.append((idx, ns, notification))
+
+        return results, accepted
+
+
+    @staticmethod
+    def _smtpKey(handler):
+        handlers = getattr(handler, 'handlers', [handler])
+        return repr(SmtpConnectionPool.key(handlers[0].settings))
+
+
+    def _service(self, topic):
+        topic = topic.lower()
+        if topic not in self._services:
+            self._services[topic] = NotificationService(topic, self.db,
+                    attachmentsDir=self.attachmentsDir, archiveWriter=self.archiveWriter)
+        return self._services[topic]
+
+
     @staticmethod
-    def _incrementNameIfExist(path, fileName):
-        if not fileName in os.listdir(path):
-            return fileName
-        try:
-            (name, extension) = fileName.rsplit('.', 1)
-            extension = '.' + extension
-        except ValueError: # No file extension
-            name = fileName
-            extension = ''
-
-        duplicatedNumber = 0;
-        while True:
-            duplicatedNumber += 1;
-            fileName = name + '_{}'.format(duplicatedNumber) + extension
-            if not fileName in os.listdir(path):
-                return fileName
+    def _status(error):
+        return {'status': error.code, 'error': error.toDict()}
@@ -0,0 +1,150 @@
+from ayeaye.compress import CONTENT_COMPRESSOR, FORMAT_TEXT
+from ayeaye.partition import ARCHIVE_PARTITIONS
+from ayeaye.search import indexContents
+from ayeaye.stats import updateStats
+from logging import getLogger
+from queue import Queue, Empty
+import sqlite3
+from threading import Event, Thread
+from time import time
+
+
+LOGGER = getLogger('archive')
+
+
+def insertNotifications(cur, rows):
+    ''' Insert rows of (time, topic, title, content, send_failed) into the
+    notification archive, or its partitions, and count them in the
+    statistics. Committing is up to the caller. '''
+    for (table, tableRows) in ARCHIVE_PARTITIONS.split(cur, rows):
+        stored = [CONTENT_COMPRESSOR.compress(cur, row[1], row[3]) for row in tableRows]
+        if all([s[1] == FORMAT_TEXT for s in stored]):
+            cur.executemany('''
+                INSERT INTO {} (time, topic, title, content, send_failed)
+                    VALUES (?, ?, ?, ?, ?)
+                '''.format(table), tableRows)
+            continue
+
+        # The search index needs the text of compressed contents, which the
+        # trigger doesn't have, thus they're indexed by their ids.
+        indexed = []
+        for (row, (content, contentFormat, dictionaryId)) in zip(tableRows, stored):
+            cur.execute('''
+                INSERT INTO {} (time, topic, title, content, send_failed, content_format,
+                        content_dict)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                '''.format(table), (row[0], row[1], row[2], content, row[4], contentFormat,
+                    dictionaryId, ))
+            if contentFormat != FORMAT_TEXT:
+                indexed.append((cur.lastrowid, row[2], row[3]))
+        indexContents(cur, table, indexed)
+    updateStats(cur, rows)
+
+
+class ArchiveWriter(object):
+    ''' Collects archive inserts of all threads and commits them in batches.
+
+    A batch is committed as soon as it holds maxBatch rows or maxDelay
+    seconds passed since its first row was submitted, thus there's one fsync
+    per batch instead of one per notification. Callers that need to know
+    their notification is on disk submit it as durable, which commits its
+    batch right away, and wait for the commit up to timeout seconds.
+    '''
+
+    def __init__(self, connect, maxBatch=100, maxDelay=0.05, timeout=30):
+        self.connect = connect
+        self.maxBatch = maxBatch
+        self.maxDelay = maxDelay # In seconds
+        self.timeout = timeout # In seconds
+        self._queue = Queue()
+        self._thread = None
+
+
+    def start(self):
+        self._thread = Thread(target=self._run, name='archive-writer', daemon=True)
+        self._thread.start()
+
+
+    def stop(self):
+        ''' Commit everything submitted so far and stop the writer. '''
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+
+    def submit(self, rows, durable=False):
+        ''' Queue rows for archiving. If durable is set wait until they're
+        committed. Returns False if the writer isn't running, committing them
+        failed or didn't finish within the timeout. '''
+        if self._thread is None or not self._thread.is_alive():
+            LOGGER.error('Failed to archive {} notifications: archive writer not running'.format(
+                len(rows)))
+            return False
+
+        done = Event() if durable else None
+        entry = {'rows': rows, 'done': done, 'error': None}
+        self._queue.put(entry)
+
+        if not durable:
+            return True
+
+        if not done.wait(self.timeout):
+            LOGGER.error('Failed to archive {} notifications: no commit within {} seconds'.format(
+                len(rows), self.timeout))
+            return False
+        return entry['error'] is None
+
+
+    def _run(self):
+        db = self.connect()
+        try:
+            stopped = False
+            while not stopped:
+                entry = self._queue.get()
+                if entry is None:
+                    break
+
+                # A durable entry is committed right away, together with
+                # whatever is already waiting.
+                batch = [entry]
+                count = len(entry['rows'])
+                deadline = time() + (0 if entry['done'] else self.maxDelay)
+                while count < self.maxBatch:
+                    try:
+                        entry = self._queue.get(timeout=max(0, deadline - time()))
+                    except Empty:
+                        break
+                    if entry is None:
+                        stopped = True
+                        break
+                    batch.append(entry)
+                    count += len(entry['rows'])
+                    if entry['done'] is not None:
+                        deadline = 0
+
+                self._commit(db, batch)
+        finally:
+            db.close()
+
+
+    def _commit(self, db, batch):
+        error = None
+        try:
+            cur = db.cursor()
+            for entry in batch:
+                insertNotifications(cur, entry['rows'])
+            db.commit()
+        except sqlite3.Error as e:
+            LOGGER.error('Failed to archive {} notifications: {}'.format(
+                sum([len(b['rows']) for b in batch]), str(e)))
+            db.rollback()
+            CONTENT_COMPRESSOR.reset()
+            ARCHIVE_PARTITIONS.reset()
+            error = e
+        finally:
+            cur.close()
+
+        for entry in batch:
+            entry['error'] = error
+            if entry['done'] is not None:
+                entry['done'].set()
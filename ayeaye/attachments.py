@@ -0,0 +1,255 @@
+from base64 import encodebytes
+from binascii import a2b_base64, Error as BinasciiError
+from hashlib import sha256
+from logging import getLogger
+import os
+import re
+from tempfile import mkstemp, SpooledTemporaryFile
+from threading import Lock
+
+
+LOGGER = getLogger('attachments')
+
+# Number of base64 characters decoded at once, a multiple of 4.
+DECODE_CHUNK_SIZE = 256 * 1024
+# Number of bytes read from an attachment buffer at once, a multiple of 57
+# thus every chunk encodes to whole 76 character base64 lines.
+READ_CHUNK_SIZE = 57 * 1024
+# Attachments larger than this are spooled to a temporary file.
+SPOOL_SIZE = 1024 * 1024
+# Objects of the AttachmentStore are named by their SHA-256 in hex.
+DIGEST_PATTERN = re.compile('^[0-9a-f]{64}$')
+
+
+def decodeBase64(content, chunkSize=DECODE_CHUNK_SIZE):
+    ''' Decode base64 text chunk by chunk, yielding the decoded bytes.
+    Whitespace, as in line wrapped base64, is skipped. '''
+    rest = ''
+    for i in range(0, len(content), chunkSize):
+        chunk = rest + ''.join(content[i:i + chunkSize].split())
+        end = len(chunk) - len(chunk) % 4
+        rest = chunk[end:]
+        if end > 0:
+            yield a2b_base64(chunk[:end])
+    if rest:
+        raise ValueError('Incorrect base64 padding')
+
+
+class Attachment(object):
+    ''' The decoded content of an attachment.
+
+    A notification's base64 attachments are decoded once into Attachment
+    buffers, which are then used both to build the email and to archive the
+    file. Small attachments are kept in memory, larger ones are spooled to a
+    temporary file. Attachments uploaded as files or taken from the
+    AttachmentStore are read from their file instead.
+    '''
+
+    def __init__(self, filename, backup=False, spoolSize=SPOOL_SIZE, file=None):
+        self.filename = filename
+        self.backup = backup
+        self.size = 0
+        self.digest = None # SHA-256 if the content is known to be stored
+        self._base64 = None
+        self._lock = Lock()
+        if file is None:
+            self.file = SpooledTemporaryFile(max_size=spoolSize)
+        else:
+            self.file = file
+            self.size = file.seek(0, os.SEEK_END)
+
+
+    @classmethod
+    def fromBase64(cls, attachment, spoolSize=SPOOL_SIZE):
+        ''' Decode an attachment as given in a notification, i.e. a dict
+        with filename, content (base64) and optionally backup. '''
+        self = cls(attachment['filename'], attachment.get('backup') is True, spoolSize)
+        try:
+            for chunk in decodeBase64(attachment['content']):
+                self.write(chunk)
+        except (BinasciiError, ValueError) as e:
+            self.close()
+            raise ValueError('Invalid base64 content of {}: {}'.format(
+                attachment['filename'], str(e)))
+        return self
+
+
+    @classmethod
+    def fromFile(cls, filename, file, backup=False):
+        ''' Use an open binary file, e.g. an uploaded one, as attachment. The
+        attachment takes over the file and closes it. '''
+        return cls(filename, backup, file=file)
+
+
+    @classmethod
+    def fromStore(cls, store, attachment):
+        ''' Open an attachment referencing content of the store, i.e. a dict
+        with filename, sha256 and optionally backup. '''
+        try:
+            file = open(store.path(attachment['sha256']), 'rb')
+        except (OSError, ValueError) as e:
+            raise ValueError('Missing content of {}: {}'.format(
+                attachment['filename'], str(e)))
+        self = cls(attachment['filename'], attachment.get('backup') is True, file=file)
+        self.digest = attachment['sha256']
+        return self
+
+
+    def toReference(self):
+        ''' The JSON serializable reference to this attachment once it's put
+        into the store. '''
+        return {'filename': self.filename, 'sha256': self.digest, 'backup': self.backup}
+
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+
+    def chunks(self, size=READ_CHUNK_SIZE):
+        self.file.seek(0)
+        while True:
+            chunk = self.file.read(size)
+            if not chunk:
+                break
+            yield chunk
+
+
+    def base64(self):
+        ''' The content base64 encoded in lines of 76 characters, as used
+        by MIME. It's encoded once, even if the emails for several targets
+        are built at the same time. '''
+        with self._lock:
+            if self._base64 is None:
+                self._base64 = ''.join([encodebytes(c).decode('ascii') for c in self.chunks()])
+            return self._base64
+
+
+    def encodeMime(self, part):
+        ''' Encoder for email.mime parts, sets the part's payload to this
+        attachment. '''
+        part.set_payload(self.base64())
+        part['Content-Transfer-Encoding'] = 'base64'
+
+
+    def close(self):
+        self._base64 = None
+        self.file.close()
+
+
+def loadAttachments(notification, store=None):
+    ''' Replace the base64 attachments of a notification by Attachment
+    buffers, thus the base64 text can be freed. References to stored content
+    are opened from the store, if one is given, which must only be done for
+    notifications the service stored itself. Raises ValueError if one of
+    them can't be decoded. '''
+    attachments = []
+    try:
+        for attachment in notification.get('attachments', []):
+            if isinstance(attachment, Attachment):
+                pass
+            elif store is not None and 'sha256' in attachment:
+                attachment = Attachment.fromStore(store, attachment)
+            else:
+                attachment = Attachment.fromBase64(attachment)
+            attachments.append(attachment)
+    except:
+        for attachment in attachments:
+            attachment.close()
+        raise
+
+    if 'attachments' in notification:
+        notification['attachments'] = attachments
+    return attachments
+
+
+def closeAttachments(notification):
+    for attachment in notification.get('attachments', []):
+        if isinstance(attachment, Attachment):
+            attachment.close()
+
+
+class AttachmentStore(object):
+    ''' Content addressed store for archived attachments.
+
+    Every file is stored once under the SHA-256 of its content, sharded into
+    two levels of subdirectories, i.e. objects/ab/cd/abcd.... Files are
+    written to a temporary file first and renamed into place once complete,
+    thus a file in objects/ is never partially written. Which notification
+    came with which files is recorded in the notification_attachment table.
+    '''
+
+    def __init__(self, baseDir):
+        self.baseDir = baseDir
+        self.objectsDir = os.path.join(baseDir, 'objects')
+        self.tmpDir = os.path.join(baseDir, 'tmp')
+
+
+    def path(self, digest):
+        ''' The path of the object with the SHA-256 digest. Raises ValueError
+        if digest isn't one. '''
+        if type(digest) is not str or not DIGEST_PATTERN.match(digest):
+            raise ValueError('Invalid attachment digest: {}'.format(digest))
+        return os.path.join(self.objectsDir, digest[0:2], digest[2:4], digest)
+
+
+    @staticmethod
+    def _touch(path):
+        ''' Mark a stored object as used, so that the purge keeps it. Returns
+        False if there is no such object. '''
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+
+    def putAttachment(self, attachment):
+        ''' Store an Attachment, returns its (digest, size). '''
+        if attachment.digest is not None and self._touch(self.path(attachment.digest)):
+            return (attachment.digest, attachment.size)
+
+        (attachment.digest, size) = self.put(attachment.chunks())
+        return (attachment.digest, size)
+
+
+    def put(self, chunks):
+        ''' Store the content given as iterable of bytes, returns its
+        (digest, size). Content that is stored already isn't written again. '''
+        os.makedirs(self.tmpDir, exist_ok=True)
+        (fd, tmpPath) = mkstemp(dir=self.tmpDir)
+        try:
+            hash = sha256()
+            size = 0
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    hash.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+
+            digest = hash.hexdigest()
+            path = self.path(digest)
+            if self._touch(path):
+                os.unlink(tmpPath)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmpPath, path)
+        except:
+            if os.path.exists(tmpPath):
+                os.unlink(tmpPath)
+            raise
+
+        return (digest, size)
+
+
+    def record(self, db, topic, time, files):
+        ''' Record the (filename, digest, size) files of a notification.
+        Committing is up to the caller. '''
+        cur = db.cursor()
+        try:
+            cur.executemany('''
+                INSERT INTO notification_attachment (time, topic, filename, sha256, size)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', [(time, topic, f, d, s) for (f, d, s) in files])
+        finally:
+            cur.close()
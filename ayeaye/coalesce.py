@@ -0,0 +1,401 @@
+from ayeaye.attachments import Attachment, closeAttachments
+from ayeaye.error import Error, InternalError
+from ayeaye.mtemail import SMTP_POOL, SMTP_TIMEOUT
+import arrow
+from hashlib import sha256
+import json
+from logging import getLogger
+import sqlite3
+from threading import Event, Thread
+from time import time
+
+
+LOGGER = getLogger('coalesce')
+
+# Seconds a digest waits for further notifications if only digestSize is set.
+DIGEST_INTERVAL = 300
+# Maximum number of notifications combined into one digest.
+DIGEST_MAX_SIZE = 1000
+# Maximum bytes of attachments of one digest, unless a single notification
+# has more.
+DIGEST_MAX_BYTES = 20 * 1024 * 1024
+# Seconds on top of the SMTP waits and timeouts a digest may take to send,
+# e.g. for transferring large attachments.
+CLAIM_MARGIN = 120
+
+
+def notificationHash(notification):
+    ''' Hash of the title, content and attachments of a notification. '''
+    hash = sha256()
+    for value in [notification['title'], notification['content']]:
+        hash.update(json.dumps(value).encode('utf-8'))
+    for attachment in notification.get('attachments', []):
+        if isinstance(attachment, Attachment):
+            hash.update(attachment.filename.encode('utf-8'))
+            if attachment.digest is None:
+                for chunk in attachment.chunks():
+                    hash.update(chunk)
+            else:
+                hash.update(attachment.digest.encode('utf-8'))
+        else:
+            hash.update(json.dumps([attachment.get('filename'), attachment.get('content'),
+                attachment.get('sha256')]).encode('utf-8'))
+    # Half of the digest is plenty to tell notifications of a topic apart.
+    return hash.hexdigest()[0:32]
+
+
+def attachmentsSize(notification):
+    ''' The size in bytes of the attachments of a notification, base64 ones
+    are estimated from their length. '''
+    size = 0
+    for attachment in notification.get('attachments', []):
+        if isinstance(attachment, Attachment):
+            size += attachment.size
+        else:
+            size += len(attachment.get('content', '')) * 3 // 4
+    return size
+
+
+def claimLease():
+    ''' Seconds the expired dedup windows and buffered notifications taken
+    by the CoalesceService stay claimed while their summary or digest is
+    sent. Sending waits up to SMTP_POOL.maxWait for the rate limit, for a session
+    and for another one if the session was dropped, and up to SMTP_TIMEOUT
+    for every command of both sessions. If it takes longer another process
+    may take them again and send it twice. '''
+    return int(3 * SMTP_POOL.maxWait + 20 * SMTP_TIMEOUT + CLAIM_MARGIN)
+
+
+class DedupService(object):
+    ''' Tracks the notifications of topics with a dedupWindow.
+
+    The first notification with a given hash opens a window of dedupWindow
+    seconds and is sent, repeats within the window are only counted. Windows
+    are kept in the notification_dedup table, thus they're shared by all
+    processes and survive restarts. If sending the first notification fails
+    its window is released, so that it's sent again when it's retried. Once
+    a window expired the CoalesceService sends a summary of its repeats, the
+    window is claimed meanwhile and only removed once the summary was sent.
+    '''
+
+    def __init__(self, database):
+        self.db = database
+        self.opened = None # The id of the window opened by track
+
+
+    def track(self, topic, window, notification):
+        ''' Record the notification, returns True if it's a repeat. Otherwise
+        the id of the window it opened is kept in opened. '''
+        digest = notificationHash(notification)
+        now = int(time())
+        try:
+            cur = self.db.cursor()
+            cur.execute('''
+                UPDATE notification_dedup SET repeats = repeats + 1, last_time = ?
+                    WHERE topic = ? AND hash = ? AND expires > ?
+                ''', (now, topic, digest, now, ))
+            repeat = cur.rowcount > 0
+            if not repeat:
+                cur.execute('''
+                    INSERT INTO notification_dedup
+                        (topic, hash, first_time, last_time, expires, title, content)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ''', (topic, digest, now, now, now + int(window),
+                        notification['title'], notification['content'], ))
+                self.opened = cur.lastrowid
+            self.db.commit()
+        except sqlite3.Error as e:
+            # Better send a duplicate than lose a notification.
+            LOGGER.error('Failed to track notification: {}'.format(str(e)))
+            self.db.rollback()
+            return False
+        finally:
+            cur.close()
+
+        return repeat
+
+
+    def release(self, windowId):
+        ''' Remove a window, i.e. the one opened by a notification that failed
+        sending or an expired one whose summary was sent. '''
+        try:
+            cur = self.db.cursor()
+            cur.execute('DELETE FROM notification_dedup WHERE id = ?', (windowId, ))
+            self.db.commit()
+        except sqlite3.Error as e:
+            LOGGER.error('Failed to release dedup window {}: {}'.format(windowId, str(e)))
+            self.db.rollback()
+        finally:
+            cur.close()
+
+
+    def expired(self):
+        ''' Remove the expired windows without repeats and claim the ones
+        with repeats, which are returned. They must be released once their
+        summary is sent, otherwise they're taken again after claimLease(). '''
+        now = int(time())
+        claimed = now - claimLease()
+        cur = self.db.cursor()
+        try:
+            # Only take the write lock if there's something to remove.
+            cur.execute('''
+                SELECT 1 FROM notification_dedup WHERE expires <= ? AND claimed <= ? LIMIT 1
+                ''', (now, claimed, ))
+            if cur.fetchone() is None:
+                return []
+
+            cur.execute('BEGIN IMMEDIATE')
+            cur.execute('DELETE FROM notification_dedup WHERE expires <= ? AND repeats = 0',
+                    (now, ))
+            cur.execute('''
+                SELECT id, topic, first_time, last_time, repeats, title, content
+                    FROM notification_dedup WHERE expires <= ? AND claimed <= ?
+                ''', (now, claimed, ))
+            windows = cur.fetchall()
+            cur.executemany('UPDATE notification_dedup SET claimed = ? WHERE id = ?',
+                    [(now, window['id']) for window in windows])
+            self.db.commit()
+        except:
+            self.db.rollback()
+            raise
+        finally:
+            cur.close()
+
+        return windows
+
+
+    @staticmethod
+    def summary(window):
+        ''' The notification summarizing the repeats of an expired window. '''
+        return {
+            'title': '{} (repeated {} times)'.format(window['title'], window['repeats']),
+            'content': '{}\n\nThis notification was repeated {} times between {} and {}.'.format(
+                window['content'], window['repeats'],
+                arrow.get(window['first_time']).isoformat(),
+                arrow.get(window['last_time']).isoformat()),
+            'dedup': False,
+        }
+
+
+class DigestService(object):
+    ''' Buffers the notifications of topics with a digestInterval or
+    digestSize, which the CoalesceService combines into one digest every
+    digestInterval seconds or digestSize notifications.
+
+    Buffered notifications are kept in the notification_digest table like
+    queued ones, i.e. uploaded attachments as references to the store. They
+    are claimed while their digest is sent and only removed once it's sent,
+    if sending fails they're taken again once their claimLease() expired.
+    '''
+
+    def __init__(self, database):
+        self.db = database
+
+
+    def buffer(self, topic, notification, size=0):
+        ''' Buffer a notification with size bytes of attachments. '''
+        try:
+            cur = self.db.cursor()
+            cur.execute('''
+                INSERT INTO notification_digest (time, topic, notification, size)
+                    VALUES (?, ?, ?, ?)
+                ''', (int(time()), topic, json.dumps(notification), size, ))
+            self.db.commit()
+        except sqlite3.Error as e:
+            LOGGER.error(str(e))
+            self.db.rollback()
+            raise InternalError('Failed to buffer notification for digest')
+        finally:
+            cur.close()
+
+
+    def pending(self):
+        ''' The topics with unclaimed buffered notifications, their number
+        and the time of the oldest one. '''
+        cur = self.db.cursor()
+        try:
+            cur.execute('''
+                SELECT topic, COUNT(*) AS count, MIN(time) AS first_time
+                    FROM notification_digest WHERE claimed <= ? GROUP BY topic
+                ''', (int(time()) - claimLease(), ))
+            return cur.fetchall()
+        finally:
+            cur.close()
+
+
+    def take(self, topic, limit, maxBytes=DIGEST_MAX_BYTES):
+        ''' Claim and return the oldest limit unclaimed notifications of the
+        topic, fewer if their attachments have more than maxBytes. They must
+        be removed once their digest is sent. '''
+        now = int(time())
+        cur = self.db.cursor()
+        try:
+            cur.execute('BEGIN IMMEDIATE')
+            cur.execute('''
+                SELECT id, time, notification, size FROM notification_digest
+                    WHERE topic = ? AND claimed <= ? ORDER BY id LIMIT ?
+                ''', (topic, now - claimLease(), limit, ))
+            rows = []
+            size = 0
+            for row in cur.fetchall():
+                size += row['size'] or 0
+                if len(rows) > 0 and size > maxBytes:
+                    break
+                rows.append(row)
+            cur.executemany('UPDATE notification_digest SET claimed = ? WHERE id = ?',
+                    [(now, row['id']) for row in rows])
+            self.db.commit()
+        except:
+            self.db.rollback()
+            raise
+        finally:
+            cur.close()
+
+        return rows
+
+
+    def remove(self, rows):
+        ''' Remove taken notifications once their digest is sent. '''
+        cur = self.db.cursor()
+        try:
+            cur.executemany('DELETE FROM notification_digest WHERE id = ?',
+                    [(row['id'], ) for row in rows])
+            self.db.commit()
+        except:
+            self.db.rollback()
+            raise
+        finally:
+            cur.close()
+
+
+    @staticmethod
+    def combine(rows):
+        ''' The digest of buffered notifications, with all their attachments. '''
+        sections = []
+        attachments = []
+        for row in rows:
+            notification = json.loads(row['notification'])
+            sections.append('[{}] {}\n\n{}'.format(arrow.get(row['time']).isoformat(),
+                notification['title'], notification['content']))
+            attachments.extend(notification.get('attachments', []))
+
+        digest = {
+            'title': 'Digest of {} notifications'.format(len(rows)),
+            'content': '\n\n\n'.join(sections),
+            'dedup': False,
+            'digest': False,
+        }
+        if len(attachments) > 0:
+            digest['attachments'] = attachments
+        return digest
+
+
+class CoalesceService(object):
+    ''' Background thread sending the summaries of expired dedup windows and
+    the digests of topics that are due.
+
+    Summaries are queued if the API queues notifications, thus they're
+    retried like any other notification, otherwise they're sent right away.
+    '''
+
+    def __init__(self, connect, attachmentsDir=None, archiveWriter=None, interval=1,
+            delivery=None):
+        self.connect = connect
+        self.attachmentsDir = attachmentsDir
+        self.archiveWriter = archiveWriter
+        self.interval = interval # In seconds
+        self.delivery = delivery
+        self._stopped = Event()
+        self._thread = None
+
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = Thread(target=self._run, name='coalesce', daemon=True)
+        self._thread.start()
+
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+
+
+    def _run(self):
+        db = self.connect()
+        try:
+            while not self._stopped.wait(self.interval):
+                self.flush(db)
+        finally:
+            db.close()
+
+
+    def flush(self, db):
+        dedup = DedupService(db)
+        try:
+            windows = dedup.expired()
+        except sqlite3.Error as e:
+            LOGGER.error('Failed to get expired dedup windows: {}'.format(str(e)))
+            return
+
+        for window in windows:
+            # Otherwise it's taken again once its claim expired.
+            if self._send(db, window['topic'], DedupService.summary(window)):
+                dedup.release(window['id'])
+
+        try:
+            self._flushDigests(db)
+        except sqlite3.Error as e:
+            LOGGER.error('Failed to flush digests: {}'.format(str(e)))
+
+
+    def _flushDigests(self, db):
+        # Imported here as appsvc uses the DigestService.
+        from ayeaye.appsvc import NotificationService
+
+        digests = DigestService(db)
+        now = int(time())
+        for (topic, count, firstTime) in digests.pending():
+            try:
+                settings = NotificationService(topic, db).notificationHandler.settings
+            except Error:
+                # The handler is gone, sending the digest fails and is logged.
+                settings = {}
+            # Digests of topics that aren't digested anymore are sent right away.
+            digested = settings.get('digestInterval') or settings.get('digestSize')
+            size = min(settings.get('digestSize') or DIGEST_MAX_SIZE, DIGEST_MAX_SIZE)
+            due = not digested \
+                    or firstTime + (settings.get('digestInterval') or DIGEST_INTERVAL) <= now
+
+            while count > 0 and (count >= size or due):
+                rows = digests.take(topic, size)
+                if len(rows) == 0:
+                    break
+                count -= len(rows)
+                # Otherwise they're taken again once their claim expired.
+                if not self._send(db, topic, DigestService.combine(rows)):
+                    break
+                digests.remove(rows)
+
+
+    def _send(self, db, topic, notification):
+        ''' Send or queue the notification, returns False if that failed. '''
+        # Imported here as appsvc uses the DedupService.
+        from ayeaye.appsvc import NotificationService
+
+        ns = NotificationService(topic, db, attachmentsDir=self.attachmentsDir,
+                archiveWriter=self.archiveWriter)
+        try:
+            # Buffered attachments reference the attachment store.
+            ns._loadStoredAttachments(notification)
+            if self.delivery is not None:
+                ns.queueNotification(notification)
+                self.delivery.notify()
+            else:
+                ns.sendNotification(notification)
+        except Error as e:
+            LOGGER.error('Failed to send {} of {}: {}'.format(notification['title'], topic, str(e)))
+            return False
+        finally:
+            closeAttachments(notification)
+        return True
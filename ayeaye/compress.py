@@ -0,0 +1,247 @@
+from ayeaye.partition import ArchivePartitions
+from ayeaye.search import createSearchIndex, indexContents
+from collections import Counter
+from logging import getLogger
+from threading import Lock
+from time import time
+import zlib
+
+
+LOGGER = getLogger('compress')
+
+COMPRESSIONS = ['none', 'zlib']
+# The content_format of archive rows, rows of any format stay readable.
+FORMAT_TEXT = 0
+FORMAT_ZLIB = 1
+# Shorter contents are stored as text, compressing them doesn't pay off.
+MIN_SIZE = 256 # In bytes
+# Number of archived notifications of a topic its dictionary is trained from.
+DICTIONARY_SAMPLES = 50
+# zlib only uses the last 32 KiB of a preset dictionary.
+DICTIONARY_SIZE = 32 * 1024
+
+
+def trainDictionary(samples, size=DICTIONARY_SIZE):
+    ''' A zlib preset dictionary of the sample contents, newest first. Lines
+    that occur in several samples, e.g. the fixed parts of a report, come
+    last with the most common ones at the end, as zlib encodes matches at
+    short distances best. The rest is filled with the newest samples. '''
+    counts = Counter()
+    for sample in samples:
+        counts.update(set(sample.splitlines(True)))
+    common = [line for (line, n) in counts.most_common() if n > 1]
+    dictionary = ''.join(reversed(common)).encode('utf-8')[-size:]
+
+    for sample in samples:
+        if len(dictionary) >= size:
+            break
+        dictionary = sample.encode('utf-8')[-(size - len(dictionary)):] + dictionary
+    return dictionary
+
+
+class ContentCompressor(object):
+    ''' Compresses the contents of archived notifications with zlib, using a
+    preset dictionary per topic.
+
+    Once a topic has DICTIONARY_SAMPLES archived notifications a dictionary
+    is trained from them and stored in notification_dictionary, until then
+    its contents are compressed without one. Rows refer to the dictionary
+    they were compressed with by content_dict, thus dictionaries are never
+    changed and are cached. Contents that are short or don't get smaller
+    are stored as text, content_format tells how a row is stored.
+    '''
+
+    def __init__(self, compression='none', minSize=MIN_SIZE):
+        self.compression = compression
+        self.minSize = minSize
+        # The (id, dictionary) of a topic, or the number of notifications
+        # until training its dictionary is tried again.
+        self._topics = {}
+        self._dictionaries = {}
+        self._lock = Lock()
+
+
+    def configure(self, compression, minSize=MIN_SIZE):
+        ''' Set the compression, forgetting the cached dictionaries. '''
+        self.compression = compression
+        self.minSize = minSize
+        self.reset()
+
+
+    def reset(self):
+        ''' Forget the cached dictionaries, e.g. since a transaction that
+        stored a dictionary was rolled back. '''
+        with self._lock:
+            self._topics = {}
+            self._dictionaries = {}
+
+
+    def compress(self, cur, topic, content):
+        ''' The content of a notification as stored in the archive, i.e.
+        (content, content_format, content_dict). A new dictionary is
+        stored in the transaction of cur. '''
+        data = content.encode('utf-8')
+        if self.compression in [None, 'none'] or len(data) < self.minSize:
+            return (content, FORMAT_TEXT, None)
+
+        (dictionaryId, dictionary) = self._topicDictionary(cur, topic)
+        if dictionary is None:
+            compressor = zlib.compressobj()
+        else:
+            compressor = zlib.compressobj(zdict=dictionary)
+        compressed = compressor.compress(data) + compressor.flush()
+        if len(compressed) >= len(data):
+            return (content, FORMAT_TEXT, None)
+        return (compressed, FORMAT_ZLIB, dictionaryId)
+
+
+    def decompress(self, db, content, contentFormat, dictionaryId=None):
+        ''' The text of content stored in contentFormat. Raises ValueError if
+        it can't be decompressed. '''
+        if contentFormat in [None, FORMAT_TEXT]:
+            return content
+        if contentFormat != FORMAT_ZLIB:
+            raise ValueError('Unknown content format {}'.format(contentFormat))
+
+        try:
+            if dictionaryId is None:
+                return zlib.decompress(content).decode('utf-8')
+            decompressor = zlib.decompressobj(zdict=self._dictionary(db, dictionaryId))
+            return (decompressor.decompress(content) + decompressor.flush()).decode('utf-8')
+        except zlib.error as e:
+            raise ValueError('Invalid compressed content: {}'.format(str(e)))
+
+
+    def _dictionary(self, db, dictionaryId):
+        with self._lock:
+            dictionary = self._dictionaries.get(dictionaryId)
+        if dictionary is not None:
+            return dictionary
+
+        cur = db.cursor()
+        try:
+            cur.execute('SELECT dictionary FROM notification_dictionary WHERE id = ?',
+                    (dictionaryId, ))
+            row = cur.fetchone()
+        finally:
+            cur.close()
+        if row is None:
+            raise ValueError('No such dictionary {}'.format(dictionaryId))
+
+        with self._lock:
+            self._dictionaries[dictionaryId] = row[0]
+        return row[0]
+
+
+    def _topicDictionary(self, cur, topic):
+        with self._lock:
+            entry = self._topics.get(topic)
+            if type(entry) is tuple:
+                return entry
+            if entry is not None and entry > 0:
+                self._topics[topic] = entry - 1
+                return (None, None)
+
+        cur.execute('''
+            SELECT id, dictionary FROM notification_dictionary
+                WHERE topic = ? ORDER BY id DESC LIMIT 1
+            ''', (topic, ))
+        entry = cur.fetchone()
+        entry = tuple(entry) if entry is not None else self._train(cur, topic)
+
+        with self._lock:
+            self._topics[topic] = DICTIONARY_SAMPLES if entry is None else entry
+            if entry is not None:
+                self._dictionaries[entry[0]] = entry[1]
+        return (None, None) if entry is None else entry
+
+
+    def _train(self, cur, topic):
+        ''' Train and store the dictionary of topic from its newest archived
+        notifications, if there are enough of them. Returns its id and the
+        dictionary. '''
+        samples = []
+        # The partitions newest first, the unpartitioned archive is the oldest.
+        for table in reversed(ArchivePartitions.tables(cur.connection)):
+            cur.execute('''
+                SELECT content, content_format, content_dict FROM {}
+                    WHERE topic = ? ORDER BY time DESC LIMIT ?
+                '''.format(table), (topic, DICTIONARY_SAMPLES - len(samples), ))
+            for row in cur.fetchall():
+                try:
+                    samples.append(self.decompress(cur.connection, *row))
+                except ValueError as e:
+                    LOGGER.warning('Skipping a sample of {}: {}'.format(topic, str(e)))
+            if len(samples) >= DICTIONARY_SAMPLES:
+                break
+
+        if len(samples) < DICTIONARY_SAMPLES:
+            return None
+
+        dictionary = trainDictionary(samples)
+        cur.execute('''
+            INSERT INTO notification_dictionary (topic, time, dictionary) VALUES (?, ?, ?)
+            ''', (topic, int(time()), dictionary, ))
+        LOGGER.info('Trained a compression dictionary of {} bytes for {}'.format(
+            len(dictionary), topic))
+        return (cur.lastrowid, dictionary)
+
+
+def migrateCompression(db):
+    ''' Migration adding the columns of compressed contents to the archive
+    tables. Compressed contents are indexed for search by the archive, thus
+    the triggers now skip them. '''
+    tables = ArchivePartitions.allTables(db)
+
+    cur = db.cursor()
+    try:
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS notification_dictionary (
+              id INTEGER PRIMARY KEY,
+              topic VARCHAR(32),
+              time INTEGER,
+              dictionary BLOB
+            )''')
+        for table in tables:
+            existing = [r[1] for r in cur.execute('PRAGMA table_info({})'.format(table)).fetchall()]
+            for (name, definition) in [('content_format', 'INTEGER DEFAULT 0'),
+                    ('content_dict', 'INTEGER')]:
+                if name not in existing:
+                    cur.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table, name, definition))
+            cur.execute('DROP TRIGGER IF EXISTS {}_fts_insert'.format(table))
+            createSearchIndex(cur, table)
+        db.commit()
+    finally:
+        cur.close()
+
+
+def migrateSearchContent(db):
+    ''' Migration replacing the search indexes of the archive tables, which
+    kept a copy of the texts, by contentless ones. Compressed contents are
+    indexed by their decompressed text. '''
+    tables = ArchivePartitions.allTables(db)
+
+    def texts(table):
+        for (rowId, title, content, contentFormat, dictionaryId) in db.execute('''
+                SELECT id, title, content, content_format, content_dict FROM {}
+                '''.format(table)):
+            try:
+                yield (rowId, title, CONTENT_COMPRESSOR.decompress(db, content, contentFormat,
+                    dictionaryId))
+            except ValueError as e:
+                LOGGER.warning('Not indexing {} of {}: {}'.format(rowId, table, str(e)))
+
+    cur = db.cursor()
+    try:
+        for table in tables:
+            cur.execute('DROP TRIGGER IF EXISTS {}_fts_insert'.format(table))
+            cur.execute('DROP TRIGGER IF EXISTS {}_fts_delete'.format(table))
+            cur.execute('DROP TABLE IF EXISTS {}_fts'.format(table))
+            createSearchIndex(cur, table)
+            indexContents(cur, table, texts(table))
+        db.commit()
+    finally:
+        cur.close()
+
+
+CONTENT_COMPRESSOR = ContentCompressor()
@@ -0,0 +1,80 @@
+from logging import getLogger
+from queue import LifoQueue, Empty, Full
+import sqlite3
+
+
+LOGGER = getLogger('database')
+
+JOURNAL_MODES = ['delete', 'truncate', 'persist', 'memory', 'wal', 'off']
+SYNCHRONOUS = ['off', 'normal', 'full', 'extra']
+
+
+class ConnectionPool(object):
+    ''' A pool of sqlite3 connections to one database.
+
+    Connections are configured once when they're opened and handed out to
+    one thread at a time. Up to size idle connections are kept open, any
+    more are closed when they're released. The journal mode is a property of
+    the database file and thus only set once when the pool is created.
+    '''
+
+    def __init__(self, databasePath, size=8, journalMode='wal', synchronous='normal',
+            busyTimeout=5000, cacheSize=-2000, mmapSize=0):
+        if journalMode not in JOURNAL_MODES:
+            raise ValueError('Invalid journal mode: {}'.format(journalMode))
+        if synchronous not in SYNCHRONOUS:
+            raise ValueError('Invalid synchronous setting: {}'.format(synchronous))
+
+        self.databasePath = databasePath
+        self.synchronous = synchronous
+        self.busyTimeout = busyTimeout # In milliseconds
+        self.cacheSize = cacheSize # In pages or KiB if negative
+        self.mmapSize = mmapSize # In bytes
+        self._idle = LifoQueue(maxsize=size)
+
+        db = self.connect()
+        try:
+            mode = db.execute('PRAGMA journal_mode = {}'.format(journalMode)).fetchone()[0]
+            if mode != journalMode:
+                LOGGER.warning('Database uses journal mode {} instead of {}'.format(
+                    mode, journalMode))
+        finally:
+            db.close()
+
+
+    def connect(self):
+        ''' Open a new configured connection that isn't managed by the pool. '''
+        db = sqlite3.connect(self.databasePath, timeout=self.busyTimeout / 1000,
+                check_same_thread=False)
+        db.row_factory = sqlite3.Row
+        db.execute('PRAGMA synchronous = {}'.format(self.synchronous))
+        db.execute('PRAGMA busy_timeout = {}'.format(int(self.busyTimeout)))
+        db.execute('PRAGMA cache_size = {}'.format(int(self.cacheSize)))
+        db.execute('PRAGMA mmap_size = {}'.format(int(self.mmapSize)))
+        return db
+
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            return self.connect()
+
+
+    def release(self, db):
+        # Never hand out a connection with a transaction left open.
+        if db.in_transaction:
+            db.rollback()
+
+        try:
+            self._idle.put_nowait(db)
+        except Full:
+            db.close()
+
+
+    def closeAll(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Empty:
+                break
@@ -0,0 +1,204 @@
+from ayeaye.appsvc import NotificationService
+from ayeaye.attachments import closeAttachments
+from ayeaye.error import Error, ArchiveError
+import json
+from logging import getLogger
+import random
+import sqlite3
+from threading import Condition, Thread
+from time import time
+
+
+LOGGER = getLogger('delivery')
+
+
+class DeliveryService(object):
+    ''' Pool of background workers draining the notification_queue table.
+
+    Notifications accepted by the API are only written to the queue, the
+    workers then claim them one by one and hand them to the NotificationService
+    which does the actual sending and archiving. A claimed notification whose
+    worker died (i.e. the process got killed) is picked up again after the
+    lease expired.
+
+    A delivery that failed for a temporary reason is retried up to
+    maxAttempts times, with an exponentially growing and jittered delay.
+    Every attempt is recorded in notification_attempt.
+    '''
+
+    def __init__(self, databasePath, attachmentsDir=None, workers=2,
+            pollInterval=5, lease=300, pool=None, archiveWriter=None,
+            maxAttempts=5, retryDelay=30, retryMaxDelay=3600):
+        self.databasePath = databasePath
+        self.pool = pool
+        self.archiveWriter = archiveWriter
+        self.attachmentsDir = attachmentsDir
+        self.workers = workers
+        self.pollInterval = pollInterval # In seconds
+        self.lease = lease # In seconds
+        self.maxAttempts = maxAttempts
+        self.retryDelay = retryDelay # In seconds
+        self.retryMaxDelay = retryMaxDelay # In seconds
+        self._condition = Condition()
+        self._running = False
+        self._threads = []
+
+
+    def start(self):
+        self._running = True
+        for i in range(self.workers):
+            t = Thread(target=self._run, name='delivery-{}'.format(i), daemon=True)
+            t.start()
+            self._threads.append(t)
+        LOGGER.info('Started {} delivery workers'.format(self.workers))
+
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+
+    def notify(self):
+        ''' Wake up an idle worker, called after a notification got queued. '''
+        with self._condition:
+            self._condition.notify()
+
+
+    def _connect(self):
+        # Workers keep their connection, thus it's not taken from the pool.
+        if self.pool is not None:
+            return self.pool.connect()
+
+        db = sqlite3.connect(self.databasePath, timeout=30)
+        db.row_factory = sqlite3.Row
+        return db
+
+
+    def _run(self):
+        db = self._connect()
+        try:
+            while self._running:
+                try:
+                    queued = self._claim(db)
+                except sqlite3.Error as e:
+                    LOGGER.error('Failed to claim notification: {}'.format(str(e)))
+                    queued = None
+
+                if queued is None:
+                    with self._condition:
+                        if self._running:
+                            self._condition.wait(self.pollInterval)
+                    continue
+
+                self._deliver(db, queued)
+        finally:
+            db.close()
+
+
+    def _claim(self, db):
+        now = int(time())
+        cur = db.cursor()
+        try:
+            cur.execute('BEGIN IMMEDIATE')
+            cur.execute('''
+                SELECT id, topic, notification, attempts FROM notification_queue
+                    WHERE (state = 'pending' AND next_attempt <= ?)
+                        OR (state = 'sending' AND claimed < ?)
+                    ORDER BY next_attempt, id LIMIT 1
+                ''', (now, now - self.lease, ))
+            queued = cur.fetchone()
+            if queued is not None:
+                cur.execute('''
+                    UPDATE notification_queue SET state = 'sending', claimed = ?
+                        WHERE id = ?
+                    ''', (now, queued['id'], ))
+            db.commit()
+        except:
+            db.rollback()
+            raise
+        finally:
+            cur.close()
+
+        return queued
+
+
+    def _deliver(self, db, queued):
+        attempts = queued['attempts'] + 1
+        error = None
+        retry = False
+        notification = {}
+        try:
+            notification = json.loads(queued['notification'])
+            ns = NotificationService(queued['topic'], db,
+                    attachmentsDir=self.attachmentsDir, archiveWriter=self.archiveWriter)
+            # Uploaded attachments were queued as references to the store.
+            ns._loadStoredAttachments(notification)
+            ns.sendNotification(notification, archiveFailed=attempts >= self.maxAttempts)
+        except ArchiveError as e:
+            # It was sent, retrying would send it again.
+            self._archiveFailed(queued, e)
+        except Exception as e:
+            error = str(e)
+            retry = self._retryable(e, attempts)
+        finally:
+            closeAttachments(notification)
+
+        self._finish(db, queued, attempts, error, retry)
+
+
+    @staticmethod
+    def _archiveFailed(queued, error):
+        LOGGER.error('Delivered notification {}, but failed to archive it: {}'.format(
+            queued['id'], str(error)))
+
+
+    def _retryable(self, error, attempts):
+        # An invalid notification doesn't become valid by retrying it.
+        return isinstance(error, Error) and error.code >= 500 \
+                and attempts < self.maxAttempts
+
+
+    def _finish(self, db, queued, attempts, error=None, retry=False):
+        ''' Record the outcome of a delivery attempt. '''
+        if error is None:
+            state = 'sent'
+            nextAttempt = None
+        elif retry:
+            state = 'pending'
+            nextAttempt = int(time() + self.backoff(attempts))
+            LOGGER.warning('Failed to deliver notification {}, retrying in {} s: {}'.format(
+                queued['id'], nextAttempt - int(time()), error))
+        else:
+            state = 'failed'
+            nextAttempt = None
+            LOGGER.error('Failed to deliver notification {}: {}'.format(
+                queued['id'], error))
+
+        try:
+            cur = db.cursor()
+            cur.execute('''
+                UPDATE notification_queue SET state = ?, attempts = ?, next_attempt = ?
+                    WHERE id = ?
+                ''', (state, attempts, nextAttempt, queued['id'], ))
+            cur.execute('''
+                INSERT INTO notification_attempt (queue_id, time, error)
+                    VALUES (?, ?, ?)
+                ''', (queued['id'], int(time()), error, ))
+            db.commit()
+        except sqlite3.Error as e:
+            LOGGER.error('Failed to update queued notification {}: {}'.format(
+                queued['id'], str(e)))
+        finally:
+            cur.close()
+
+
+    def backoff(self, attempts):
+        ''' Seconds to wait before the next attempt, after attempts failed
+        ones. Jittered so that notifications failing together don't retry
+        together. '''
+        delay = min(self.retryMaxDelay, self.retryDelay * 2 ** (attempts - 1))
+        return random.uniform(delay / 2, delay)
@@ -37,6 +37,8 @@ ConstraintViolationError = genError('ConstraintViolationError', 412, 30, 'CONSTR
 TeapotError = genError('TeapotError', 418, 10, 'TEAPOT')
 LimitExceededError = genError('LimitExceededError', 429, 30, 'LIMIT_EXCEEDED')
 InternalError = genError('InternalError', 500, 50, 'INTERNAL_ERROR')
+# The notification was sent, but archiving it failed.
+ArchiveError = genError('ArchiveError', 500, 50, 'ARCHIVE_ERROR')
 TransactionError = genError('TransactionError', 500, 40, 'TRANSACTION_ERROR')
 SearchError = genError('SearchError', 500, 30, 'SEARCH_ERROR')
 UnknownError = genError('UnknownError', 500, 50, 'UNKNOWN_ERROR')
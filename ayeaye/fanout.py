@@ -0,0 +1,103 @@
+from ayeaye.error import Error, InternalError, BadRequestError
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from threading import Lock
+
+
+LOGGER = getLogger('fanout')
+
+
+def targetSettings(settings):
+    ''' The settings of every target of a handler. A target's settings
+    override the ones of the handler, e.g. a target may only set toAddr. '''
+    targets = settings['targets']
+    if type(targets) is not list or len(targets) == 0 \
+            or any([type(t) is not dict for t in targets]):
+        raise BadRequestError('Targets must be a non-empty list of settings')
+
+    base = dict([(k, v) for (k, v) in settings.items() if k != 'targets'])
+    return [dict(base, **t) for t in targets]
+
+
+class TargetExecutor(object):
+    ''' Bounded thread pool shared by all fan-out deliveries. The pool is
+    created on first use, thus maxThreads can still be configured before. '''
+
+    def __init__(self, maxThreads=8):
+        self.maxThreads = maxThreads
+        self._executor = None
+        self._lock = Lock()
+
+
+    def submit(self, func, *args):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.maxThreads,
+                        thread_name_prefix='fanout')
+        return self._executor.submit(func, *args)
+
+
+    def shutdown(self):
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+        if executor is not None:
+            executor.shutdown()
+
+
+TARGET_EXECUTOR = TargetExecutor()
+
+
+class FanOutNotificationService(object):
+    ''' Delivers a notification to several targets of a topic concurrently,
+    e.g. to different mail servers or recipient groups.
+
+    A notification counts as sent if at least one target got it, the status
+    of every target is returned as {'targets': [...]}. If all targets failed
+    an InternalError is raised, like for a topic with a single target.
+    '''
+
+    def __init__(self, handlers, settings=None):
+        self.handlers = handlers
+        self.settings = {} if settings is None else settings
+
+
+    def sendNotification(self, notification):
+        futures = [TARGET_EXECUTOR.submit(h.sendNotification, notification)
+                for h in self.handlers]
+        errors = []
+        for f in futures:
+            try:
+                f.result()
+            except Exception as e:
+                errors.append(e)
+            else:
+                errors.append(None)
+        return self._results(errors)
+
+
+    async def sendNotificationAsync(self, notification):
+        outcomes = await asyncio.gather(
+                *[h.sendNotificationAsync(notification) for h in self.handlers],
+                return_exceptions=True)
+        return self._results([o if isinstance(o, Exception) else None for o in outcomes])
+
+
+    def _results(self, errors):
+        results = []
+        for (idx, error) in enumerate(errors):
+            if error is None:
+                results.append({'target': idx, 'status': 200})
+                continue
+
+            LOGGER.warning('Failed to send notification to target {}: {}'.format(
+                idx, str(error)))
+            if not isinstance(error, Error):
+                error = InternalError(str(error))
+            results.append({'target': idx, 'status': error.code, 'error': error.toDict()})
+
+        if all([e is not None for e in errors]):
+            raise InternalError('Failed to send notification to all {} targets'.format(
+                len(errors)))
+        return {'targets': results}
@@ -1,14 +1,266 @@
-from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
-from email.mime.multipart import MIMEMultipart
+from ayeaye.attachments import Attachment
 from ayeaye.error import Error, AuthenticationError, InternalError, MissingAttributeError, \
-        UnknownError, BadRequestError
+        UnknownError, BadRequestError, BusyError
+from ayeaye.ratelimit import TokenBucket
+from ayeaye.template import MessageTemplate
 from logging import getLogger
+import asyncio
 import smtplib
-import base64
+from threading import Condition, Lock
+from time import sleep, time
 
 LOGGER = getLogger('mtemail')
-COMMASPACE = ', '
+
+# Seconds every SMTP command of a notification may take.
+SMTP_TIMEOUT = 10
+
+
+class PooledConnection(object):
+
+    def __init__(self, key, smtp):
+        self.key = key
+        self.smtp = smtp
+        self.messages = 0
+        self.lastUsed = time()
+
+
+class SmtpConnectionPool(object):
+    ''' Keeps authenticated SMTP sessions alive between notifications.
+
+    Sessions are keyed by (server, port, ssl, starttls, user) and are checked
+    with NOOP before they get reused. A session is closed after it sent
+    maxMessages messages or was idle for more than maxIdle seconds.
+
+    The settings of a server may limit the messages sent to it per second
+    (rateLimit, with bursts of up to rateBurst messages) and the number of
+    sessions open to it at once (maxConnections). Senders wait for up to
+    maxWait seconds to get within these limits, instead of failing. The
+    limits are kept by each process, thus if the server runs several
+    processes each gets its share, i.e. the limits divided by processes.
+    '''
+
+    def __init__(self, maxMessages=100, maxIdle=60, maxWait=30, processes=1):
+        self.maxMessages = maxMessages
+        self.maxIdle = maxIdle # In seconds
+        self.maxWait = maxWait # In seconds
+        self.processes = processes
+        self._idle = {}
+        self._open = {}
+        self._buckets = {}
+        self._slots = {}
+        self._lock = Lock()
+        self._released = Condition(self._lock)
+
+
+    @staticmethod
+    def key(settings):
+        return (settings['server'], settings['port'], bool(settings['ssl']),
+                bool(settings['starttls']),
+                settings.get('user') if settings['auth'] else None)
+
+
+    @staticmethod
+    def serverKey(settings):
+        return (settings['server'], settings['port'])
+
+
+    def sendmail(self, settings, msg, timeout=10):
+        ''' Send msg over a pooled session. If the server dropped the session
+        in the meantime we reconnect once and try again. '''
+        self.throttle(settings)
+        conn = self.acquire(settings, timeout)
+        try:
+            try:
+                conn.smtp.sendmail(settings['fromAddr'], settings['toAddr'], msg)
+            except smtplib.SMTPServerDisconnected:
+                self.discard(conn)
+                conn = None
+                # Within maxConnections like any other session.
+                conn = self.acquire(settings, timeout)
+                conn.smtp.sendmail(settings['fromAddr'], settings['toAddr'], msg)
+        except:
+            if conn is not None:
+                self.discard(conn)
+            raise
+
+        self.release(conn)
+
+
+    def throttle(self, settings):
+        ''' Wait until a message may be sent to the server. '''
+        wait = self.reserve(settings)
+        if wait > 0:
+            sleep(wait)
+
+
+    def reserve(self, settings):
+        ''' Reserve sending a message to the server, returns the seconds to
+        wait before sending it. Raises BusyError if that's more than maxWait. '''
+        bucket = self._bucket(settings)
+        if bucket is None:
+            return 0
+
+        wait = bucket.reserve(self.maxWait)
+        if wait is None:
+            raise BusyError('Rate limit of {}:{} exceeded'.format(*self.serverKey(settings)))
+        return wait
+
+
+    def acquire(self, settings, timeout=10):
+        key = self.key(settings)
+        serverKey = self.serverKey(settings)
+        maxConnections = self.maxConnections(settings)
+        deadline = time() + self.maxWait
+        while True:
+            with self._lock:
+                while True:
+                    idle = self._idle.get(key)
+                    if idle:
+                        conn = idle.pop()
+                        break
+                    if not maxConnections or self._open.get(serverKey, 0) < maxConnections:
+                        # Reserve the slot of the session that is opened below.
+                        self._open[serverKey] = self._open.get(serverKey, 0) + 1
+                        conn = None
+                        break
+                    if not self._released.wait(deadline - time()):
+                        raise BusyError('Too many connections to {}:{}'.format(*serverKey))
+
+            if conn is None:
+                return self._connect(settings, timeout, reserved=True)
+
+            if time() - conn.lastUsed > self.maxIdle:
+                self.discard(conn)
+                continue
+
+            try:
+                if conn.smtp.noop()[0] == 250:
+                    return conn
+            except (smtplib.SMTPException, OSError) as e:
+                LOGGER.debug('Pooled SMTP session is dead: {}'.format(str(e)))
+            self.discard(conn)
+
+
+    def release(self, conn):
+        conn.messages += 1
+        conn.lastUsed = time()
+        if conn.messages >= self.maxMessages:
+            self.discard(conn)
+            return
+
+        with self._lock:
+            self._idle.setdefault(conn.key, []).append(conn)
+            self._released.notify()
+
+
+    def discard(self, conn):
+        try:
+            conn.smtp.quit()
+        except Exception:
+            conn.smtp.close()
+        self._closed(conn.key[0:2])
+
+
+    def closeAll(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+        for conns in idle.values():
+            for conn in conns:
+                self.discard(conn)
+
+
+    def asyncSlot(self, settings):
+        ''' Semaphore limiting the concurrent sessions of the asyncio delivery
+        engine to the server, which doesn't use pooled sessions. '''
+        maxConnections = self.maxConnections(settings)
+        if not maxConnections:
+            return None
+
+        key = (self.serverKey(settings), maxConnections)
+        with self._lock:
+            if key not in self._slots:
+                self._slots[key] = asyncio.Semaphore(maxConnections)
+            return self._slots[key]
+
+
+    def maxConnections(self, settings):
+        ''' This process' share of the maxConnections of the server, at
+        least one session. '''
+        maxConnections = settings.get('maxConnections')
+        if not maxConnections:
+            return None
+        return max(1, maxConnections // self.processes)
+
+
+    def _bucket(self, settings):
+        rate = settings.get('rateLimit')
+        if not rate:
+            return None
+
+        burst = max(1, settings.get('rateBurst', max(1, rate)) // self.processes)
+        rate = rate / self.processes
+        key = self.serverKey(settings)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(rate, burst)
+            # Follow changed settings without losing the saved up tokens.
+            bucket.rate = rate
+            bucket.burst = burst
+        return bucket
+
+
+    def _closed(self, serverKey):
+        with self._lock:
+            self._open[serverKey] = max(0, self._open.get(serverKey, 0) - 1)
+            self._released.notify()
+
+
+    def _connect(self, settings, timeout, reserved=False):
+        ''' Open a session. Unless the caller reserved a slot already one is
+        taken for the session. '''
+        serverKey = self.serverKey(settings)
+        if not reserved:
+            with self._lock:
+                self._open[serverKey] = self._open.get(serverKey, 0) + 1
+
+        try:
+            if settings['auth'] and not ('user' in settings and 'password' in settings):
+                raise MissingAttributeError('No user/password supplied')
+
+            if settings['ssl'] and not settings['starttls']:
+                s = smtplib.SMTP_SSL(host=settings['server'], port=settings['port'],
+                        timeout=timeout)
+            else:
+                s = smtplib.SMTP(host=settings['server'], port=settings['port'],
+                        timeout=timeout)
+        except:
+            self._closed(serverKey)
+            raise
+
+        try:
+            if settings['starttls']:
+                s.starttls()
+
+            if settings['auth']:
+                s.login(settings['user'], settings['password'])
+        except:
+            s.close()
+            self._closed(serverKey)
+            raise
+
+        return PooledConnection(self.key(settings), s)
+
+
+SMTP_POOL = SmtpConnectionPool()
+
+
+def messageBytes(msg):
+    ''' The message as sent over SMTP, i.e. with CRLF line endings, which
+    smtplib doesn't add to bytes. '''
+    return msg.as_bytes(policy=msg.policy.clone(linesep='\r\n'))
 
 
 class EmailNotificationService(object):
@@ -23,50 +275,46 @@ class EmailNotificationService(object):
                     '''Required attributes: server, port, toAddr, fromAddr, ssl, auth, starttls''')
 
         self.settings = settings
-        self.timeout = 10 # In seconds
+        self.timeout = SMTP_TIMEOUT # In seconds
+        # Handlers are cached, thus the template is compiled once per handler.
+        self.template = MessageTemplate.fromSettings(settings)
 
 
-    def sendNotification(self, notification):
-        msg = MIMEMultipart()
+    def buildMessage(self, notification):
+        msg = self.template.render(notification)
 
-        msg['Subject'] = notification['title']
-        msg['From'] = self.settings['fromAddr']
-        msg['To'] = COMMASPACE.join(self.settings['toAddr'])
-        msg.attach(MIMEText(notification['content']))
-
-        try:
-            if 'attachments' in notification:
-                if type(notification['attachments']) is list :
-                    for f in notification['attachments']:
-                        if not ("filename" in f and "content" in f):
-                            raise BadRequestError('One of the file is missing filename or content')
-                        file_cont = base64.b64decode(f["content"].encode('utf-8'))
-                        file_name = f["filename"]
-                        part = MIMEApplication(file_cont, name=file_name)
-                        part['Content-Diposition'] = 'attachment; filename="%s"' % file_name
-                        msg.attach(part)
-                else:
-                    raise BadRequestError('Attachments must be a list')
-
-            s = None
-
-            if self.settings['ssl'] and not self.settings['starttls']:
-                s = smtplib.SMTP_SSL(host=self.settings['server'],
-                        port=self.settings['port'], timeout=self.timeout)
+        if 'attachments' in notification:
+            if type(notification['attachments']) is list :
+                for f in notification['attachments']:
+                    if isinstance(f, Attachment):
+                        msg.attach(self._attachmentPart(f))
+                        continue
+                    # Attachments not decoded by the caller already are
+                    # decoded here, only for as long as it takes to encode them.
+                    if not ("filename" in f and "content" in f):
+                        raise BadRequestError('One of the file is missing filename or content')
+                    f = Attachment.fromBase64(f)
+                    try:
+                        msg.attach(self._attachmentPart(f))
+                    finally:
+                        f.close()
             else:
-                s = smtplib.SMTP(host=self.settings['server'], port=self.settings['port'],
-                        timeout=self.timeout)
+                raise BadRequestError('Attachments must be a list')
 
-            if self.settings['starttls']:
-                s.starttls()
+        return msg
+
+
+    @staticmethod
+    def _attachmentPart(attachment):
+        part = MIMEApplication(b'', name=attachment.filename, _encoder=attachment.encodeMime)
+        part['Content-Diposition'] = 'attachment; filename="%s"' % attachment.filename
+        return part
 
-            if self.settings['auth']:
-                if 'user' in self.settings and 'password' in self.settings:
-                    s.login(self.settings['user'], self.settings['password'])
-                else:
-                    raise MissingAttributeError('No user/password supplied')
 
-            s.sendmail(self.settings['fromAddr'], self.settings['toAddr'], msg.as_string())
+    def sendNotification(self, notification):
+        try:
+            msg = self.buildMessage(notification)
+            SMTP_POOL.sendmail(self.settings, messageBytes(msg), timeout=self.timeout)
         except smtplib.SMTPConnectError as e:
             LOGGER.error(str(e))
             raise InternalError('Failed to connect to SMTP server')
@@ -84,6 +332,49 @@ class EmailNotificationService(object):
             raise UnknownError('Oops, ... Something went wrong!')
         else:
             return True
+
+
+    async def sendNotificationAsync(self, notification):
+        # Encoding attachments may read them from disk, thus it's done by the
+        # default executor.
+        loop = asyncio.get_running_loop()
+        msg = await loop.run_in_executor(None, self.buildMessage, notification)
+        await self.sendMessageAsync(msg)
+        return True
+
+
+    async def sendMessageAsync(self, msg):
+        ''' Send a message built by buildMessage without blocking the event
+        loop, using aiosmtplib. Unlike sendNotification every message opens
+        its own session. aiosmtplib is only needed for the asyncio delivery
+        engine, thus it's imported here. '''
+        import aiosmtplib
+
+        settings = self.settings
+        if settings['auth'] and not ('user' in settings and 'password' in settings):
+            raise MissingAttributeError('No user/password supplied')
+
+        wait = SMTP_POOL.reserve(settings)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+        slot = SMTP_POOL.asyncSlot(settings)
+        if slot is not None:
+            try:
+                await asyncio.wait_for(slot.acquire(), SMTP_POOL.maxWait)
+            except asyncio.TimeoutError:
+                raise BusyError('Too many connections to {}:{}'.format(
+                    *SMTP_POOL.serverKey(settings)))
+
+        try:
+            await aiosmtplib.send(messageBytes(msg), sender=settings['fromAddr'],
+                    recipients=settings['toAddr'], hostname=settings['server'],
+                    port=settings['port'],
+                    use_tls=bool(settings['ssl'] and not settings['starttls']),
+                    start_tls=bool(settings['starttls']),
+                    username=settings['user'] if settings['auth'] else None,
+                    password=settings['password'] if settings['auth'] else None,
+                    timeout=self.timeout)
         finally:
-            if s is not None:
-                s.quit()
+            if slot is not None:
+                slot.release()
@@ -0,0 +1,161 @@
+from ayeaye.search import createSearchIndex
+from calendar import timegm
+from datetime import datetime
+from logging import getLogger
+from threading import Lock
+
+
+LOGGER = getLogger('partition')
+
+INTERVALS = ['none', 'day', 'week', 'month']
+# Holds the notifications archived without partitioning, it is queried like
+# a partition without bounds.
+ARCHIVE_TABLE = 'notification_archive'
+
+
+class ArchivePartitions(object):
+    ''' Splits the notification archive into one table per day, week or
+    month, e.g. notification_archive_20240101.
+
+    Partitions are created when the first notification of their time range
+    is archived and are listed in notification_archive_partition, thus
+    history queries only read the partitions overlapping the requested
+    range and the retention purge drops whole partitions instead of
+    deleting their rows. With the interval none notifications are archived
+    in the notification_archive table, which is always queried as well.
+    '''
+
+    def __init__(self, interval='none'):
+        self.interval = interval
+        self._created = set()
+        self._lock = Lock()
+
+
+    def configure(self, interval):
+        ''' Set the interval, forgetting the partitions created so far. '''
+        with self._lock:
+            self.interval = interval
+            self._created = set()
+
+
+    def reset(self):
+        ''' Forget the partitions created so far, e.g. since a transaction
+        that created one was rolled back or partitions were dropped. '''
+        with self._lock:
+            self._created = set()
+
+
+    def bounds(self, t):
+        ''' The start and end (exclusive) of the partition of time t. '''
+        day = int(t) - int(t) % 86400
+        if self.interval == 'day':
+            return (day, day + 86400)
+        if self.interval == 'week':
+            # Weeks start on Monday, the epoch was a Thursday.
+            start = day - ((day // 86400 + 3) % 7) * 86400
+            return (start, start + 7 * 86400)
+        if self.interval == 'month':
+            d = datetime.utcfromtimestamp(day)
+            nextMonth = datetime(d.year + d.month // 12, d.month % 12 + 1, 1)
+            return (timegm(d.replace(day=1).timetuple()), timegm(nextMonth.timetuple()))
+        raise ValueError('Invalid partition interval: {}'.format(self.interval))
+
+
+    def split(self, cur, rows):
+        ''' Group rows of (time, ...) by the table they're archived in, the
+        partitions are created as needed. Returns a list of (table, rows). '''
+        if self.interval in [None, 'none']:
+            return [(ARCHIVE_TABLE, rows)]
+
+        tables = {}
+        for row in rows:
+            (start, end) = self.bounds(row[0])
+            table = '{}_{}'.format(ARCHIVE_TABLE,
+                    datetime.utcfromtimestamp(start).strftime('%Y%m%d'))
+            if table not in tables:
+                self._create(cur, table, start, end)
+                tables[table] = []
+            tables[table].append(row)
+        return list(tables.items())
+
+
+    def _create(self, cur, table, start, end):
+        with self._lock:
+            if table in self._created:
+                return
+        LOGGER.info('Creating archive partition {}'.format(table))
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS {0} (
+              id INTEGER PRIMARY KEY,
+              time INTEGER,
+              send_failed BOOLEAN,
+              topic VARCHAR(32),
+              title VARCHAR(1024),
+              content TEXT,
+              content_format INTEGER DEFAULT 0,
+              content_dict INTEGER
+            )'''.format(table))
+        cur.execute('CREATE INDEX IF NOT EXISTS {0}_topic_time ON {0} (topic, time)'.format(table))
+        cur.execute('CREATE INDEX IF NOT EXISTS {0}_time ON {0} (time)'.format(table))
+        createSearchIndex(cur, table)
+        cur.execute('''
+            INSERT OR IGNORE INTO notification_archive_partition (name, start, end)
+                VALUES (?, ?, ?)
+            ''', (table, start, end, ))
+        with self._lock:
+            self._created.add(table)
+
+
+    @staticmethod
+    def tables(db, fromTime=None, toTime=None):
+        ''' The archive tables that may hold notifications from fromTime to
+        toTime (inclusive), oldest first. '''
+        conditions = []
+        params = []
+        if fromTime is not None:
+            conditions.append('end > ?')
+            params.append(fromTime)
+        if toTime is not None:
+            conditions.append('start <= ?')
+            params.append(toTime)
+
+        qry = 'SELECT name FROM notification_archive_partition'
+        if len(conditions) > 0:
+            qry += ' WHERE ' + ' AND '.join(conditions)
+        qry += ' ORDER BY start'
+
+        cur = db.cursor()
+        try:
+            cur.execute(qry, params)
+            return [ARCHIVE_TABLE] + [row[0] for row in cur.fetchall()]
+        finally:
+            cur.close()
+
+
+    @staticmethod
+    def allTables(db):
+        ''' All archive tables, unlike tables() also of databases that were
+        never partitioned and lack notification_archive_partition, as
+        migrations see them. '''
+        tables = [ARCHIVE_TABLE]
+        if db.execute('''
+                SELECT count(*) FROM sqlite_master
+                    WHERE type = 'table' AND name = 'notification_archive_partition'
+                ''').fetchone()[0]:
+            tables.extend([r[0] for r in db.execute('SELECT name FROM notification_archive_partition')])
+        return tables
+
+
+    @staticmethod
+    def expired(db, cutoff):
+        ''' The partitions only holding notifications up to cutoff. '''
+        cur = db.cursor()
+        try:
+            cur.execute('SELECT name FROM notification_archive_partition WHERE end <= ?',
+                    (cutoff + 1, ))
+            return [row[0] for row in cur.fetchall()]
+        finally:
+            cur.close()
+
+
+ARCHIVE_PARTITIONS = ArchivePartitions()
@@ -0,0 +1,289 @@
+from ayeaye.attachments import AttachmentStore
+from ayeaye.compress import CONTENT_COMPRESSOR, FORMAT_TEXT
+from ayeaye.partition import ArchivePartitions, ARCHIVE_PARTITIONS
+from ayeaye.search import unindexContents
+import json
+from logging import getLogger
+import os
+import sqlite3
+from time import sleep
+
+
+LOGGER = getLogger('purge')
+
+# Delivered or finally failed notifications of the delivery queue.
+DONE_STATES = ('sent', 'failed')
+
+
+class PurgeService(object):
+    ''' Removes archived and delivered notifications older than a retention
+    period, together with attachment files nothing refers to anymore.
+
+    Rows are deleted in batches of batchSize, each in its own short
+    transaction selected by the time index, with pause seconds in between.
+    Thus the API only ever waits for one batch instead of the whole purge.
+    Partitions of the archive that only hold expired notifications are
+    dropped as a whole.
+    Freed pages are returned to the file system by an incremental vacuum,
+    which requires a database with auto_vacuum = INCREMENTAL.
+    '''
+
+    def __init__(self, database, attachmentsDir=None, batchSize=1000, pause=0.05):
+        self.db = database
+        self.attachmentsDir = attachmentsDir
+        self.batchSize = batchSize
+        self.pause = pause # In seconds
+
+
+    def cutoff(self, retentionPeriod):
+        ''' The epoch time of now modified by retentionPeriod, e.g. -30 days,
+        see https://www.sqlite.org/lang_datefunc.html for valid periods. '''
+        cutoff = self.db.execute("SELECT CAST(strftime('%s', 'now', ?) AS INTEGER)",
+                (retentionPeriod, )).fetchone()[0]
+        if cutoff is None:
+            raise ValueError('Invalid retention period: {}'.format(retentionPeriod))
+        return cutoff
+
+
+    def purge(self, cutoff):
+        ''' Purge everything up to the epoch time cutoff, returns the number
+        of removed rows per table and of removed attachment files. '''
+        counts = {}
+        counts['partitions'] = self._dropPartitions(cutoff)
+        counts['notification_archive'] = 0
+        for table in ArchivePartitions.tables(self.db, toTime=cutoff):
+            counts['notification_archive'] += self._purgeArchive(table, cutoff)
+        counts['notification_attachment'] = self._deleteBatches('''
+            DELETE FROM notification_attachment WHERE id IN
+                (SELECT id FROM notification_attachment WHERE time <= ? ORDER BY time LIMIT ?)
+            ''', cutoff)
+        counts['notification_queue'] = self._purgeQueue(cutoff)
+        counts['attachments'] = self.purgeAttachments(cutoff)
+        return counts
+
+
+    def _dropPartitions(self, cutoff):
+        partitions = ArchivePartitions.expired(self.db, cutoff)
+        for table in partitions:
+            LOGGER.info('Dropping archive partition {}'.format(table))
+            cur = self.db.cursor()
+            try:
+                cur.execute('DELETE FROM notification_archive_partition WHERE name = ?',
+                        (table, ))
+                cur.execute('DROP TABLE IF EXISTS {}'.format(table))
+                cur.execute('DROP TABLE IF EXISTS {}_fts'.format(table))
+                self.db.commit()
+            except:
+                self.db.rollback()
+                raise
+            finally:
+                cur.close()
+            ARCHIVE_PARTITIONS.reset()
+            sleep(self.pause)
+        return len(partitions)
+
+
+    def _deleteBatches(self, qry, cutoff):
+        total = 0
+        while True:
+            cur = self.db.cursor()
+            try:
+                cur.execute(qry, (cutoff, self.batchSize, ))
+                deleted = cur.rowcount
+                self.db.commit()
+            except:
+                self.db.rollback()
+                raise
+            finally:
+                cur.close()
+
+            total += deleted
+            if deleted < self.batchSize:
+                return total
+            sleep(self.pause)
+
+
+    def _purgeArchive(self, table, cutoff):
+        total = 0
+        while True:
+            cur = self.db.cursor()
+            try:
+                cur.execute('''
+                    SELECT id, title, content, content_format, content_dict FROM {}
+                        WHERE time <= ? ORDER BY time LIMIT ?
+                    '''.format(table), (cutoff, self.batchSize, ))
+                rows = cur.fetchall()
+                # The trigger only removes text contents from the search index.
+                self._unindexCompressed(cur, table, rows)
+                cur.executemany('DELETE FROM {} WHERE id = ?'.format(table),
+                        [(row[0], ) for row in rows])
+                self.db.commit()
+            except:
+                self.db.rollback()
+                raise
+            finally:
+                cur.close()
+
+            total += len(rows)
+            if len(rows) < self.batchSize:
+                return total
+            sleep(self.pause)
+
+
+    def _unindexCompressed(self, cur, table, rows):
+        indexed = []
+        for (rowId, title, content, contentFormat, dictionaryId) in rows:
+            if contentFormat in [None, FORMAT_TEXT]:
+                continue
+            try:
+                indexed.append((rowId, title, CONTENT_COMPRESSOR.decompress(self.db, content,
+                    contentFormat, dictionaryId)))
+            except ValueError as e:
+                LOGGER.warning('Failed to remove {} of {} from the search index: {}'.format(
+                    rowId, table, str(e)))
+        unindexContents(cur, table, indexed)
+
+
+    def _purgeQueue(self, cutoff):
+        total = 0
+        while True:
+            cur = self.db.cursor()
+            try:
+                cur.execute('''
+                    SELECT id FROM notification_queue
+                        WHERE state IN (?, ?) AND time <= ? ORDER BY id LIMIT ?
+                    ''', DONE_STATES + (cutoff, self.batchSize, ))
+                ids = [(row[0], ) for row in cur.fetchall()]
+                cur.executemany('DELETE FROM notification_attempt WHERE queue_id = ?', ids)
+                cur.executemany('DELETE FROM notification_queue WHERE id = ?', ids)
+                self.db.commit()
+            except:
+                self.db.rollback()
+                raise
+            finally:
+                cur.close()
+
+            total += len(ids)
+            if len(ids) < self.batchSize:
+                return total
+            sleep(self.pause)
+
+
+    def purgeAttachments(self, cutoff):
+        ''' Remove the stored attachments last written before cutoff that are
+        neither archived nor referenced by a notification waiting for its
+        delivery or digest. Leftovers of interrupted writes are removed too,
+        as are the files last written before cutoff in the per-topic
+        directories attachments were archived in before the store. '''
+        if self.attachmentsDir is None:
+            return 0
+
+        store = AttachmentStore(self.attachmentsDir)
+        live = self._liveDigests()
+        removed = 0
+        for (dirPath, dirNames, fileNames) in os.walk(store.objectsDir):
+            for digest in fileNames:
+                path = os.path.join(dirPath, digest)
+                try:
+                    if os.stat(path).st_mtime > cutoff or digest in live \
+                            or self._isArchived(digest):
+                        continue
+                    os.unlink(path)
+                    removed += 1
+                except FileNotFoundError:
+                    continue
+
+        if os.path.isdir(store.tmpDir):
+            for name in os.listdir(store.tmpDir):
+                path = os.path.join(store.tmpDir, name)
+                try:
+                    if os.stat(path).st_mtime <= cutoff:
+                        os.unlink(path)
+                except FileNotFoundError:
+                    continue
+
+        for name in os.listdir(self.attachmentsDir):
+            path = os.path.join(self.attachmentsDir, name)
+            if path not in [store.objectsDir, store.tmpDir] and os.path.isdir(path):
+                removed += self._purgeTopicDir(path, cutoff)
+
+        return removed
+
+
+    @staticmethod
+    def _purgeTopicDir(topicDir, cutoff):
+        ''' Remove the files of a topic directory of the attachment archive
+        before the store, and the directory once it's empty. Nothing refers
+        to these files. '''
+        removed = 0
+        for name in os.listdir(topicDir):
+            path = os.path.join(topicDir, name)
+            try:
+                if os.path.isfile(path) and os.stat(path).st_mtime <= cutoff:
+                    os.unlink(path)
+                    removed += 1
+            except FileNotFoundError:
+                continue
+
+        try:
+            os.rmdir(topicDir)
+        except OSError:
+            # Not empty.
+            pass
+        return removed
+
+
+    def _isArchived(self, digest):
+        cur = self.db.cursor()
+        try:
+            cur.execute('SELECT 1 FROM notification_attachment WHERE sha256 = ? LIMIT 1',
+                    (digest, ))
+            return cur.fetchone() is not None
+        finally:
+            cur.close()
+
+
+    def _liveDigests(self):
+        ''' The attachments queued or buffered notifications refer to. '''
+        digests = set()
+        cur = self.db.cursor()
+        try:
+            cur.execute('''
+                SELECT notification FROM notification_queue WHERE state NOT IN (?, ?)
+                UNION ALL
+                SELECT notification FROM notification_digest
+                ''', DONE_STATES)
+            for row in cur:
+                for attachment in json.loads(row[0]).get('attachments', []):
+                    if 'sha256' in attachment:
+                        digests.add(attachment['sha256'])
+        finally:
+            cur.close()
+        return digests
+
+
+    def vacuum(self, pages=1000):
+        ''' Return the free pages of the database to the file system, pages
+        at a time. Returns the number of freed pages, or None if the database
+        doesn't use incremental auto_vacuum. '''
+        if self.db.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            LOGGER.warning('The database does not use auto_vacuum = INCREMENTAL, '
+                    'see ayeaye-purge --vacuum')
+            return None
+
+        freed = 0
+        while True:
+            free = self.db.execute('PRAGMA freelist_count').fetchone()[0]
+            if free == 0:
+                return freed
+            # The pragma only frees pages while its result is stepped through.
+            self.db.execute('PRAGMA incremental_vacuum({})'.format(int(pages))).fetchall()
+            freed += min(free, pages)
+            sleep(self.pause)
+
+
+    def enableIncrementalVacuum(self):
+        ''' Switch the database to auto_vacuum = INCREMENTAL, which requires a
+        full VACUUM that locks the database while it rewrites the file. '''
+        self.db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        self.db.execute('VACUUM')
@@ -0,0 +1,31 @@
+from threading import Lock
+from time import monotonic
+
+
+class TokenBucket(object):
+    ''' Allows rate events per second on average and bursts of up to burst
+    events. Callers reserve a token and wait until it becomes valid, thus
+    concurrent callers are spread out instead of being rejected. '''
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate # Per second
+        self.burst = burst
+        self._tokens = burst
+        self._updated = monotonic()
+        self._lock = Lock()
+
+
+    def reserve(self, maxWait=None):
+        ''' Take a token and return the seconds to wait before using it. If
+        that would take longer than maxWait seconds no token is taken and
+        None is returned. '''
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+            wait = max(0, (1 - self._tokens) / self.rate)
+            if maxWait is not None and wait > maxWait:
+                return None
+            self._tokens -= 1
+            return wait
@@ -1,3 +1,7 @@
+-- Only takes effect for new databases, existing ones are switched by
+-- ayeaye-purge --vacuum. Lets ayeaye-purge return freed pages incrementally.
+PRAGMA auto_vacuum = INCREMENTAL;
+
 CREATE TABLE IF NOT EXISTS handler_type (
   id INTEGER PRIMARY KEY,
   name VARCHAR(128) UNIQUE
@@ -24,9 +28,189 @@ CREATE TABLE IF NOT EXISTS notification_archive (
   send_failed BOOLEAN,
   topic VARCHAR(32),
   title VARCHAR(1024),
-  content TEXT
+  -- Stored as text or compressed, see content_format and ayeaye/compress.py.
+  content TEXT,
+  content_format INTEGER DEFAULT 0,
+  content_dict INTEGER
+);
+
+CREATE INDEX IF NOT EXISTS notification_archive_topic_time
+  ON notification_archive (topic, time);
+
+CREATE INDEX IF NOT EXISTS notification_archive_time
+  ON notification_archive (time);
+
+CREATE TABLE IF NOT EXISTS notification_queue (
+  id INTEGER PRIMARY KEY,
+  time INTEGER,
+  topic VARCHAR(32),
+  notification TEXT,
+  state VARCHAR(16) DEFAULT 'pending',
+  claimed INTEGER,
+  attempts INTEGER DEFAULT 0,
+  next_attempt INTEGER DEFAULT 0
 );
 
+CREATE INDEX IF NOT EXISTS notification_queue_state_next_attempt
+  ON notification_queue (state, next_attempt);
+
+CREATE TABLE IF NOT EXISTS notification_attempt (
+  id INTEGER PRIMARY KEY,
+  queue_id INTEGER,
+  time INTEGER,
+  error TEXT,
+  FOREIGN KEY(queue_id) REFERENCES notification_queue(id)
+);
+
+CREATE INDEX IF NOT EXISTS notification_attempt_queue_id
+  ON notification_attempt (queue_id);
+
+-- Archived attachments are stored once per content in the AttachmentStore,
+-- this maps them to the notifications they were sent with.
+CREATE TABLE IF NOT EXISTS notification_attachment (
+  id INTEGER PRIMARY KEY,
+  time INTEGER,
+  topic VARCHAR(32),
+  filename VARCHAR(255),
+  sha256 CHAR(64),
+  size INTEGER
+);
+
+CREATE INDEX IF NOT EXISTS notification_attachment_topic_time
+  ON notification_attachment (topic, time);
+
+CREATE INDEX IF NOT EXISTS notification_attachment_sha256
+  ON notification_attachment (sha256);
+
+-- The purge deletes attachments by time.
+CREATE INDEX IF NOT EXISTS notification_attachment_time
+  ON notification_attachment (time);
+
+-- Dedup windows of topics with a dedupWindow, keyed by the hash of the
+-- notification. Expired windows are removed once their repeats got summarized,
+-- claimed is the time their summary was taken for sending.
+CREATE TABLE IF NOT EXISTS notification_dedup (
+  id INTEGER PRIMARY KEY,
+  topic VARCHAR(32),
+  hash CHAR(32),
+  first_time INTEGER,
+  last_time INTEGER,
+  expires INTEGER,
+  repeats INTEGER DEFAULT 0,
+  title VARCHAR(1024),
+  content TEXT,
+  claimed INTEGER DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS notification_dedup_topic_hash
+  ON notification_dedup (topic, hash, expires);
+
+CREATE INDEX IF NOT EXISTS notification_dedup_expires
+  ON notification_dedup (expires);
+
+-- Notifications buffered for the digest of topics with a digestInterval or
+-- digestSize, stored like queued ones. claimed is the time their digest was
+-- taken for sending, size the bytes of their attachments.
+CREATE TABLE IF NOT EXISTS notification_digest (
+  id INTEGER PRIMARY KEY,
+  time INTEGER,
+  topic VARCHAR(32),
+  notification TEXT,
+  claimed INTEGER DEFAULT 0,
+  size INTEGER DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS notification_digest_topic
+  ON notification_digest (topic, id);
+
+-- Full-text index of the archive, see ayeaye/search.py. Partitions of the
+-- archive get their own index when they're created.
+CREATE VIRTUAL TABLE IF NOT EXISTS notification_archive_fts
+  USING fts5(title, content, content='');
+
+CREATE TRIGGER IF NOT EXISTS notification_archive_fts_insert AFTER INSERT ON notification_archive
+  WHEN new.content_format = 0 BEGIN
+  INSERT INTO notification_archive_fts (rowid, title, content) VALUES (new.id, new.title, new.content);
+END;
+
+CREATE TRIGGER IF NOT EXISTS notification_archive_fts_delete AFTER DELETE ON notification_archive
+  WHEN old.content_format = 0 BEGIN
+  INSERT INTO notification_archive_fts (notification_archive_fts, rowid, title, content)
+    VALUES ('delete', old.id, old.title, old.content);
+END;
+
+-- Number of archived and of failed notifications per topic and hour, bucket
+-- is the start of the hour. Updated together with the archive.
+CREATE TABLE IF NOT EXISTS notification_stats (
+  topic VARCHAR(32),
+  bucket INTEGER,
+  count INTEGER DEFAULT 0,
+  failed INTEGER DEFAULT 0,
+  PRIMARY KEY (topic, bucket)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS notification_stats_bucket
+  ON notification_stats (bucket);
+
+-- The partitions of the archive, see --archivePartition. Each holds the
+-- notifications archived from start up to end (exclusive).
+CREATE TABLE IF NOT EXISTS notification_archive_partition (
+  name VARCHAR(64) PRIMARY KEY,
+  start INTEGER,
+  end INTEGER
+);
+
+-- The zlib dictionaries archived contents of a topic are compressed with,
+-- see --archiveCompression. Rows refer to them by content_dict, thus they're
+-- never changed.
+CREATE TABLE IF NOT EXISTS notification_dictionary (
+  id INTEGER PRIMARY KEY,
+  topic VARCHAR(32),
+  time INTEGER,
+  dictionary BLOB
+);
+
+-- Bumped on every change of handler or global settings, so that cached
+-- notification handlers can cheaply be checked for staleness. It starts at a
+-- random value to not mistake the version of one database for another.
+CREATE TABLE IF NOT EXISTS settings_version (
+  id INTEGER PRIMARY KEY CHECK (id = 1),
+  version INTEGER
+);
+
+INSERT OR IGNORE INTO settings_version (id, version)
+  VALUES (1, abs(random() % 1000000000000));
+
+CREATE TRIGGER IF NOT EXISTS handler_insert_version AFTER INSERT ON handler
+BEGIN
+  UPDATE settings_version SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS handler_update_version AFTER UPDATE ON handler
+BEGIN
+  UPDATE settings_version SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS handler_delete_version AFTER DELETE ON handler
+BEGIN
+  UPDATE settings_version SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS global_setting_insert_version AFTER INSERT ON global_setting
+BEGIN
+  UPDATE settings_version SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS global_setting_update_version AFTER UPDATE ON global_setting
+BEGIN
+  UPDATE settings_version SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS global_setting_delete_version AFTER DELETE ON global_setting
+BEGIN
+  UPDATE settings_version SET version = version + 1;
+END;
+
 INSERT OR IGNORE INTO handler_type (name) VALUES ('email');
 
 -- Should we keep track of what notifications were send when and by which handler?
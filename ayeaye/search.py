@@ -0,0 +1,59 @@
+def createSearchIndex(cur, table, backfill=False):
+    ''' Create the FTS5 index of the titles and contents of an archive table,
+    e.g. notification_archive_fts, with triggers keeping it in sync. The
+    index is contentless, i.e. it only holds the terms and has the ids of
+    the table as rowids, and a row is removed from it by its indexed text.
+    Compressed contents thus aren't handled by the triggers but indexed by
+    insertNotifications and removed by the purge. If backfill is set the
+    rows the table holds already are indexed too, they must be text. '''
+    cur.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS {0}_fts USING fts5(title, content, content='')
+        '''.format(table))
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS {0}_fts_insert AFTER INSERT ON {0}
+            WHEN new.content_format = 0 BEGIN
+          INSERT INTO {0}_fts (rowid, title, content) VALUES (new.id, new.title, new.content);
+        END'''.format(table))
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS {0}_fts_delete AFTER DELETE ON {0}
+            WHEN old.content_format = 0 BEGIN
+          INSERT INTO {0}_fts ({0}_fts, rowid, title, content)
+            VALUES ('delete', old.id, old.title, old.content);
+        END'''.format(table))
+    if backfill:
+        cur.execute('''
+            INSERT INTO {0}_fts (rowid, title, content)
+                SELECT id, title, content FROM {0}
+                    WHERE id NOT IN (SELECT rowid FROM {0}_fts)
+            '''.format(table))
+
+
+def indexContents(cur, table, rows):
+    ''' Index rows of (id, title, text) of an archive table, e.g. the text
+    of compressed contents. '''
+    cur.executemany('INSERT INTO {}_fts (rowid, title, content) VALUES (?, ?, ?)'.format(
+        table), rows)
+
+
+def unindexContents(cur, table, rows):
+    ''' Remove rows of (id, title, text) from the index of an archive table,
+    the text must be the indexed one. '''
+    cur.executemany('''
+        INSERT INTO {0}_fts ({0}_fts, rowid, title, content) VALUES ('delete', ?, ?, ?)
+        '''.format(table), rows)
+
+
+def migrateSearchIndex(db):
+    ''' Migration indexing the archive tables of an existing database. '''
+    # Imported here as the partitions create their search index.
+    from ayeaye.partition import ArchivePartitions
+
+    tables = ArchivePartitions.allTables(db)
+
+    cur = db.cursor()
+    try:
+        for table in tables:
+            createSearchIndex(cur, table, backfill=True)
+        db.commit()
+    finally:
+        cur.close()
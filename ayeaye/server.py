@@ -0,0 +1,53 @@
+from ayeaye.api import APP, runApi, startApi, stopApi
+from logging import getLogger
+
+
+LOGGER = getLogger('server')
+
+SERVERS = ['dev', 'gunicorn']
+
+
+def gunicornApplication(args):
+    ''' The API as gunicorn application.
+
+    gunicorn pre-forks args.processes worker processes, each serving
+    args.threads requests concurrently. Every worker starts its own database
+    pool, archive writer and delivery workers after it got forked and stops
+    them when it exits. Workers are recycled after about args.maxRequests
+    requests and are gracefully restarted on SIGHUP.
+
+    gunicorn is only needed for this server, thus it's imported here.
+    '''
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise RuntimeError('The gunicorn server requires gunicorn, pip install gunicorn')
+
+    class GunicornApplication(BaseApplication):
+
+        def load_config(self):
+            self.cfg.set('bind', '{}:{}'.format(args.listen, args.port))
+            self.cfg.set('workers', args.processes)
+            self.cfg.set('threads', args.threads)
+            self.cfg.set('max_requests', args.maxRequests)
+            # Keep the workers from all being recycled at the same time.
+            self.cfg.set('max_requests_jitter', args.maxRequests // 10)
+            self.cfg.set('timeout', args.timeout)
+            self.cfg.set('graceful_timeout', args.timeout)
+            self.cfg.set('post_fork', lambda server, worker: startApi(args))
+            self.cfg.set('worker_exit', lambda server, worker: stopApi())
+
+
+        def load(self):
+            return APP
+
+    return GunicornApplication()
+
+
+def runServer(args):
+    if args.server == 'gunicorn':
+        LOGGER.info('Starting gunicorn with {} processes of {} threads'.format(
+            args.processes, args.threads))
+        gunicornApplication(args).run()
+    else:
+        runApi(args)
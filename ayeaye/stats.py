@@ -0,0 +1,51 @@
+from ayeaye.partition import ArchivePartitions
+
+
+BUCKET_SIZE = 3600 # In seconds
+# Sizes of the intervals statistics are aggregated by, None for the whole range.
+INTERVALS = {'hour': 3600, 'day': 86400, 'total': None}
+
+
+def updateStats(cur, rows):
+    ''' Add rows of (time, topic, title, content, send_failed) to the hourly
+    counts of notification_stats. Committing is up to the caller, i.e. it's
+    done in the transaction archiving the rows. '''
+    buckets = {}
+    for row in rows:
+        key = (row[1], int(row[0]) - int(row[0]) % BUCKET_SIZE)
+        (count, failed) = buckets.get(key, (0, 0))
+        buckets[key] = (count + 1, failed + (1 if row[4] else 0))
+
+    cur.executemany('''
+        INSERT INTO notification_stats (topic, bucket, count, failed) VALUES (?, ?, ?, ?)
+            ON CONFLICT (topic, bucket) DO UPDATE SET
+                count = count + excluded.count, failed = failed + excluded.failed
+        ''', [k + v for (k, v) in buckets.items()])
+
+
+def migrateStats(db):
+    ''' Migration counting the notifications archived so far. '''
+    tables = ArchivePartitions.allTables(db)
+
+    cur = db.cursor()
+    try:
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS notification_stats (
+              topic VARCHAR(32),
+              bucket INTEGER,
+              count INTEGER DEFAULT 0,
+              failed INTEGER DEFAULT 0,
+              PRIMARY KEY (topic, bucket)
+            ) WITHOUT ROWID''')
+        for table in tables:
+            cur.execute('''
+                INSERT INTO notification_stats (topic, bucket, count, failed)
+                    SELECT topic, time - time % ?, COUNT(*),
+                            SUM(CASE WHEN send_failed THEN 1 ELSE 0 END)
+                        FROM {} WHERE true GROUP BY 1, 2
+                    ON CONFLICT (topic, bucket) DO UPDATE SET
+                        count = count + excluded.count, failed = failed + excluded.failed
+                '''.format(table), (BUCKET_SIZE, ))
+        db.commit()
+    finally:
+        cur.close()
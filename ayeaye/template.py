@@ -0,0 +1,99 @@
+from ayeaye.error import BadRequestError
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from string import Formatter
+
+
+COMMASPACE = ', '
+
+# The fields of a notification that templates may refer to.
+FIELDS = ['title', 'content']
+# Headers that are set from the notification and settings, not by templates.
+RESERVED_HEADERS = ['subject', 'from', 'to', 'content-type', 'content-transfer-encoding',
+        'mime-version']
+
+
+class Template(object):
+    ''' A subject or body template with {title} and {content} placeholders.
+    The template is parsed once, rendering only joins its literal text and
+    the fields of a notification. '''
+
+    def __init__(self, template):
+        if type(template) is not str:
+            raise BadRequestError('Templates must be strings')
+
+        self.parts = []
+        try:
+            for (literal, field, spec, conversion) in Formatter().parse(template):
+                if field is not None and (field not in FIELDS or spec or conversion):
+                    raise BadRequestError('Invalid placeholder {{{}}}, templates may only '
+                            'contain {{title}} and {{content}}'.format(field))
+                self.parts.append((literal, field))
+        except ValueError as e:
+            raise BadRequestError('Invalid template: {}'.format(str(e)))
+
+        # A template that is just a placeholder returns the field as is.
+        if len(self.parts) == 1 and self.parts[0][0] == '' and self.parts[0][1] is not None:
+            self.field = self.parts[0][1]
+        else:
+            self.field = None
+
+
+    def render(self, notification):
+        if self.field is not None:
+            return notification[self.field]
+
+        values = []
+        for (literal, field) in self.parts:
+            values.append(literal)
+            if field is not None:
+                values.append(notification[field])
+        return ''.join(values)
+
+
+class MessageTemplate(object):
+    ''' The parts of the messages of a handler that are the same for every
+    notification, compiled once when the handler is loaded.
+
+    Settings:
+        subjectTemplate: Template of the subject, defaults to {title}
+        bodyTemplate: Template of the body, defaults to {content}
+        headers: Map of further headers, e.g. Reply-To, added to every message
+    '''
+
+    def __init__(self, subject, body, headers):
+        self.subject = subject
+        self.body = body
+        self.headers = headers # List of (name, value)
+
+
+    @classmethod
+    def fromSettings(cls, settings):
+        headers = settings.get('headers', {})
+        if type(headers) is not dict or any([type(v) is not str for v in headers.values()]):
+            raise BadRequestError('Headers must be a map of strings')
+        for (name, value) in headers.items():
+            if name.lower() in RESERVED_HEADERS:
+                raise BadRequestError('Header {} can not be set'.format(name))
+            if '\n' in name or '\r' in name or '\n' in value or '\r' in value:
+                raise BadRequestError('Header {} contains a line break'.format(name))
+
+        fixed = []
+        if 'fromAddr' in settings:
+            fixed.append(('From', settings['fromAddr']))
+        if 'toAddr' in settings:
+            fixed.append(('To', COMMASPACE.join(settings['toAddr'])))
+        fixed.extend(headers.items())
+
+        return cls(Template(settings.get('subjectTemplate', '{title}')),
+                Template(settings.get('bodyTemplate', '{content}')), fixed)
+
+
+    def render(self, notification):
+        ''' A new message for the notification, without attachments. '''
+        msg = MIMEMultipart()
+        msg['Subject'] = self.subject.render(notification)
+        for (name, value) in self.headers:
+            msg[name] = value
+        msg.attach(MIMEText(self.body.render(notification)))
+        return msg
@@ -0,0 +1,119 @@
+from os import path, close, unlink
+from shutil import rmtree
+import sys
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+import ayeaye
+from ayeaye.aiodelivery import AsyncDeliveryService
+from ayeaye.appsvc import NotificationService
+import asyncio
+import json
+import sqlite3
+from tempfile import mkstemp, mkdtemp
+from time import sleep, time
+import unittest
+from unittest import mock
+
+try:
+    import aiosmtplib
+except ImportError:
+    aiosmtplib = None
+
+
+@unittest.skipIf(aiosmtplib is None, 'aiosmtplib is not installed')
+class AsyncDeliveryServiceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.databaseFd, self.databasePath = mkstemp(suffix='.test.db')
+        ayeaye.initializeDatabase(self.databasePath)
+        self.database = sqlite3.connect(self.databasePath)
+        self.database.row_factory = sqlite3.Row
+        self.fileArchivePath = mkdtemp()
+
+        # Nothing listens on port 1, thus every delivery fails right away.
+        settings = dict(server='127.0.0.1', port=1, toAddr=['TS@medicustek.com'],
+                fromAddr='test@medicustek.com', ssl=0, auth=0, starttls=0)
+        cur = self.database.cursor()
+        cur.execute('''
+            INSERT INTO handler (topic, handler_type, settings)
+            VALUES ('ts', (SELECT id FROM handler_type WHERE name = 'email'), ?)
+        ''', (json.dumps(settings), ))
+        self.database.commit()
+        cur.close()
+        self.ns = NotificationService('ts', self.database, self.fileArchivePath)
+
+
+    def tearDown(self):
+        self.database.close()
+        close(self.databaseFd)
+        unlink(self.databasePath)
+        rmtree(self.fileArchivePath)
+
+
+    def _waitForStates(self, state, count, timeout=10):
+        deadline = time() + timeout
+        while time() < deadline:
+            cur = self.database.cursor()
+            cur.execute('SELECT count(*) FROM notification_queue WHERE state = ?',
+                    (state, ))
+            current = cur.fetchone()[0]
+            cur.close()
+            if current == count:
+                return True
+            sleep(0.1)
+        return False
+
+
+    def testDeliverConcurrently(self):
+        for i in range(20):
+            self.ns.queueNotification(dict(title='Queued {}'.format(i), content='Test'))
+
+        inFlight = []
+        async def send(*args, **kwargs):
+            inFlight.append(1)
+            await asyncio.sleep(0.5)
+
+        ds = AsyncDeliveryService(self.databasePath, self.fileArchivePath, maxInFlight=10)
+        with mock.patch('aiosmtplib.send', side_effect=send) as sendmail:
+            start = time()
+            ds.start()
+            try:
+                ds.notify()
+                self.assertTrue(self._waitForStates('sent', 20))
+            finally:
+                ds.stop()
+
+        # Two rounds of ten concurrent sends instead of 20 sequential ones.
+        self.assertLess(time() - start, 5)
+        self.assertEqual(20, sendmail.call_count)
+        self.assertEqual('test@medicustek.com', sendmail.call_args[1]['sender'])
+
+        cur = self.database.cursor()
+        cur.execute('SELECT count(*) FROM notification_archive WHERE send_failed = 0')
+        self.assertEqual(20, cur.fetchone()[0])
+        cur.close()
+
+
+    def testFailedDelivery(self):
+        notificationId = self.ns.queueNotification(dict(title='Queued', content='Test'))
+
+        ds = AsyncDeliveryService(self.databasePath, self.fileArchivePath, maxAttempts=1)
+        ds.start()
+        try:
+            ds.notify()
+            self.assertTrue(self._waitForStates('failed', 1))
+        finally:
+            ds.stop()
+
+        cur = self.database.cursor()
+        cur.execute('SELECT error FROM notification_attempt WHERE queue_id = ?',
+                (notificationId, ))
+        self.assertEqual('INTERNAL_ERROR: Failed to send notification', cur.fetchone()[0])
+        cur.execute('SELECT send_failed FROM notification_archive')
+        self.assertTrue(cur.fetchone()[0])
+        cur.close()
+
+
+if __name__ == '__main__':
+    import xmlrunner
+    unittest.main(testRunner=xmlrunner.XMLTestRunner(output='test-reports'))
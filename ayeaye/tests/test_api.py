@@ -11,7 +11,12 @@ from shutil import rmtree
 from time import sleep
 from base64 import b64encode, b64decode
 import email
+from io import BytesIO
 import unittest
+from unittest import mock
+from ayeaye.archive import insertNotifications
+from ayeaye.attachments import AttachmentStore
+from ayeaye.mtemail import SMTP_POOL
 
 
 TEST_NOTIFICATION_FILE = './test_notifications/vagrant'
@@ -213,6 +218,130 @@ class ApiWithTestData(unittest.TestCase):
         self.assertEqual(4, len(data))
 
 
+    def testNotificationHistoryByCursor(self):
+        rv = self.app.get('/notifications/?after=&limit=3')
+        data = json.loads(rv.get_data().decode('utf-8'))
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual(['N4', 'N3', 'N2'], [n['title'] for n in data])
+
+        rv = self.app.get('/notifications/?limit=3&after=' + rv.headers['X-Next-After'])
+        data = json.loads(rv.get_data().decode('utf-8'))
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual(['N1'], [n['title'] for n in data])
+        self.assertNotIn('X-Next-After', rv.headers)
+
+        rv = self.app.get('/notifications/TS?after=&limit=1')
+        data = json.loads(rv.get_data().decode('utf-8'))
+        self.assertEqual(['N2'], [n['title'] for n in data])
+
+        rv = self.app.get('/notifications/TS?limit=1&after=' + rv.headers['X-Next-After'])
+        data = json.loads(rv.get_data().decode('utf-8'))
+        self.assertEqual(['N1'], [n['title'] for n in data])
+
+
+    def testNotificationHistoryByCursorAndTime(self):
+        rv = self.app.get('/notifications/?after=&limit=2&fromTime=12&toTime=22')
+        data = json.loads(rv.get_data().decode('utf-8'))
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual(['N3', 'N2'], [n['title'] for n in data])
+
+        rv = self.app.get('/notifications/?after=25,4&toTime=100')
+        data = json.loads(rv.get_data().decode('utf-8'))
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual(['N3', 'N2', 'N1'], [n['title'] for n in data])
+
+        rv = self.app.get('/notifications/?after=25,4&toTime=last')
+        self.assertEqual(400, rv.status_code)
+
+
+    def testNotificationHistoryStreamed(self):
+        rv = self.app.get('/notifications/', headers={'Accept': 'application/x-ndjson'})
+        lines = rv.get_data().decode('utf-8').splitlines()
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual('application/x-ndjson', rv.mimetype)
+        self.assertEqual(['N4', 'N3', 'N2', 'N1'], [json.loads(l)['title'] for l in lines])
+
+        rv = self.app.get('/notifications/?stream=true&fromTime=15')
+        data = json.loads(rv.get_data().decode('utf-8'))
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual('application/json', rv.mimetype)
+        self.assertEqual(3, len(data))
+
+        rv = self.app.get('/notifications/TS?stream=1')
+        data = json.loads(rv.get_data().decode('utf-8'))
+        self.assertEqual(2, len(data))
+
+        rv = self.app.get('/notifications/IRB?fromTime=30', headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual('', rv.get_data().decode('utf-8'))
+
+
+    def testNotificationHistoryByInvalidCursor(self):
+        rv = self.app.get('/notifications/?after=yesterday')
+        self.assertEqual(400, rv.status_code)
+
+
+    def testAttachmentReferencesAreRejected(self):
+        attachments = [{'filename': 'x', 'content': '', 'sha256': '../../../../../../etc/passwd'}]
+        APP.config['ATTACHMENTS_DIR'] = mkdtemp()
+        self.addCleanup(rmtree, APP.config['ATTACHMENTS_DIR'])
+        with mock.patch.object(SMTP_POOL, 'sendmail') as sendmail:
+            rv = self.app.post('/notifications/ts',
+                    data=json.dumps(dict(title='T', content='C', attachments=attachments)),
+                    content_type='application/json')
+            self.assertEqual(400, rv.status_code)
+
+            rv = self.app.post('/notifications/',
+                    data=json.dumps([dict(topic='ts', title='T', content='C',
+                        attachments=attachments)]),
+                    content_type='application/json')
+            data = json.loads(rv.get_data().decode('utf-8'))
+            self.assertEqual([400], [r['status'] for r in data])
+        self.assertEqual(0, sendmail.call_count)
+
+
+    def testNotificationStats(self):
+        # Archived like the archive writer does, counting them.
+        cur = self.database.cursor()
+        insertNotifications(cur, [(3610, 'ts', 'N5', 'C5', True),
+            (3620, 'irb', 'N6', 'C6', False), (7300, 'ts', 'N7', 'C7', False)])
+        self.database.commit()
+        cur.close()
+
+        rv = self.app.get('/notifications/stats?interval=total')
+        data = json.loads(rv.get_data().decode('utf-8'))
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual([{'topic': 'irb', 'count': 1, 'failed': 0},
+            {'topic': 'ts', 'count': 2, 'failed': 1}], data)
+
+        rv = self.app.get('/notifications/stats?topic=TS&fromTime=0&toTime=3600')
+        data = json.loads(rv.get_data().decode('utf-8'))
+        self.assertEqual([{'topic': 'ts', 'time': 3600, 'count': 1, 'failed': 1}], data)
+
+        rv = self.app.get('/notifications/stats?interval=minute')
+        self.assertEqual(400, rv.status_code)
+
+
+    def testSearchNotifications(self):
+        rv = self.app.get('/notifications/?q=N2%20OR%20N3%20OR%20C4&limit=2')
+        data = json.loads(rv.get_data().decode('utf-8'))
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual(2, len(data))
+        self.assertEqual('2', rv.headers['X-Next-Offset'])
+
+        rv = self.app.get('/notifications/?q=N2%20OR%20N3%20OR%20C4&limit=2&offset=2')
+        data = json.loads(rv.get_data().decode('utf-8'))
+        self.assertEqual(1, len(data))
+        self.assertNotIn('X-Next-Offset', rv.headers)
+
+        rv = self.app.get('/notifications/TS?q=N2%20OR%20N3')
+        data = json.loads(rv.get_data().decode('utf-8'))
+        self.assertEqual(['N2'], [n['title'] for n in data])
+
+        rv = self.app.get('/notifications/?q=%22N2')
+        self.assertEqual(400, rv.status_code)
+
+
 class ApiHandlersEmailTestCase(unittest.TestCase):
 
     def insertTestData(self):
@@ -489,6 +618,197 @@ class ApiSendNotificationTestCase(unittest.TestCase):
         self.assertTrue(notificationReceived(notification))
 
 
+class ApiQueueNotificationTestCase(unittest.TestCase):
+
+    def insertTestData(self):
+        handler = dict(
+                topic='ts',
+                settings=dict(
+                    server='127.0.0.1',
+                    port=2525,
+                    toAddr=['TS@medicustek.com'],
+                    fromAddr='test@medicustek.com',
+                    ssl=0,
+                    auth=0,
+                    starttls=0))
+
+        cur = self.database.cursor()
+        cur.execute('''
+            INSERT INTO handler (topic, handler_type, settings)
+            VALUES (?, (SELECT id FROM handler_type WHERE name = 'email'), ?)
+        ''', (handler['topic'], json.dumps(handler['settings']), ))
+        self.database.commit()
+        cur.close()
+
+
+    def setUp(self):
+        self.databaseFd, APP.config['DATABASE'] = mkstemp(suffix='test.db')
+        APP.config['ASYNC_DELIVERY'] = True
+        APP.config['ATTACHMENTS_DIR'] = mkdtemp()
+        APP.config['TESTING'] = True
+        self.app = APP.test_client()
+        with APP.app_context():
+            ayeaye.initializeDatabase(APP.config['DATABASE'])
+        self.database = sqlite3.connect(APP.config['DATABASE'])
+        self.insertTestData()
+
+
+    def tearDown(self):
+        APP.config['ASYNC_DELIVERY'] = False
+        self.database.close()
+        close(self.databaseFd)
+        unlink(APP.config['DATABASE'])
+        rmtree(APP.config['ATTACHMENTS_DIR'])
+
+
+    def testQueueUploadedNotification(self):
+        rv = self.app.post(
+                '/notifications/TS',
+                data={'title': 'Uploaded', 'content': 'Test 1 2 3',
+                      'attachments': (BytesIO(b'a,b,c'), 'f1.csv'),
+                      'backup': (BytesIO(b'd,e,f'), 'f2.csv')},
+                content_type='multipart/form-data')
+        data = json.loads(rv.get_data().decode('utf-8'))
+
+        self.assertEqual(202, rv.status_code)
+
+        cur = self.database.cursor()
+        cur.execute('SELECT notification FROM notification_queue WHERE id = ?',
+                (data['id'], ))
+        queued = json.loads(cur.fetchone()[0])
+        cur.close()
+
+        self.assertEqual('Uploaded', queued['title'])
+        self.assertEqual([('f1.csv', False), ('f2.csv', True)],
+                [(a['filename'], a['backup']) for a in queued['attachments']])
+        store = AttachmentStore(APP.config['ATTACHMENTS_DIR'])
+        with open(store.path(queued['attachments'][1]['sha256']), 'rb') as f:
+            self.assertEqual(b'd,e,f', f.read())
+
+
+    def testSendUploadedNotification(self):
+        APP.config['ASYNC_DELIVERY'] = False
+        with mock.patch.object(SMTP_POOL, 'sendmail') as sendmail:
+            rv = self.app.post(
+                    '/notifications/TS',
+                    data={'title': 'Uploaded', 'content': 'Test 1 2 3',
+                          'backup': (BytesIO(b'd,e,f'), 'f2.csv')},
+                    content_type='multipart/form-data')
+
+        self.assertEqual(200, rv.status_code)
+        msg = email.message_from_bytes(sendmail.call_args[0][1])
+        self.assertEqual('Uploaded', msg['Subject'])
+        self.assertEqual(b'd,e,f', msg.get_payload()[1].get_payload(decode=True))
+
+        cur = self.database.cursor()
+        cur.execute('SELECT topic, filename FROM notification_attachment')
+        self.assertEqual(('ts', 'f2.csv'), tuple(cur.fetchone()))
+        cur.close()
+
+
+    def testUploadMissingAttributes(self):
+        rv = self.app.post(
+                '/notifications/TS',
+                data={'title': 'Uploaded', 'attachments': (BytesIO(b'a,b,c'), 'f1.csv')},
+                content_type='multipart/form-data')
+
+        self.assertEqual(400, rv.status_code)
+
+
+    def testQueueNotification(self):
+        notification = dict(title='Queued', content='Test 1 2 3')
+        rv = self.app.post(
+                '/notifications/TS',
+                data=json.dumps(notification),
+                content_type='application/json')
+        data = json.loads(rv.get_data().decode('utf-8'))
+
+        self.assertEqual(202, rv.status_code)
+
+        cur = self.database.cursor()
+        cur.execute('SELECT topic, notification, state FROM notification_queue WHERE id = ?',
+                (data['id'], ))
+        topic, queued, state = cur.fetchone()
+        cur.close()
+
+        self.assertEqual('ts', topic)
+        self.assertEqual('pending', state)
+        self.assertEqual(notification, json.loads(queued))
+
+
+    def testGetQueuedNotification(self):
+        notification = dict(title='Queued', content='Test 1 2 3')
+        rv = self.app.post(
+                '/notifications/TS',
+                data=json.dumps(notification),
+                content_type='application/json')
+        notificationId = json.loads(rv.get_data().decode('utf-8'))['id']
+
+        rv = self.app.get('/notifications/queue/{}'.format(notificationId))
+        data = json.loads(rv.get_data().decode('utf-8'))
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual('pending', data['state'])
+        self.assertEqual(0, data['attempts'])
+        self.assertEqual([], data['history'])
+
+        rv = self.app.get('/notifications/queue/{}'.format(notificationId + 1))
+        self.assertEqual(404, rv.status_code)
+
+
+    def testQueueNotificationUnknownTopic(self):
+        notification = dict(title='Queued', content='Test 1 2 3')
+        rv = self.app.post(
+                '/notifications/unknown',
+                data=json.dumps(notification),
+                content_type='application/json')
+
+        self.assertEqual(404, rv.status_code)
+
+
+    def testQueueNotifications(self):
+        notifications = [
+                dict(topic='TS', title='First', content='Test 1 2 3'),
+                dict(topic='unknown', title='Second', content='Test 1 2 3'),
+                dict(topic='ts', title='Third'),
+                dict(topic='ts', title='Fourth', content='Test 1 2 3')]
+        rv = self.app.post(
+                '/notifications/',
+                data=json.dumps(notifications),
+                content_type='application/json')
+        data = json.loads(rv.get_data().decode('utf-8'))
+
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual([202, 404, 400, 202], [r['status'] for r in data])
+
+        cur = self.database.cursor()
+        cur.execute('SELECT id FROM notification_queue ORDER BY id')
+        self.assertEqual([data[0]['id'], data[3]['id']], [r[0] for r in cur.fetchall()])
+        cur.close()
+
+
+    def testQueueNotificationsNoList(self):
+        rv = self.app.post(
+                '/notifications/',
+                data=json.dumps(dict(topic='ts', title='First', content='Test')),
+                content_type='application/json')
+        self.assertEqual(400, rv.status_code)
+
+
+    def testQueueNotificationMissingAttributes(self):
+        notification = dict(title='Queued')
+        rv = self.app.post(
+                '/notifications/TS',
+                data=json.dumps(notification),
+                content_type='application/json')
+
+        self.assertEqual(400, rv.status_code)
+
+        cur = self.database.cursor()
+        cur.execute('SELECT count(*) FROM notification_queue')
+        self.assertEqual(0, cur.fetchone()[0])
+        cur.close()
+
+
 if __name__ == '__main__':
     import xmlrunner
     unittest.main(testRunner=xmlrunner.XMLTestRunner(output='test-reports'))
@@ -0,0 +1,105 @@
+from os import path, close, unlink
+import sys
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+import ayeaye
+from ayeaye.archive import ArchiveWriter
+import sqlite3
+from tempfile import mkstemp
+from threading import Event, Thread
+import unittest
+
+
+class ArchiveWriterTestCase(unittest.TestCase):
+
+    def connect(self):
+        return sqlite3.connect(self.databasePath, check_same_thread=False)
+
+
+    def setUp(self):
+        self.databaseFd, self.databasePath = mkstemp(suffix='.test.db')
+        ayeaye.initializeDatabase(self.databasePath)
+        self.database = sqlite3.connect(self.databasePath)
+
+
+    def tearDown(self):
+        self.database.close()
+        close(self.databaseFd)
+        unlink(self.databasePath)
+
+
+    def _count(self):
+        return self.database.execute('SELECT count(*) FROM notification_archive').fetchone()[0]
+
+
+    def testDurableSubmit(self):
+        writer = ArchiveWriter(self.connect, maxBatch=100, maxDelay=10)
+        writer.start()
+        try:
+            self.assertTrue(writer.submit([(10, 'ts', 'N1', 'C1', False)], durable=True))
+            self.assertEqual(1, self._count())
+        finally:
+            writer.stop()
+
+
+    def testDurableSubmitTimeout(self):
+        writer = ArchiveWriter(self.connect, maxBatch=100, maxDelay=0, timeout=0.1)
+        self.assertFalse(writer.submit([(10, 'ts', 'N1', 'C1', False)], durable=True))
+
+        commit = writer._commit
+        stuck = Event()
+        writer._commit = lambda db, batch: stuck.wait() or commit(db, batch)
+        writer.start()
+        try:
+            self.assertFalse(writer.submit([(10, 'ts', 'N1', 'C1', False)], durable=True))
+        finally:
+            stuck.set()
+            writer.stop()
+        self.assertFalse(writer.submit([(11, 'ts', 'N2', 'C2', False)]))
+
+
+    def testSubmitFromManyThreads(self):
+        writer = ArchiveWriter(self.connect, maxBatch=50, maxDelay=0.5)
+        commits = []
+        commit = writer._commit
+        writer._commit = lambda db, batch: commits.append(len(batch)) or commit(db, batch)
+        writer.start()
+
+        def submit(i):
+            for j in range(50):
+                writer.submit([(i, 'ts', 'N{}'.format(j), 'C', False)])
+
+        threads = [Thread(target=submit, args=(i, )) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        writer.stop()
+
+        self.assertEqual(200, self._count())
+        self.assertEqual(200, sum(commits))
+        self.assertTrue(len(commits) < 200)
+
+
+    def testStopCommitsPendingRows(self):
+        writer = ArchiveWriter(self.connect, maxBatch=100, maxDelay=10)
+        writer.start()
+        writer.submit([(10, 'ts', 'N1', 'C1', False), (11, 'ts', 'N2', 'C2', False)])
+        writer.stop()
+        self.assertEqual(2, self._count())
+
+
+    def testFailedCommit(self):
+        writer = ArchiveWriter(self.connect, maxBatch=100, maxDelay=0)
+        writer.start()
+        try:
+            self.database.execute('DROP TABLE notification_archive')
+            self.database.commit()
+            self.assertFalse(writer.submit([(10, 'ts', 'N1', 'C1', False)], durable=True))
+        finally:
+            writer.stop()
+
+
+if __name__ == '__main__':
+    import xmlrunner
+    unittest.main(testRunner=xmlrunner.XMLTestRunner(output='test-reports'))
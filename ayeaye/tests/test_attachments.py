@@ -0,0 +1,119 @@
+from os import path
+import sys
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+from ayeaye.attachments import Attachment, AttachmentStore, decodeBase64, loadAttachments, \
+        closeAttachments
+import mtemail
+from mtemail import EmailNotificationService
+from base64 import b64encode
+import email
+import unittest
+from unittest import mock
+
+
+class AttachmentTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.data = bytes(range(256)) * 100
+        self.content = b64encode(self.data).decode('utf-8')
+
+
+    def testDecodeBase64(self):
+        wrapped = '\n'.join([self.content[i:i + 76] for i in range(0, len(self.content), 76)])
+        self.assertEqual(self.data, b''.join(decodeBase64(self.content, chunkSize=1000)))
+        self.assertEqual(self.data, b''.join(decodeBase64(wrapped, chunkSize=1001)))
+
+
+    def testFromBase64(self):
+        attachment = Attachment.fromBase64(
+                {'filename': 'f1.bin', 'content': self.content, 'backup': True})
+
+        self.assertEqual('f1.bin', attachment.filename)
+        self.assertTrue(attachment.backup)
+        self.assertEqual(len(self.data), attachment.size)
+        self.assertEqual(self.data, b''.join(attachment.chunks()))
+        # Can be read as often as needed.
+        self.assertEqual(self.data, b''.join(attachment.chunks(size=1000)))
+        self.assertEqual(self.content, attachment.base64().replace('\n', ''))
+        attachment.close()
+
+
+    def testLargeAttachmentIsSpooled(self):
+        small = Attachment.fromBase64({'filename': 'f1.bin', 'content': self.content})
+        large = Attachment.fromBase64({'filename': 'f1.bin', 'content': self.content},
+                spoolSize=1024)
+
+        self.assertFalse(small.file._rolled)
+        self.assertTrue(large.file._rolled)
+        self.assertEqual(self.data, b''.join(large.chunks()))
+        small.close()
+        large.close()
+
+
+    def testFromInvalidBase64(self):
+        with self.assertRaises(ValueError):
+            Attachment.fromBase64({'filename': 'f1.bin', 'content': 'SSd'})
+
+
+    def testLoadAttachments(self):
+        notification = dict(title='Test', content='Test',
+                attachments=[{'filename': 'f1.bin', 'content': self.content},
+                             {'filename': 'f2.bin', 'content': 'SSdtIGEgdGVhcG90IQ=='}])
+        attachments = loadAttachments(notification)
+
+        self.assertEqual(attachments, notification['attachments'])
+        self.assertEqual(['f1.bin', 'f2.bin'], [a.filename for a in attachments])
+        self.assertEqual(b"I'm a teapot!", b''.join(attachments[1].chunks()))
+        # Loading them again doesn't decode them a second time.
+        self.assertEqual(attachments, loadAttachments(notification))
+        closeAttachments(notification)
+        self.assertTrue(attachments[0].file.closed)
+
+
+    def testStoreRejectsInvalidDigests(self):
+        store = AttachmentStore('/srv/ayeaye/attachments')
+        digest = 'a' * 64
+        self.assertEqual('/srv/ayeaye/attachments/objects/aa/aa/' + digest, store.path(digest))
+        for digest in ['../../../../../../etc/passwd', 'A' * 64, 'a' * 63, None]:
+            with self.assertRaises(ValueError):
+                store.path(digest)
+        with self.assertRaises(ValueError):
+            loadAttachments(dict(attachments=[{'filename': 'x', 'sha256': '../../etc/passwd'}]),
+                    store)
+
+
+    def testEmailWithAttachment(self):
+        settings = dict(server='127.0.0.1', port=2525, toAddr=['test@medicustek.com'],
+                fromAddr='norbert@medicustek.com', auth=False, ssl=False, starttls=False)
+        ens = EmailNotificationService(settings)
+        for attachment in [{'filename': 'f1.bin', 'content': self.content},
+                           Attachment.fromBase64({'filename': 'f1.bin', 'content': self.content})]:
+            with mock.patch.object(mtemail.SMTP_POOL, 'sendmail') as sendmail:
+                ens.sendNotification(dict(title='Test', content='Test',
+                    attachments=[attachment]))
+
+            msg = email.message_from_bytes(sendmail.call_args[0][1])
+            part = msg.get_payload()[1]
+            self.assertEqual('f1.bin', part.get_param('name'))
+            self.assertEqual(self.data, part.get_payload(decode=True))
+
+
+    def testEmailLineEndings(self):
+        settings = dict(server='127.0.0.1', port=2525, toAddr=['test@medicustek.com'],
+                fromAddr='norbert@medicustek.com', auth=False, ssl=False, starttls=False)
+        ens = EmailNotificationService(settings)
+        with mock.patch.object(mtemail.SMTP_POOL, 'sendmail') as sendmail:
+            ens.sendNotification(dict(title='Test', content='Line 1\nLine 2',
+                attachments=[Attachment.fromBase64({'filename': 'f1.bin', 'content': self.content})]))
+
+        data = sendmail.call_args[0][1]
+        self.assertIsInstance(data, bytes)
+        self.assertNotIn(b'\n', data.replace(b'\r\n', b''))
+        self.assertEqual(self.data, email.message_from_bytes(data).get_payload()[1]
+                .get_payload(decode=True))
+
+
+if __name__ == '__main__':
+    import xmlrunner
+    unittest.main(testRunner=xmlrunner.XMLTestRunner(output='test-reports'))
@@ -0,0 +1,353 @@
+from os import path, close, unlink
+from shutil import rmtree
+import sys
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+import ayeaye
+from ayeaye.appsvc import NotificationService, NotificationHandlerService, \
+        NotificationBatchService, HANDLER_CACHE
+from ayeaye.coalesce import CoalesceService, DedupService, DigestService, claimLease, \
+        notificationHash
+from ayeaye.delivery import DeliveryService
+from ayeaye.error import BadRequestError, InternalError
+from ayeaye.mtemail import SMTP_POOL
+import json
+import smtplib
+import sqlite3
+from tempfile import mkstemp, mkdtemp
+import unittest
+from unittest import mock
+
+SETTINGS = dict(server='127.0.0.1', port=2525, toAddr=['TS@medicustek.com'],
+        fromAddr='test@medicustek.com', ssl=0, auth=0, starttls=0)
+
+
+class CoalesceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.databaseFd, self.databasePath = mkstemp(suffix='.test.db')
+        ayeaye.initializeDatabase(self.databasePath)
+        self.database = sqlite3.connect(self.databasePath)
+        self.database.row_factory = sqlite3.Row
+        self.fileArchivePath = mkdtemp()
+        HANDLER_CACHE.invalidate()
+
+        nhs = NotificationHandlerService(self.database)
+        nhs.addEmailHandler({'topic': 'ts', 'settings': dict(SETTINGS, dedupWindow=60)})
+
+
+    def tearDown(self):
+        HANDLER_CACHE.invalidate()
+        self.database.close()
+        close(self.databaseFd)
+        unlink(self.databasePath)
+        rmtree(self.fileArchivePath)
+
+
+    def expire(self):
+        cur = self.database.cursor()
+        cur.execute('UPDATE notification_dedup SET expires = 0')
+        self.database.commit()
+        cur.close()
+
+
+    def archivedTitles(self):
+        cur = self.database.cursor()
+        cur.execute('SELECT title FROM notification_archive ORDER BY id')
+        titles = [row['title'] for row in cur.fetchall()]
+        cur.close()
+        return titles
+
+
+    def testNotificationHash(self):
+        notification = dict(title='Alarm', content='Bed 3')
+
+        self.assertEqual(32, len(notificationHash(notification)))
+        self.assertEqual(notificationHash(notification),
+                notificationHash(dict(title='Alarm', content='Bed 3', dedup=True)))
+        self.assertNotEqual(notificationHash(notification),
+                notificationHash(dict(title='Alarm', content='Bed 4')))
+        self.assertNotEqual(notificationHash(notification),
+                notificationHash(dict(notification, attachments=[
+                    {'filename': 'f1.log', 'content': 'SSdtIGEgdGVhcG90IQ=='}])))
+
+
+    def testTrack(self):
+        dedup = DedupService(self.database)
+        notification = dict(title='Alarm', content='Bed 3')
+
+        self.assertFalse(dedup.track('ts', 60, notification))
+        self.assertTrue(dedup.track('ts', 60, notification))
+        self.assertTrue(dedup.track('ts', 60, notification))
+        # Windows are per topic.
+        self.assertFalse(dedup.track('other', 60, notification))
+
+        self.expire()
+        self.assertFalse(dedup.track('ts', 60, notification))
+
+
+    def testExpired(self):
+        dedup = DedupService(self.database)
+        dedup.track('ts', 60, dict(title='Alarm', content='Bed 3'))
+        dedup.track('ts', 60, dict(title='Alarm', content='Bed 3'))
+        dedup.track('ts', 60, dict(title='Alarm', content='Bed 4'))
+        self.assertEqual([], dedup.expired())
+
+        self.expire()
+        windows = dedup.expired()
+
+        # Windows without repeats are only removed.
+        self.assertEqual(1, len(windows))
+        summary = DedupService.summary(windows[0])
+        self.assertEqual('Alarm (repeated 1 times)', summary['title'])
+        self.assertTrue(summary['content'].startswith('Bed 3'))
+        self.assertFalse(summary['dedup'])
+
+        # The window with repeats is claimed until its summary was sent.
+        self.assertEqual([], dedup.expired())
+        cur = self.database.cursor()
+        cur.execute('SELECT COUNT(*) FROM notification_dedup')
+        self.assertEqual(1, cur.fetchone()[0])
+        dedup.release(windows[0]['id'])
+        cur.execute('SELECT COUNT(*) FROM notification_dedup')
+        self.assertEqual(0, cur.fetchone()[0])
+        cur.close()
+
+
+    def testSendDuplicate(self):
+        ns = NotificationService('ts', self.database, self.fileArchivePath)
+        notification = dict(title='Alarm', content='Bed 3')
+        with mock.patch.object(SMTP_POOL, 'sendmail') as sendmail:
+            self.assertIsNone(ns.sendNotification(dict(notification)))
+            self.assertEqual({'duplicate': True}, ns.sendNotification(dict(notification)))
+            self.assertIsNone(ns.sendNotification(dict(notification, dedup=False)))
+
+        self.assertEqual(2, sendmail.call_count)
+        self.assertEqual(['Alarm', 'Alarm'], self.archivedTitles())
+
+
+    def testFailedSendOpensNoWindow(self):
+        ns = NotificationService('ts', self.database, self.fileArchivePath)
+        notification = dict(title='Alarm', content='Bed 3')
+        with mock.patch.object(SMTP_POOL, 'sendmail',
+                side_effect=[smtplib.SMTPDataError(554, b'Rejected'), {}]) as sendmail:
+            with self.assertRaises(InternalError):
+                ns.sendNotification(dict(notification))
+            # Retried by the client, it's sent instead of counted as repeat.
+            self.assertIsNone(ns.sendNotification(dict(notification)))
+
+        self.assertEqual(2, sendmail.call_count)
+        self.assertEqual(1, self.database.execute(
+            'SELECT COUNT(*) FROM notification_dedup').fetchone()[0])
+
+
+    def testInvalidAttachmentOpensNoWindow(self):
+        ns = NotificationService('ts', self.database, self.fileArchivePath)
+        notification = dict(title='Alarm', content='Bed 3',
+                attachments=[dict(filename='f1.log', content='not base64!')])
+        for i in range(2):
+            with self.assertRaises(BadRequestError):
+                ns.sendNotification(dict(notification))
+
+        self.assertEqual(0, self.database.execute(
+            'SELECT COUNT(*) FROM notification_dedup').fetchone()[0])
+
+
+    def testFailedDeliveryIsRetried(self):
+        ns = NotificationService('ts', self.database, self.fileArchivePath)
+        notificationId = ns.queueNotification(dict(title='Alarm', content='Bed 3'))
+        ds = DeliveryService(self.databasePath, self.fileArchivePath, maxAttempts=3)
+        with mock.patch.object(SMTP_POOL, 'sendmail',
+                side_effect=[smtplib.SMTPDataError(554, b'Rejected'), {}]) as sendmail:
+            ds._deliver(self.database, ds._claim(self.database))
+            self.assertEqual('pending', ns.aQueuedNotification(notificationId)['state'])
+
+            self.database.execute('UPDATE notification_queue SET next_attempt = 0')
+            self.database.commit()
+            ds._deliver(self.database, ds._claim(self.database))
+
+        self.assertEqual(2, sendmail.call_count)
+        self.assertEqual('sent', ns.aQueuedNotification(notificationId)['state'])
+        self.assertEqual(['Alarm'], self.archivedTitles())
+
+
+    def testSendNotificationsDuplicate(self):
+        bs = NotificationBatchService(self.database, self.fileArchivePath)
+        notification = dict(topic='ts', title='Alarm', content='Bed 3')
+        with mock.patch.object(SMTP_POOL, 'sendmail') as sendmail:
+            results = bs.sendNotifications([dict(notification), dict(notification)])
+
+        self.assertEqual(1, sendmail.call_count)
+        self.assertEqual([200, 200], [r['status'] for r in results])
+        self.assertTrue(results[1]['duplicate'])
+
+
+    def testFlush(self):
+        ns = NotificationService('ts', self.database, self.fileArchivePath)
+        coalesce = CoalesceService(None, self.fileArchivePath)
+        with mock.patch.object(SMTP_POOL, 'sendmail') as sendmail:
+            for i in range(3):
+                ns.sendNotification(dict(title='Alarm', content='Bed 3'))
+            coalesce.flush(self.database)
+            self.assertEqual(1, sendmail.call_count)
+
+            self.expire()
+            coalesce.flush(self.database)
+
+        self.assertEqual(2, sendmail.call_count)
+        self.assertEqual(['Alarm', 'Alarm (repeated 2 times)'], self.archivedTitles())
+
+
+    def testFailedSummaryIsKept(self):
+        ns = NotificationService('ts', self.database, self.fileArchivePath)
+        coalesce = CoalesceService(None, self.fileArchivePath)
+        with mock.patch.object(SMTP_POOL, 'sendmail',
+                side_effect=[{}, smtplib.SMTPDataError(554, b'Rejected'), {}]) as sendmail:
+            for i in range(3):
+                ns.sendNotification(dict(title='Alarm', content='Bed 3'))
+            self.expire()
+            coalesce.flush(self.database)
+            self.assertEqual(2, sendmail.call_count)
+
+            cur = self.database.cursor()
+            cur.execute('UPDATE notification_dedup SET claimed = 0')
+            self.database.commit()
+            cur.close()
+            coalesce.flush(self.database)
+
+        self.assertEqual(3, sendmail.call_count)
+        self.assertEqual('Alarm (repeated 2 times)', self.archivedTitles()[-1])
+        self.assertEqual(0, self.database.execute(
+            'SELECT COUNT(*) FROM notification_dedup').fetchone()[0])
+
+
+    def testInvalidSettings(self):
+        nhs = NotificationHandlerService(self.database)
+        for setting in ['dedupWindow', 'digestInterval', 'digestSize']:
+            for invalid in ['60', -1]:
+                with self.assertRaises(BadRequestError):
+                    nhs.addEmailHandler({'topic': 'ts', 'settings': dict(SETTINGS, **{setting: invalid})})
+
+
+    def testDigestCombine(self):
+        rows = [
+            {'time': 0, 'notification': json.dumps(dict(title='Up', content='Bed 3'))},
+            {'time': 60, 'notification': json.dumps(dict(title='Down', content='Bed 4',
+                attachments=[{'filename': 'f1.log', 'content': 'SSdtIGEgdGVhcG90IQ=='}]))},
+        ]
+        digest = DigestService.combine(rows)
+
+        self.assertEqual('Digest of 2 notifications', digest['title'])
+        self.assertEqual('[1970-01-01T00:00:00+00:00] Up\n\nBed 3\n\n\n'
+                '[1970-01-01T00:01:00+00:00] Down\n\nBed 4', digest['content'])
+        self.assertEqual(['f1.log'], [a['filename'] for a in digest['attachments']])
+        self.assertFalse(digest['digest'])
+
+
+    def testDigestBySize(self):
+        nhs = NotificationHandlerService(self.database)
+        nhs.addEmailHandler({'topic': 'status', 'settings': dict(SETTINGS, digestSize=3)})
+        ns = NotificationService('status', self.database, self.fileArchivePath)
+        coalesce = CoalesceService(None, self.fileArchivePath)
+
+        with mock.patch.object(SMTP_POOL, 'sendmail') as sendmail:
+            for i in range(7):
+                result = ns.sendNotification(dict(title='Status', content=str(i)))
+                self.assertEqual({'digest': True}, result)
+            coalesce.flush(self.database)
+
+        # Two full digests, the last notification waits for more.
+        self.assertEqual(2, sendmail.call_count)
+        self.assertEqual(['Digest of 3 notifications', 'Digest of 3 notifications'],
+                self.archivedTitles())
+        self.assertEqual([('status', 1)], [tuple(p[0:2]) for p in
+            DigestService(self.database).pending()])
+
+
+    def testDigestByInterval(self):
+        nhs = NotificationHandlerService(self.database)
+        nhs.addEmailHandler({'topic': 'status', 'settings': dict(SETTINGS, digestInterval=60)})
+        bs = NotificationBatchService(self.database, self.fileArchivePath)
+        coalesce = CoalesceService(None, self.fileArchivePath)
+
+        with mock.patch.object(SMTP_POOL, 'sendmail') as sendmail:
+            results = bs.sendNotifications([dict(topic='status', title='Status', content=str(i))
+                for i in range(5)])
+            self.assertEqual([{'status': 200, 'digest': True}] * 5, results)
+            coalesce.flush(self.database)
+            self.assertEqual(0, sendmail.call_count)
+
+            cur = self.database.cursor()
+            cur.execute('UPDATE notification_digest SET time = time - 60')
+            self.database.commit()
+            cur.close()
+            coalesce.flush(self.database)
+
+        self.assertEqual(1, sendmail.call_count)
+        self.assertEqual(['Digest of 5 notifications'], self.archivedTitles())
+        self.assertEqual([], DigestService(self.database).pending())
+
+
+    def testFailedDigestIsKept(self):
+        nhs = NotificationHandlerService(self.database)
+        nhs.addEmailHandler({'topic': 'status', 'settings': dict(SETTINGS, digestSize=3)})
+        ns = NotificationService('status', self.database, self.fileArchivePath)
+        coalesce = CoalesceService(None, self.fileArchivePath)
+
+        with mock.patch.object(SMTP_POOL, 'sendmail',
+                side_effect=[smtplib.SMTPDataError(554, b'Rejected'), {}]) as sendmail:
+            for i in range(3):
+                ns.sendNotification(dict(title='Status', content=str(i)))
+            coalesce.flush(self.database)
+            # Claimed until they're taken again.
+            self.assertEqual(1, sendmail.call_count)
+            self.assertEqual([], DigestService(self.database).pending())
+            self.assertEqual(3, self.database.execute(
+                'SELECT COUNT(*) FROM notification_digest').fetchone()[0])
+
+            cur = self.database.cursor()
+            cur.execute('UPDATE notification_digest SET claimed = 0')
+            self.database.commit()
+            cur.close()
+            coalesce.flush(self.database)
+
+        self.assertEqual(2, sendmail.call_count)
+        self.assertEqual(0, self.database.execute(
+            'SELECT COUNT(*) FROM notification_digest').fetchone()[0])
+
+
+    def testClaimOutlastsSending(self):
+        # Waiting for the rate limit and two sessions, with every command timing out.
+        with mock.patch.object(SMTP_POOL, 'maxWait', 30):
+            self.assertGreater(claimLease(), 3 * 30 + 20 * 10)
+
+        digests = DigestService(self.database)
+        digests.buffer('status', dict(title='Status', content=''))
+        self.assertEqual(1, len(digests.take('status', 10)))
+        cur = self.database.cursor()
+        cur.execute('UPDATE notification_digest SET claimed = claimed - ?', (claimLease() - 5, ))
+        self.database.commit()
+        cur.close()
+        self.assertEqual([], digests.take('status', 10))
+
+
+    def testDigestAttachmentSize(self):
+        digests = DigestService(self.database)
+        for size in [10, 10, 30, 5]:
+            digests.buffer('status', dict(title='Status', content=''), size)
+
+        self.assertEqual([10, 10], [r['size'] for r in digests.take('status', 10, maxBytes=25)])
+        # A notification with more than maxBytes is taken on its own.
+        self.assertEqual([30], [r['size'] for r in digests.take('status', 10, maxBytes=25)])
+        rows = digests.take('status', 10, maxBytes=25)
+        self.assertEqual([5], [r['size'] for r in rows])
+        self.assertEqual([], digests.take('status', 10, maxBytes=25))
+
+        digests.remove(rows)
+        self.assertEqual(3, self.database.execute(
+            'SELECT COUNT(*) FROM notification_digest').fetchone()[0])
+
+
+if __name__ == '__main__':
+    import xmlrunner
+    unittest.main(testRunner=xmlrunner.XMLTestRunner(output='test-reports'))
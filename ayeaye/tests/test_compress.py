@@ -0,0 +1,236 @@
+from os import path, close, unlink
+import sys
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+import ayeaye
+from ayeaye.appsvc import NotificationService
+from ayeaye.archive import insertNotifications
+from ayeaye.compress import ContentCompressor, CONTENT_COMPRESSOR, DICTIONARY_SAMPLES, \
+        FORMAT_TEXT, FORMAT_ZLIB, trainDictionary
+from ayeaye.partition import ARCHIVE_PARTITIONS
+from ayeaye.purge import PurgeService
+import sqlite3
+from tempfile import mkstemp
+import unittest
+import zlib
+
+# 2024-01-01T00:00:00Z
+START = 1704067200
+
+
+def report(i):
+    ''' A lab report of about 1.5 KB, most of it is the same every time. '''
+    return 'Lab report {}\n\n'.format(i) + ''.join([
+        'Analyzer {}: status OK, temperature {} C, reagent level {} %\n'.format(
+            a, 20 + (i * a) % 7, 100 - i % 50) for a in range(24)])
+
+
+class ContentCompressorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.databaseFd, self.databasePath = mkstemp(suffix='.test.db')
+        ayeaye.initializeDatabase(self.databasePath)
+        self.database = sqlite3.connect(self.databasePath)
+        self.database.row_factory = sqlite3.Row
+        self.ns = NotificationService(database=self.database)
+        CONTENT_COMPRESSOR.configure('zlib')
+
+
+    def tearDown(self):
+        CONTENT_COMPRESSOR.configure('none')
+        ARCHIVE_PARTITIONS.configure('none')
+        self.database.close()
+        close(self.databaseFd)
+        unlink(self.databasePath)
+
+
+    def archive(self, rows):
+        cur = self.database.cursor()
+        insertNotifications(cur, rows)
+        self.database.commit()
+        cur.close()
+
+
+    def stored(self, table='notification_archive'):
+        return self.database.execute('''
+            SELECT title, content, content_format, content_dict FROM {} ORDER BY id
+            '''.format(table)).fetchall()
+
+
+    def testTrainDictionary(self):
+        samples = ['a\nb\nc\n', 'a\nb\nd\n', 'a\ne\n']
+        dictionary = trainDictionary(samples)
+        # The most common line last, preceded by the newest sample.
+        self.assertTrue(dictionary.endswith(b'a\nb\nc\nb\na\n'))
+        self.assertTrue(dictionary.startswith(b'a\ne\n'))
+        self.assertEqual(8, len(trainDictionary(samples, size=8)))
+
+
+    def testCompress(self):
+        self.archive([(START, 'lab', 'Report', report(0), False),
+            (START + 1, 'lab', 'Short', 'Analyzer 1 failed', True)])
+
+        stored = self.stored()
+        self.assertEqual(FORMAT_ZLIB, stored[0]['content_format'])
+        self.assertIsNone(stored[0]['content_dict'])
+        self.assertEqual(report(0), zlib.decompress(stored[0]['content']).decode('utf-8'))
+        self.assertEqual((FORMAT_TEXT, 'Analyzer 1 failed'),
+                (stored[1]['content_format'], stored[1]['content']))
+
+        self.assertEqual(['Analyzer 1 failed', report(0)],
+                [n['content'] for n in self.ns.aNotificationHistoryByTime(fromTime=START)])
+        self.assertEqual(['Report'], [n['title'] for n in
+            self.ns.searchNotifications('reagent')[0]])
+
+
+    def testDictionary(self):
+        # A topic's dictionary is trained once it has enough notifications.
+        for i in range(DICTIONARY_SAMPLES + 5):
+            self.archive([(START + i, 'lab', 'Report {}'.format(i), report(i), False)])
+
+        stored = self.stored()
+        self.assertEqual([None] * (DICTIONARY_SAMPLES + 1),
+                [r['content_dict'] for r in stored[:DICTIONARY_SAMPLES + 1]])
+        dictionaryId = stored[-1]['content_dict']
+        self.assertIsNotNone(dictionaryId)
+        self.assertEqual(1, self.database.execute('''
+            SELECT COUNT(*) FROM notification_dictionary WHERE topic = 'lab'
+            ''').fetchone()[0])
+        self.assertLess(len(stored[-1]['content']),
+                len(zlib.compress(report(DICTIONARY_SAMPLES + 4).encode('utf-8'))))
+
+        # Other processes read the dictionary from the database.
+        CONTENT_COMPRESSOR.reset()
+        history = self.ns.aNotificationHistoryByTime(fromTime=START)
+        self.assertEqual([report(i) for i in range(DICTIONARY_SAMPLES + 4, -1, -1)],
+                [n['content'] for n in history])
+        self.assertEqual(['Report {}'.format(DICTIONARY_SAMPLES + 4)], [n['title'] for n in
+            self.ns.searchNotifications('"Lab report {}"'.format(DICTIONARY_SAMPLES + 4))[0]])
+
+        # Later notifications use the stored dictionary instead of a new one.
+        compressor = ContentCompressor('zlib')
+        cur = self.database.cursor()
+        self.assertEqual(dictionaryId, compressor.compress(cur, 'lab', report(0))[2])
+        cur.close()
+
+
+    def testDatabaseSize(self):
+        # The search index must not keep the texts the archive compressed.
+        for i in range(0, 500, 50):
+            self.archive([(START + j, 'lab', 'Report {}'.format(j), report(j), False)
+                for j in range(i, i + 50)])
+
+        size = self.database.execute('PRAGMA page_count').fetchone()[0] * \
+                self.database.execute('PRAGMA page_size').fetchone()[0]
+        self.assertLess(size, sum([len(report(i)) for i in range(500)]))
+
+
+    def testReadTextRows(self):
+        CONTENT_COMPRESSOR.configure('none')
+        self.archive([(START, 'lab', 'Old', report(0), False)])
+        CONTENT_COMPRESSOR.configure('zlib')
+        self.archive([(START + 1, 'lab', 'New', report(1), False)])
+
+        self.assertEqual([FORMAT_TEXT, FORMAT_ZLIB], [r['content_format'] for r in self.stored()])
+        (page, after) = self.ns.aNotificationHistoryPage('lab')
+        self.assertEqual([report(1), report(0)], [n['content'] for n in page])
+        self.assertEqual([report(0), report(1)],
+                [n['content'] for n in self.ns.aNotificationHistoryByTopicAndTime('lab', START)])
+        self.assertEqual([report(1), report(0)],
+                [n['content'] for n in self.ns.aNotificationHistoryByTime(stream=True)])
+
+
+    def testPartitions(self):
+        ARCHIVE_PARTITIONS.configure('day')
+        self.archive([(START, 'lab', 'Report', report(0), False)])
+
+        self.assertEqual(FORMAT_ZLIB,
+                self.stored('notification_archive_20240101')[0]['content_format'])
+        self.assertEqual(['Report'], [n['title'] for n in
+            self.ns.searchNotifications('analyzer')[0]])
+
+        PurgeService(self.database, pause=0).purge(START + 86400)
+        self.assertEqual([], self.ns.searchNotifications('analyzer')[0])
+
+
+    def testPurge(self):
+        self.archive([(START, 'lab', 'Old report', report(0), False),
+            (START, 'lab', 'Old', 'Analyzer 1 failed', False),
+            (START + 86400, 'lab', 'New report', report(1), False)])
+        PurgeService(self.database, pause=0).purge(START)
+
+        self.assertEqual(['New report'], [n['title'] for n in
+            self.ns.searchNotifications('analyzer')[0]])
+        self.assertEqual(1, self.database.execute(
+            'SELECT COUNT(*) FROM notification_archive_fts').fetchone()[0])
+        # Rows are removed from the index by the text they were indexed with.
+        self.database.execute('''
+            INSERT INTO notification_archive_fts (notification_archive_fts) VALUES ('integrity-check')
+            ''')
+        self.assertEqual([], self.ns.searchNotifications('"Lab report 0"')[0])
+
+
+    def testMigration(self):
+        # An archive of schema version 4, without compression.
+        self.database.executescript('''
+            DROP TABLE notification_archive;
+            DROP TABLE notification_archive_fts;
+            DROP TABLE notification_dictionary;
+            CREATE TABLE notification_archive (
+              id INTEGER PRIMARY KEY,
+              time INTEGER,
+              send_failed BOOLEAN,
+              topic VARCHAR(32),
+              title VARCHAR(1024),
+              content TEXT
+            );
+            CREATE VIRTUAL TABLE notification_archive_fts USING fts5(title, content);
+            CREATE TRIGGER notification_archive_fts_insert AFTER INSERT ON notification_archive BEGIN
+              INSERT INTO notification_archive_fts (rowid, title, content)
+                VALUES (new.id, new.title, new.content);
+            END;
+            CREATE TRIGGER notification_archive_fts_delete AFTER DELETE ON notification_archive BEGIN
+              DELETE FROM notification_archive_fts WHERE rowid = old.id;
+            END;
+            INSERT INTO notification_archive (time, topic, title, content, send_failed)
+                VALUES (1704067200, 'lab', 'Old', 'Analyzer 1 failed', 0);
+            PRAGMA user_version = 4;
+            ''')
+
+        ayeaye.initializeDatabase(self.databasePath)
+        self.archive([(START + 1, 'lab', 'New', report(1), False)])
+
+        self.assertEqual([FORMAT_TEXT, FORMAT_ZLIB], [r['content_format'] for r in self.stored()])
+        self.assertEqual([report(1), 'Analyzer 1 failed'],
+                [n['content'] for n in self.ns.aNotificationHistoryByTime()])
+        self.assertEqual(['New', 'Old'], sorted([n['title'] for n in
+            self.ns.searchNotifications('analyzer')[0]]))
+        # The index no longer keeps a copy of the texts.
+        self.assertEqual([(None, None), (None, None)], [tuple(r) for r in self.database.execute(
+            'SELECT title, content FROM notification_archive_fts')])
+
+
+    def testSearchIndexMigration(self):
+        # An archive of schema version 6, whose index keeps a copy of the texts.
+        self.archive([(START, 'lab', 'Report', report(0), False),
+            (START + 1, 'lab', 'Short', 'Analyzer 1 failed', False)])
+        self.database.executescript('''
+            DROP TABLE notification_archive_fts;
+            CREATE VIRTUAL TABLE notification_archive_fts USING fts5(title, content);
+            INSERT INTO notification_archive_fts (rowid, title, content)
+                VALUES (2, 'Short', 'Analyzer 1 failed');
+            PRAGMA user_version = 6;
+            ''')
+
+        ayeaye.initializeDatabase(self.databasePath)
+        self.assertEqual(['Report', 'Short'], sorted([n['title'] for n in
+            self.ns.searchNotifications('analyzer')[0]]))
+        self.assertEqual(['Report'], [n['title'] for n in
+            self.ns.searchNotifications('reagent')[0]])
+        self.assertEqual([(None, None), (None, None)], [tuple(r) for r in self.database.execute(
+            'SELECT title, content FROM notification_archive_fts')])
+
+
+if __name__ == '__main__':
+    import xmlrunner
+    unittest.main(testRunner=xmlrunner.XMLTestRunner(output='test-reports'))
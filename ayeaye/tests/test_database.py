@@ -0,0 +1,74 @@
+from os import path, close, unlink
+import sys
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+import ayeaye
+from ayeaye.database import ConnectionPool
+from tempfile import mkstemp
+import unittest
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.databaseFd, self.databasePath = mkstemp(suffix='.test.db')
+        ayeaye.initializeDatabase(self.databasePath)
+        self.pool = ConnectionPool(self.databasePath, size=1, busyTimeout=1000,
+                cacheSize=-1024, mmapSize=1048576)
+
+
+    def tearDown(self):
+        self.pool.closeAll()
+        close(self.databaseFd)
+        unlink(self.databasePath)
+        for suffix in ['-wal', '-shm']:
+            if path.isfile(self.databasePath + suffix):
+                unlink(self.databasePath + suffix)
+
+
+    def testPragmas(self):
+        db = self.pool.acquire()
+        self.assertEqual('wal', db.execute('PRAGMA journal_mode').fetchone()[0])
+        # NORMAL
+        self.assertEqual(1, db.execute('PRAGMA synchronous').fetchone()[0])
+        self.assertEqual(1000, db.execute('PRAGMA busy_timeout').fetchone()[0])
+        self.assertEqual(-1024, db.execute('PRAGMA cache_size').fetchone()[0])
+        self.pool.release(db)
+
+
+    def testConnectionIsReused(self):
+        db = self.pool.acquire()
+        self.pool.release(db)
+        self.assertIs(db, self.pool.acquire())
+
+
+    def testPoolSizeIsLimited(self):
+        first = self.pool.acquire()
+        second = self.pool.acquire()
+        self.assertIsNot(first, second)
+        self.pool.release(first)
+        self.pool.release(second)
+
+        self.assertIs(first, self.pool.acquire())
+        self.assertIsNot(second, self.pool.acquire())
+
+
+    def testReleaseRollsBackOpenTransaction(self):
+        db = self.pool.acquire()
+        db.execute("INSERT INTO notification_archive (time, topic) VALUES (1, 'ts')")
+        self.assertTrue(db.in_transaction)
+        self.pool.release(db)
+
+        db = self.pool.acquire()
+        self.assertFalse(db.in_transaction)
+        self.assertEqual(0, db.execute('SELECT count(*) FROM notification_archive').fetchone()[0])
+        self.pool.release(db)
+
+
+    def testInvalidJournalMode(self):
+        self.assertRaises(ValueError, ConnectionPool, self.databasePath, journalMode='fast')
+
+
+if __name__ == '__main__':
+    import xmlrunner
+    unittest.main(testRunner=xmlrunner.XMLTestRunner(output='test-reports'))
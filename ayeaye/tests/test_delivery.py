@@ -0,0 +1,204 @@
+from os import path, close, unlink
+from shutil import rmtree
+import sys
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+import ayeaye
+from ayeaye.appsvc import NotificationService
+from ayeaye.attachments import Attachment
+from ayeaye.delivery import DeliveryService
+from ayeaye.error import InternalError
+from ayeaye.mtemail import SMTP_POOL
+from io import BytesIO
+import json
+import sqlite3
+from tempfile import mkstemp, mkdtemp
+from time import sleep, time
+import unittest
+from unittest import mock
+
+
+class DeliveryServiceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.databaseFd, self.databasePath = mkstemp(suffix='.test.db')
+        ayeaye.initializeDatabase(self.databasePath)
+        self.database = sqlite3.connect(self.databasePath)
+        self.database.row_factory = sqlite3.Row
+        self.fileArchivePath = mkdtemp()
+
+        # Nothing listens on port 1, thus every delivery fails right away.
+        settings = dict(server='127.0.0.1', port=1, toAddr=['TS@medicustek.com'],
+                fromAddr='test@medicustek.com', ssl=0, auth=0, starttls=0)
+        cur = self.database.cursor()
+        cur.execute('''
+            INSERT INTO handler (topic, handler_type, settings)
+            VALUES ('ts', (SELECT id FROM handler_type WHERE name = 'email'), ?)
+        ''', (json.dumps(settings), ))
+        self.database.commit()
+        cur.close()
+
+
+    def tearDown(self):
+        self.database.close()
+        close(self.databaseFd)
+        unlink(self.databasePath)
+        rmtree(self.fileArchivePath)
+
+
+    def _waitForState(self, notificationId, state, timeout=10):
+        deadline = time() + timeout
+        while time() < deadline:
+            cur = self.database.cursor()
+            cur.execute('SELECT state FROM notification_queue WHERE id = ?',
+                    (notificationId, ))
+            current = cur.fetchone()[0]
+            cur.close()
+            if current == state:
+                return True
+            sleep(0.1)
+        return False
+
+
+    def testDeliverQueuedNotification(self):
+        ns = NotificationService('ts', self.database, self.fileArchivePath)
+        notificationId = ns.queueNotification(dict(title='Queued', content='Test 1 2 3'))
+
+        ds = DeliveryService(self.databasePath, self.fileArchivePath, workers=1,
+                maxAttempts=1)
+        ds.start()
+        try:
+            ds.notify()
+            self.assertTrue(self._waitForState(notificationId, 'failed'))
+        finally:
+            ds.stop()
+
+        cur = self.database.cursor()
+        cur.execute('SELECT title, send_failed FROM notification_archive WHERE topic = ?',
+                ('ts', ))
+        row = cur.fetchone()
+        cur.close()
+
+        self.assertEqual('Queued', row['title'])
+        self.assertTrue(row['send_failed'])
+
+
+    def testDeliverUploadedAttachment(self):
+        ns = NotificationService('ts', self.database, self.fileArchivePath)
+        notificationId = ns.queueNotification(dict(title='Queued', content='Test 1 2 3',
+            attachments=[Attachment.fromFile('f1.csv', BytesIO(b'a,b,c'), backup=True)]))
+
+        cur = self.database.cursor()
+        cur.execute('SELECT notification FROM notification_queue WHERE id = ?',
+                (notificationId, ))
+        queued = json.loads(cur.fetchone()[0])
+        cur.close()
+        self.assertEqual(['filename', 'sha256', 'backup'],
+                list(queued['attachments'][0].keys()))
+
+        ds = DeliveryService(self.databasePath, self.fileArchivePath, workers=1)
+        with mock.patch.object(SMTP_POOL, 'sendmail') as sendmail:
+            ds.start()
+            try:
+                ds.notify()
+                self.assertTrue(self._waitForState(notificationId, 'sent'))
+            finally:
+                ds.stop()
+
+        self.assertTrue(b'YSxiLGM=' in sendmail.call_args[0][1])
+        cur = self.database.cursor()
+        cur.execute('SELECT filename, sha256 FROM notification_attachment')
+        row = cur.fetchone()
+        cur.close()
+        self.assertEqual(('f1.csv', queued['attachments'][0]['sha256']), tuple(row))
+
+
+    def testArchiveFailureIsNotRetried(self):
+        ns = NotificationService('ts', self.database, self.fileArchivePath)
+        notificationId = ns.queueNotification(dict(title='Queued', content='Test 1 2 3',
+            attachments=[Attachment.fromFile('f1.csv', BytesIO(b'a,b,c'), backup=True)]))
+
+        ds = DeliveryService(self.databasePath, self.fileArchivePath, workers=1,
+                maxAttempts=5, retryDelay=0)
+        with mock.patch.object(SMTP_POOL, 'sendmail') as sendmail, \
+                mock.patch('ayeaye.appsvc.AttachmentStore.putAttachment',
+                        side_effect=OSError('No space left on device')):
+            ds._deliver(self.database, ds._claim(self.database))
+
+        self.assertEqual(1, sendmail.call_count)
+        queued = ns.aQueuedNotification(notificationId)
+        self.assertEqual(('sent', 1), (queued['state'], queued['attempts']))
+        self.assertIsNone(ds._claim(self.database))
+        self.assertEqual(1, len(ns.aNotificationHistory()))
+
+
+    def testAttachmentsAreClosed(self):
+        ns = NotificationService('ts', self.database, self.fileArchivePath)
+        ns.queueNotification(dict(title='Queued', content='Test 1 2 3',
+            attachments=[Attachment.fromFile('f1.csv', BytesIO(b'a,b,c'), backup=True)]))
+
+        ds = DeliveryService(self.databasePath, self.fileArchivePath, workers=1)
+        with mock.patch.object(NotificationService, '_prepareNotification',
+                    side_effect=InternalError('No handler')), \
+                mock.patch.object(Attachment, 'close', autospec=True) as closeAttachment:
+            ds._deliver(self.database, ds._claim(self.database))
+
+        self.assertEqual(1, closeAttachment.call_count)
+
+
+    def testRetryFailedDelivery(self):
+        ns = NotificationService('ts', self.database, self.fileArchivePath)
+        notificationId = ns.queueNotification(dict(title='Queued', content='Test 1 2 3'))
+
+        ds = DeliveryService(self.databasePath, self.fileArchivePath, workers=1,
+                maxAttempts=2, retryDelay=60)
+        ds._deliver(self.database, ds._claim(self.database))
+
+        queued = ns.aQueuedNotification(notificationId)
+        self.assertEqual('pending', queued['state'])
+        self.assertEqual(1, queued['attempts'])
+        self.assertTrue(queued['next_attempt'] >= time() + 29)
+        self.assertEqual(1, len(queued['history']))
+        self.assertIsNotNone(queued['history'][0]['error'])
+        # Not due yet and not archived as long as it's retried.
+        self.assertIsNone(ds._claim(self.database))
+        self.assertEqual(0, len(ns.aNotificationHistory()))
+
+        cur = self.database.cursor()
+        cur.execute('UPDATE notification_queue SET next_attempt = 0')
+        self.database.commit()
+        cur.close()
+        ds._deliver(self.database, ds._claim(self.database))
+
+        queued = ns.aQueuedNotification(notificationId)
+        self.assertEqual('failed', queued['state'])
+        self.assertEqual(2, queued['attempts'])
+        self.assertEqual(2, len(queued['history']))
+        self.assertEqual(1, len(ns.aNotificationHistory()))
+
+
+    def testBackoff(self):
+        ds = DeliveryService(self.databasePath, retryDelay=10, retryMaxDelay=100)
+        for (attempts, delay) in [(1, 10), (2, 20), (3, 40), (4, 80), (5, 100), (10, 100)]:
+            backoff = ds.backoff(attempts)
+            self.assertTrue(delay / 2 <= backoff <= delay)
+
+
+    def testClaimSkipsLeasedNotifications(self):
+        ns = NotificationService('ts', self.database, self.fileArchivePath)
+        first = ns.queueNotification(dict(title='First', content='Test'))
+        second = ns.queueNotification(dict(title='Second', content='Test'))
+
+        ds = DeliveryService(self.databasePath, self.fileArchivePath, workers=1)
+        self.assertEqual(first, ds._claim(self.database)['id'])
+        self.assertEqual(second, ds._claim(self.database)['id'])
+        self.assertIsNone(ds._claim(self.database))
+
+        # An expired lease makes the notification available again.
+        ds.lease = -1
+        self.assertEqual(first, ds._claim(self.database)['id'])
+
+
+if __name__ == '__main__':
+    import xmlrunner
+    unittest.main(testRunner=xmlrunner.XMLTestRunner(output='test-reports'))
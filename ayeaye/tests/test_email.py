@@ -2,9 +2,13 @@ from os import path, listdir, remove
 import sys
 sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
 
-from mtemail import EmailNotificationService
-from time import sleep
+from mtemail import EmailNotificationService, SmtpConnectionPool
+from ayeaye.error import BusyError
+import smtplib
+from threading import Thread
+from time import sleep, time
 import unittest
+from unittest import mock
 import email
 from base64 import b64encode, b64decode
 
@@ -123,6 +127,149 @@ class EmailNotificationServiceTestCase(unittest.TestCase):
         self.assertTrue(notificationReceived(notification))
 
 
+class SmtpConnectionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = dict(
+                server='127.0.0.1', port=2525, toAddr=['test@medicustek.com'],
+                fromAddr='norbert@medicustek.com', auth=True, ssl=False,
+                starttls=False, user=MAIL_USER, password=MAIL_PASSWORD)
+        self.smtp = mock.patch('smtplib.SMTP').start()
+        self.smtp.return_value.noop.return_value = (250, b'OK')
+        self.pool = SmtpConnectionPool(maxMessages=3, maxIdle=60)
+
+
+    def tearDown(self):
+        mock.patch.stopall()
+
+
+    def testSessionIsReused(self):
+        self.pool.sendmail(self.settings, 'msg1')
+        self.pool.sendmail(self.settings, 'msg2')
+
+        self.assertEqual(1, self.smtp.call_count)
+        self.assertEqual(1, self.smtp.return_value.login.call_count)
+        self.assertEqual(2, self.smtp.return_value.sendmail.call_count)
+
+
+    def testSessionIsRecycledAfterMaxMessages(self):
+        for i in range(4):
+            self.pool.sendmail(self.settings, 'msg')
+
+        self.assertEqual(2, self.smtp.call_count)
+        self.assertEqual(1, self.smtp.return_value.quit.call_count)
+
+
+    def testIdleSessionIsClosed(self):
+        self.pool.sendmail(self.settings, 'msg1')
+        self.pool.maxIdle = -1
+        self.pool.sendmail(self.settings, 'msg2')
+
+        self.assertEqual(2, self.smtp.call_count)
+        self.assertEqual(0, self.smtp.return_value.noop.call_count)
+
+
+    def testDeadSessionFailsHealthCheck(self):
+        self.pool.sendmail(self.settings, 'msg1')
+        self.smtp.return_value.noop.side_effect = smtplib.SMTPServerDisconnected()
+        self.pool.sendmail(self.settings, 'msg2')
+
+        self.assertEqual(2, self.smtp.call_count)
+
+
+    def testReconnectOnServerDisconnected(self):
+        self.smtp.return_value.sendmail.side_effect = [
+                smtplib.SMTPServerDisconnected(), {}]
+        self.pool.sendmail(self.settings, 'msg')
+
+        self.assertEqual(2, self.smtp.call_count)
+        self.assertEqual(2, self.smtp.return_value.sendmail.call_count)
+
+
+    def testReconnectWithinMaxConnections(self):
+        settings = dict(self.settings, maxConnections=1)
+        self.pool.maxWait = 0.1
+        self.smtp.return_value.sendmail.side_effect = smtplib.SMTPServerDisconnected()
+        # Another sender takes the slot of the dropped session.
+        held = []
+        discard = self.pool.discard
+        def discardAndAcquire(conn):
+            discard(conn)
+            if len(held) == 0:
+                held.append(self.pool.acquire(settings))
+
+        with mock.patch.object(self.pool, 'discard', side_effect=discardAndAcquire):
+            with self.assertRaises(BusyError):
+                self.pool.sendmail(settings, 'msg')
+        self.assertEqual(2, self.smtp.call_count)
+
+
+    def testLimitsAreSharedByProcesses(self):
+        self.pool.processes = 2
+        self.assertEqual(2, self.pool.maxConnections(dict(self.settings, maxConnections=5)))
+        self.assertEqual(1, self.pool.maxConnections(dict(self.settings, maxConnections=1)))
+        self.assertIsNone(self.pool.maxConnections(self.settings))
+
+        bucket = self.pool._bucket(dict(self.settings, rateLimit=10, rateBurst=4))
+        self.assertEqual((5, 2), (bucket.rate, bucket.burst))
+
+
+    def testSessionsAreKeyedByServer(self):
+        other = dict(self.settings, port=4650)
+        self.pool.sendmail(self.settings, 'msg1')
+        self.pool.sendmail(other, 'msg2')
+
+        self.assertEqual(2, self.smtp.call_count)
+
+
+    def testRateLimit(self):
+        settings = dict(self.settings, rateLimit=20, rateBurst=1)
+        start = time()
+        for i in range(5):
+            self.pool.sendmail(settings, 'msg')
+
+        self.assertGreaterEqual(time() - start, 0.19)
+        self.assertEqual(5, self.smtp.return_value.sendmail.call_count)
+
+
+    def testRateLimitExceeded(self):
+        settings = dict(self.settings, rateLimit=1, rateBurst=1)
+        self.pool.maxWait = 0.1
+        self.pool.sendmail(settings, 'msg1')
+
+        with self.assertRaises(BusyError):
+            self.pool.sendmail(settings, 'msg2')
+        self.assertEqual(1, self.smtp.return_value.sendmail.call_count)
+
+
+    def testMaxConnections(self):
+        settings = dict(self.settings, maxConnections=1)
+        self.smtp.return_value.sendmail.side_effect = lambda *args: sleep(0.1)
+        threads = [Thread(target=self.pool.sendmail, args=(settings, 'msg'))
+                for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # The senders waited for the one session instead of opening more.
+        self.assertEqual(1, self.smtp.call_count)
+        self.assertEqual(3, self.smtp.return_value.sendmail.call_count)
+
+
+    def testMaxConnectionsExceeded(self):
+        settings = dict(self.settings, maxConnections=1)
+        self.pool.maxWait = 0.1
+        conn = self.pool.acquire(settings)
+
+        with self.assertRaises(BusyError):
+            self.pool.acquire(settings)
+
+        self.pool.discard(conn)
+        self.pool.release(self.pool.acquire(settings))
+        self.assertEqual(2, self.smtp.call_count)
+
+
 if __name__ == '__main__':
     import xmlrunner
     unittest.main(testRunner=xmlrunner.XMLTestRunner(output='test-reports'))
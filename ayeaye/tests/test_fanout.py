@@ -0,0 +1,127 @@
+from os import path, close, unlink
+from shutil import rmtree
+import sys
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+import ayeaye
+from ayeaye.appsvc import NotificationService, NotificationHandlerService, HANDLER_CACHE
+from ayeaye.error import InternalError, BadRequestError
+from ayeaye.fanout import FanOutNotificationService, targetSettings
+from ayeaye.mtemail import EmailNotificationService, SMTP_POOL
+import asyncio
+import json
+import smtplib
+import sqlite3
+from tempfile import mkstemp, mkdtemp
+from time import sleep, time
+import unittest
+from unittest import mock
+
+try:
+    import aiosmtplib
+except ImportError:
+    aiosmtplib = None
+
+SETTINGS = dict(server='127.0.0.1', port=2525, toAddr=['TS@medicustek.com'],
+        fromAddr='test@medicustek.com', ssl=0, auth=0, starttls=0)
+
+
+def failOn(server):
+    def sendmail(settings, msg, timeout=10):
+        sleep(0.3)
+        if settings['server'] == server:
+            raise smtplib.SMTPException('Relay down')
+    return sendmail
+
+
+class FanOutNotificationServiceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.databaseFd, self.databasePath = mkstemp(suffix='.test.db')
+        ayeaye.initializeDatabase(self.databasePath)
+        self.database = sqlite3.connect(self.databasePath)
+        self.database.row_factory = sqlite3.Row
+        self.fileArchivePath = mkdtemp()
+        HANDLER_CACHE.invalidate()
+
+        settings = dict(SETTINGS, targets=[
+            {'toAddr': ['a@medicustek.com']},
+            {'toAddr': ['b@medicustek.com']},
+            {'server': '127.0.0.2', 'toAddr': ['c@medicustek.com']}])
+        nhs = NotificationHandlerService(self.database)
+        nhs.addEmailHandler({'topic': 'ts', 'settings': settings})
+
+
+    def tearDown(self):
+        HANDLER_CACHE.invalidate()
+        self.database.close()
+        close(self.databaseFd)
+        unlink(self.databasePath)
+        rmtree(self.fileArchivePath)
+
+
+    def testTargetSettings(self):
+        targets = targetSettings(dict(SETTINGS, targets=[
+            {'toAddr': ['a@medicustek.com']}, {'server': 'relay', 'port': 25}]))
+
+        self.assertEqual(2, len(targets))
+        self.assertEqual(['a@medicustek.com'], targets[0]['toAddr'])
+        self.assertEqual('127.0.0.1', targets[0]['server'])
+        self.assertEqual(('relay', 25), (targets[1]['server'], targets[1]['port']))
+        self.assertFalse('targets' in targets[1])
+
+        for invalid in [[], 'a@medicustek.com', ['a@medicustek.com']]:
+            with self.assertRaises(BadRequestError):
+                targetSettings(dict(SETTINGS, targets=invalid))
+
+
+    def testSendToAllTargets(self):
+        ns = NotificationService('ts', self.database, self.fileArchivePath)
+        with mock.patch.object(SMTP_POOL, 'sendmail', side_effect=failOn('127.0.0.2')) as sendmail:
+            start = time()
+            result = ns.sendNotification(dict(title='Fan out', content='Test'))
+
+        # Sent concurrently instead of one after the other.
+        self.assertLess(time() - start, 0.8)
+        self.assertEqual(3, sendmail.call_count)
+        self.assertEqual([['a@medicustek.com'], ['b@medicustek.com'], ['c@medicustek.com']],
+                sorted([c[0][0]['toAddr'] for c in sendmail.call_args_list]))
+        self.assertEqual([200, 200, 500], [t['status'] for t in result['targets']])
+        self.assertEqual('INTERNAL_ERROR', result['targets'][2]['error']['type'])
+
+        cur = self.database.cursor()
+        cur.execute('SELECT send_failed FROM notification_archive WHERE title = ?', ('Fan out', ))
+        self.assertFalse(cur.fetchone()[0])
+        cur.close()
+
+
+    def testAllTargetsFailed(self):
+        ns = NotificationService('ts', self.database, self.fileArchivePath)
+        with mock.patch.object(SMTP_POOL, 'sendmail', side_effect=smtplib.SMTPException('Down')):
+            with self.assertRaises(InternalError):
+                ns.sendNotification(dict(title='Fan out', content='Test'))
+
+        cur = self.database.cursor()
+        cur.execute('SELECT send_failed FROM notification_archive WHERE title = ?', ('Fan out', ))
+        self.assertTrue(cur.fetchone()[0])
+        cur.close()
+
+
+    @unittest.skipIf(aiosmtplib is None, 'aiosmtplib is not installed')
+    def testSendAsync(self):
+        fanOut = FanOutNotificationService([EmailNotificationService(t)
+            for t in targetSettings(dict(SETTINGS, targets=[{}, {'server': '127.0.0.2'}]))])
+
+        async def send(*args, **kwargs):
+            if kwargs['hostname'] == '127.0.0.2':
+                raise OSError('Connection refused')
+
+        with mock.patch('aiosmtplib.send', side_effect=send):
+            result = asyncio.run(fanOut.sendNotificationAsync(dict(title='Test', content='Test')))
+
+        self.assertEqual([200, 500], [t['status'] for t in result['targets']])
+
+
+if __name__ == '__main__':
+    import xmlrunner
+    unittest.main(testRunner=xmlrunner.XMLTestRunner(output='test-reports'))
@@ -1,14 +1,20 @@
-from os import path, close, unlink, listdir, remove
+from os import path, close, unlink, listdir, remove, walk
 from shutil import rmtree
 import sys
 sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
 
-from appsvc import NotificationService
+from appsvc import NotificationService, NotificationHandlerService, \
+        NotificationBatchService, HANDLER_CACHE
+from ayeaye.mtemail import SMTP_POOL
+from ayeaye.attachments import AttachmentStore
+from ayeaye.error import InternalError
+from hashlib import sha256
 import json
 import sqlite3
 from tempfile import mkstemp, mkdtemp
 from base64 import b64decode, b64encode
 import unittest
+from unittest import mock
 
 
 def initializeDatabase(databasePath):
@@ -101,6 +107,23 @@ class NotificationServiceTestCase(unittest.TestCase):
         self.assertTrue(result)
 
 
+    def archivedAttachments(self, topic):
+        cur = self.database.cursor()
+        cur.execute('''
+            SELECT filename, sha256, size FROM notification_attachment
+                WHERE topic = ? ORDER BY id
+            ''', (topic, ))
+        rows = cur.fetchall()
+        cur.close()
+        return rows
+
+
+    def readArchivedAttachment(self, digest):
+        store = AttachmentStore(self.fileArchivePath)
+        with open(store.path(digest), 'rb') as f:
+            return f.read()
+
+
     def testArchiveAttachments(self):
         notification = dict(content='Testing _archiveAttachments',
                 title='Test',
@@ -114,16 +137,23 @@ class NotificationServiceTestCase(unittest.TestCase):
                               'content': b64encode(b'This is the content of TestFile3.csv').decode('utf-8'),
                               'backup': True}])
         topic = 'TS'
+        attachments = [dict(a) for a in notification['attachments']]
         ns = NotificationService(topic, self.database, self.fileArchivePath)
         result = ns._archiveAttachments(notification)
 
-        self.assertTrue(topic.lower() in listdir(self.fileArchivePath))
-        for attachment in notification['attachments']:
-            self.assertTrue(attachment['filename'] in listdir(path.join(self.fileArchivePath, topic.lower())))
-            with open(path.join(self.fileArchivePath, topic.lower(), attachment['filename']), 'rb') as f:
-                data = f.read()
-                self.assertEqual(attachment['content'],
-                                 b64encode(data).decode('utf-8'))
+        rows = self.archivedAttachments(topic.lower())
+        self.assertEqual(3, len(rows))
+        for (attachment, row) in zip(attachments, rows):
+            self.assertEqual(attachment['filename'], row['filename'])
+            data = self.readArchivedAttachment(row['sha256'])
+            self.assertEqual(sha256(data).hexdigest(), row['sha256'])
+            self.assertEqual(len(data), row['size'])
+            self.assertEqual(attachment['content'], b64encode(data).decode('utf-8'))
+
+        # Files are sharded by the first bytes of their digest.
+        digest = rows[0]['sha256']
+        self.assertTrue(digest[0:2] in listdir(path.join(self.fileArchivePath, 'objects')))
+        self.assertEqual([], listdir(path.join(self.fileArchivePath, 'tmp')))
 
 
     def testArchiveAttachmentsNoBackup(self):
@@ -139,55 +169,62 @@ class NotificationServiceTestCase(unittest.TestCase):
                               'content': b64encode(b'This is the content of TestFile3.csv').decode('utf-8'),
                               'backup': True}])
         topic = 'TS'
+        attachments = [dict(a) for a in notification['attachments']]
         ns = NotificationService(topic, self.database, self.fileArchivePath)
         result = ns._archiveAttachments(notification)
-    
-        self.assertTrue(topic.lower() in listdir(self.fileArchivePath))
-        self.assertFalse('TestFile.csv' in listdir(path.join(self.fileArchivePath, topic.lower())))
-        self.assertFalse('TestFile2.csv' in listdir(path.join(self.fileArchivePath, topic.lower())))
-        self.assertTrue('TestFile3.csv' in listdir(path.join(self.fileArchivePath, topic.lower())))
 
-        with open(path.join(self.fileArchivePath, topic.lower(), 'TestFile3.csv'), 'rb') as f:
-            data = f.read()
-            self.assertEqual(notification['attachments'][2]['content'],
-                             b64encode(data).decode('utf-8'))
+        rows = self.archivedAttachments(topic.lower())
+        self.assertEqual(1, len(rows))
+        self.assertEqual('TestFile3.csv', rows[0]['filename'])
+        data = self.readArchivedAttachment(rows[0]['sha256'])
+        self.assertEqual(attachments[2]['content'], b64encode(data).decode('utf-8'))
 
 
-    def testArchiveDuplicatedNamedAttachments(self):
+    def testArchiveDuplicatedAttachments(self):
+        content = b64encode(b'This is the content of TestFile.csv').decode('utf-8')
         notification = dict(content='Testing _archiveAttachments',
                 title='Test',
                 attachments=[{'filename': 'TestFile.csv',
-                              'content': b64encode(b'This is the content of TestFile.csv').decode('utf-8'),
+                              'content': content,
                               'backup': True},
                              {'filename': 'TestFile.csv',
                               'content': b64encode(b'This is the content of TestFile2.csv').decode('utf-8'),
                               'backup': True},
-                             {'filename': 'TestFile.csv',
-                              'content': b64encode(b'This is the content of TestFile3.csv').decode('utf-8'),
+                             {'filename': 'Copy.csv',
+                              'content': content,
                               'backup': True}])
         topic = 'TS'
         ns = NotificationService(topic, self.database, self.fileArchivePath)
-        result = ns._archiveAttachments(notification)
+        ns._archiveAttachments(notification)
+        ns._archiveAttachments(notification)
 
-        self.assertTrue(topic.lower() in listdir(self.fileArchivePath))
-        self.assertTrue('TestFile.csv' in listdir(path.join(self.fileArchivePath, topic.lower())))
-        self.assertTrue('TestFile_1.csv' in listdir(path.join(self.fileArchivePath, topic.lower())))
-        self.assertTrue('TestFile_2.csv' in listdir(path.join(self.fileArchivePath, topic.lower())))
+        rows = self.archivedAttachments(topic.lower())
+        self.assertEqual(6, len(rows))
+        self.assertEqual(['TestFile.csv', 'TestFile.csv', 'Copy.csv'] * 2,
+                         [r['filename'] for r in rows])
+        self.assertEqual(rows[0]['sha256'], rows[2]['sha256'])
+        self.assertNotEqual(rows[0]['sha256'], rows[1]['sha256'])
 
-        with open(path.join(self.fileArchivePath, topic.lower(), 'TestFile.csv'), 'rb') as f:
-            data = f.read()
-            self.assertEqual(notification['attachments'][0]['content'],
-                             b64encode(data).decode('utf-8'))
+        # Identical content is only stored once.
+        store = AttachmentStore(self.fileArchivePath)
+        stored = set()
+        for (dirPath, dirs, files) in walk(store.objectsDir):
+            stored.update(files)
+        self.assertEqual(set([r['sha256'] for r in rows]), stored)
 
-        with open(path.join(self.fileArchivePath, topic.lower(), 'TestFile_1.csv'), 'rb') as f:
-            data = f.read()
-            self.assertEqual(notification['attachments'][1]['content'],
-                             b64encode(data).decode('utf-8'))
 
-        with open(path.join(self.fileArchivePath, topic.lower(), 'TestFile_2.csv'), 'rb') as f:
-            data = f.read()
-            self.assertEqual(notification['attachments'][2]['content'],
-                             b64encode(data).decode('utf-8'))
+    def testArchiveAttachmentsInvalidContent(self):
+        notification = dict(content='Testing _archiveAttachments',
+                title='Test',
+                attachments=[{'filename': 'TestFile.csv',
+                              'content': 'Not base64!',
+                              'backup': True}])
+        ns = NotificationService(self.topic, self.database, self.fileArchivePath)
+        with self.assertRaises(InternalError):
+            ns._archiveAttachments(notification)
+
+        self.assertEqual([], self.archivedAttachments(self.topic))
+        self.assertFalse(path.exists(path.join(self.fileArchivePath, 'objects')))
 
 
     def testANotificationHistoryByTime(self):
@@ -210,6 +247,145 @@ class NotificationServiceTestCase(unittest.TestCase):
         result = ns.aNotificationHistoryByTime(fromTime)
         self.assertEqual(2, len(result))
 
+    def testNotificationHandlerIsCached(self):
+        first = NotificationService(self.topic, self.database).notificationHandler
+        second = NotificationService(self.topic, self.database).notificationHandler
+        self.assertIs(first, second)
+
+
+    def testNotificationHandlerCacheNoticesChanges(self):
+        first = NotificationService(self.topic, self.database).notificationHandler
+
+        # Changed behind our back, i.e. by another process.
+        settings = dict(self.handler['settings'], port=4650)
+        cur = self.database.cursor()
+        cur.execute('UPDATE handler SET settings = ? WHERE topic = ?',
+                (json.dumps(settings), self.topic, ))
+        self.database.commit()
+        cur.close()
+
+        second = NotificationService(self.topic, self.database).notificationHandler
+        self.assertIsNot(first, second)
+        self.assertEqual(4650, second.settings['port'])
+
+
+    def testNotificationHandlerCacheInvalidatedByAddEmailHandler(self):
+        NotificationService(self.topic, self.database).notificationHandler
+
+        nhs = NotificationHandlerService(self.database)
+        nhs.addEmailHandler(dict(topic=self.topic,
+            settings=dict(self.handler['settings'], port=4650)))
+
+        second = NotificationService(self.topic, self.database).notificationHandler
+        self.assertEqual(4650, second.settings['port'])
+
+
+    def testNotificationHandlerCacheExpires(self):
+        ttl = HANDLER_CACHE.ttl
+        try:
+            HANDLER_CACHE.ttl = -1
+            HANDLER_CACHE.invalidate()
+            first = NotificationService(self.topic, self.database).notificationHandler
+            second = NotificationService(self.topic, self.database).notificationHandler
+        finally:
+            HANDLER_CACHE.ttl = ttl
+        self.assertIsNot(first, second)
+
+
+    def testANotificationHistoryByTimeStreamed(self):
+        ns = NotificationService(self.topic, self.database)
+        result = ns.aNotificationHistoryByTime(fromTime=20, toTime=35, stream=True)
+        self.assertFalse(isinstance(result, list))
+        self.assertEqual([35, 30, 25, 20], [n['time'] for n in result])
+
+
+    def testANotificationHistoryPage(self):
+        ns = NotificationService(self.topic, self.database)
+        result, after = ns.aNotificationHistoryPage(fromTime=20, toTime=35, limit=3)
+        self.assertEqual([35, 30, 25], [n['time'] for n in result])
+
+        result, after = ns.aNotificationHistoryPage(fromTime=20, toTime=35,
+                after=after, limit=3)
+        self.assertEqual([20], [n['time'] for n in result])
+        self.assertIsNone(after)
+
+
+    def testANotificationHistoryPageSameTime(self):
+        cur = self.database.cursor()
+        cur.execute('''
+            INSERT INTO notification_archive (title, time, topic) VALUES ('test', 40, ?)
+            ''', (self.topic, ))
+        self.database.commit()
+        cur.close()
+
+        ns = NotificationService(self.topic, self.database)
+        times = []
+        after = ''
+        while after is not None:
+            result, after = ns.aNotificationHistoryPage(self.topic, after=after, limit=1)
+            times.extend([n['time'] for n in result])
+        self.assertEqual([40, 40, 35, 30, 25, 20, 10], times)
+
+
+    def testSendNotifications(self):
+        notifications = [
+                dict(topic='TS', title='Batch 1', content='Test'),
+                dict(topic='unknown', title='Batch 2', content='Test'),
+                dict(topic='ts', title='Batch 3', content='Test',
+                    attachments=[{'filename': 'TestFile.csv',
+                                  'content': b64encode(b'Batch').decode('utf-8'),
+                                  'backup': True}])]
+        smtp = mock.patch('smtplib.SMTP').start()
+        smtp.return_value.noop.return_value = (250, b'OK')
+        try:
+            nbs = NotificationBatchService(self.database, self.fileArchivePath)
+            result = nbs.sendNotifications(notifications)
+        finally:
+            mock.patch.stopall()
+            SMTP_POOL.closeAll()
+
+        self.assertEqual([200, 404, 200], [r['status'] for r in result])
+        # Same server, thus one session for all notifications.
+        self.assertEqual(1, smtp.call_count)
+        self.assertEqual(2, smtp.return_value.sendmail.call_count)
+
+        cur = self.database.cursor()
+        cur.execute('''SELECT title, send_failed FROM notification_archive
+            WHERE title LIKE 'Batch%' ORDER BY title''')
+        rows = [tuple(r) for r in cur.fetchall()]
+        cur.close()
+        self.assertEqual([('Batch 1', 0), ('Batch 3', 0)], rows)
+        self.assertEqual(['TestFile.csv'],
+                         [r['filename'] for r in self.archivedAttachments('ts')])
+
+
+    def testSendNotificationsInvalid(self):
+        notifications = [dict(topic=5, title='Batch', content='Test'), 'ts',
+                dict(topic='ts', title='Batch', content='Test', attachments=[1]),
+                dict(topic='ts', title='Batch', content='Test')]
+        nbs = NotificationBatchService(self.database, self.fileArchivePath)
+        with mock.patch.object(SMTP_POOL, 'sendmail') as sendmail:
+            result = nbs.sendNotifications(notifications)
+
+        self.assertEqual([400, 400, 400, 200], [r['status'] for r in result])
+        self.assertEqual(1, sendmail.call_count)
+
+
+    def testSendNotificationsFailed(self):
+        handler = dict(self.handler['settings'], port=1)
+        nhs = NotificationHandlerService(self.database)
+        nhs.addEmailHandler(dict(topic='down', settings=handler))
+
+        nbs = NotificationBatchService(self.database, self.fileArchivePath)
+        result = nbs.sendNotifications([dict(topic='down', title='Batch', content='Test')])
+        self.assertEqual([500], [r['status'] for r in result])
+
+        cur = self.database.cursor()
+        cur.execute("SELECT send_failed FROM notification_archive WHERE topic = 'down'")
+        self.assertEqual([1], [r[0] for r in cur.fetchall()])
+        cur.close()
+
+
     def testDeleteAllNotificationsWithSomeNotificationsExpectingEmptyList(self):
         ns = NotificationService(self.topic, self.database)
         self.assertEqual(len(self.notifications), len(ns.aNotificationHistory()))
@@ -0,0 +1,143 @@
+from os import path, close, unlink
+import sys
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+import ayeaye
+from ayeaye.appsvc import NotificationService
+from ayeaye.archive import ArchiveWriter, insertNotifications
+from ayeaye.partition import ArchivePartitions, ARCHIVE_PARTITIONS
+from ayeaye.purge import PurgeService
+import sqlite3
+from tempfile import mkstemp
+import unittest
+
+DAY = 86400
+# 2024-01-01T00:00:00Z, a Monday.
+START = 1704067200
+
+
+class ArchivePartitionsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.databaseFd, self.databasePath = mkstemp(suffix='.test.db')
+        ayeaye.initializeDatabase(self.databasePath)
+        self.database = sqlite3.connect(self.databasePath)
+        self.database.row_factory = sqlite3.Row
+        ARCHIVE_PARTITIONS.configure('day')
+
+        # Four notifications a day, for five days.
+        self.archive([(START + d * DAY + h * 6 * 3600, 'ts' if h % 2 else 'other',
+            'Title {}/{}'.format(d, h), 'Content', False) for d in range(5) for h in range(4)])
+
+
+    def tearDown(self):
+        ARCHIVE_PARTITIONS.configure('none')
+        self.database.close()
+        close(self.databaseFd)
+        unlink(self.databasePath)
+
+
+    def archive(self, rows):
+        cur = self.database.cursor()
+        insertNotifications(cur, rows)
+        self.database.commit()
+        cur.close()
+
+
+    def testBounds(self):
+        partitions = ArchivePartitions('day')
+        self.assertEqual((START, START + DAY), partitions.bounds(START + 3600))
+
+        partitions.configure('week')
+        self.assertEqual((START, START + 7 * DAY), partitions.bounds(START + 6 * DAY))
+        self.assertEqual((START + 7 * DAY, START + 14 * DAY), partitions.bounds(START + 7 * DAY))
+
+        partitions.configure('month')
+        # 2024-02-01 and 2024-03-01, February of a leap year.
+        self.assertEqual((1706745600, 1709251200), partitions.bounds(1706745600 + 28 * DAY))
+        self.assertEqual((1733011200, 1735689600), partitions.bounds(1735689599))
+
+
+    def testSplit(self):
+        tables = ArchivePartitions.tables(self.database)
+
+        self.assertEqual(['notification_archive'] +
+                ['notification_archive_2024010{}'.format(d) for d in range(1, 6)], tables)
+        for table in tables[1:]:
+            self.assertEqual(4, self.database.execute(
+                'SELECT COUNT(*) FROM {}'.format(table)).fetchone()[0])
+        self.assertEqual(0, self.database.execute(
+            'SELECT COUNT(*) FROM notification_archive').fetchone()[0])
+
+
+    def testTablesInRange(self):
+        self.assertEqual(['notification_archive', 'notification_archive_20240102',
+            'notification_archive_20240103'],
+            ArchivePartitions.tables(self.database, START + DAY, START + 2 * DAY + 1))
+        self.assertEqual(['notification_archive', 'notification_archive_20240105'],
+            ArchivePartitions.tables(self.database, fromTime=START + 4 * DAY))
+
+
+    def testHistory(self):
+        ns = NotificationService('ts', self.database)
+
+        self.assertEqual(10, len(ns.aNotificationHistory()))
+        result = ns.aNotificationHistoryByTopicAndTime('ts', START + DAY, START + 2 * DAY)
+        self.assertEqual(['Title 1/1', 'Title 1/3'], [n['title'] for n in result])
+        result = ns.aNotificationHistoryByTime(fromTime=START + 3 * DAY, limit=5)
+        self.assertEqual(['Title 4/3', 'Title 4/2', 'Title 4/1', 'Title 4/0', 'Title 3/3'],
+                [n['title'] for n in result])
+
+
+    def testHistoryPages(self):
+        ns = NotificationService(database=self.database)
+        titles = []
+        (result, after) = ns.aNotificationHistoryPage('ts', limit=3)
+        titles.extend([n['title'] for n in result])
+        while after is not None:
+            (result, after) = ns.aNotificationHistoryPage('ts', after=after, limit=3)
+            titles.extend([n['title'] for n in result])
+
+        self.assertEqual(['Title {}/{}'.format(d, h) for d in range(4, -1, -1) for h in [3, 1]],
+                titles)
+
+
+    def testDeleteAll(self):
+        ns = NotificationService('ts', self.database)
+        ns.deleteAllNotifications()
+        self.assertEqual(0, len(ns.aNotificationHistoryByTime()))
+
+
+    def testPurgeDropsPartitions(self):
+        # The partitions of the first two days only hold expired notifications.
+        counts = PurgeService(self.database, pause=0).purge(START + 2 * DAY + 6 * 3600)
+
+        self.assertEqual(2, counts['partitions'])
+        self.assertEqual(2, counts['notification_archive'])
+        self.assertEqual(['notification_archive', 'notification_archive_20240103',
+            'notification_archive_20240104', 'notification_archive_20240105'],
+            ArchivePartitions.tables(self.database))
+        self.assertEqual(0, self.database.execute('''
+            SELECT COUNT(*) FROM sqlite_master WHERE name = 'notification_archive_20240101'
+            ''').fetchone()[0])
+        self.assertEqual(10, len(NotificationService(database=self.database)
+            .aNotificationHistoryByTime()))
+
+
+    def testRolledBackPartition(self):
+        # The batch creating the partition of 2024-01-11 fails and is rolled back.
+        batch = [dict(rows=[(START + 10 * DAY, 'ts', 'New', 'Content', False)], done=None),
+                dict(rows=[(START + 10 * DAY, 'ts', ['Invalid'], 'Content', False)], done=None)]
+        ArchiveWriter(None)._commit(self.database, batch)
+        self.assertIsInstance(batch[0]['error'], sqlite3.Error)
+        self.assertNotIn('notification_archive_20240111', ArchivePartitions.tables(self.database))
+
+        self.archive([(START + 10 * DAY, 'ts', 'New', 'Content', False)])
+        self.assertIn('notification_archive_20240111', ArchivePartitions.tables(self.database))
+        self.assertEqual(['New'], [n['title'] for n in NotificationService(database=self.database)
+            .aNotificationHistoryByTime(fromTime=START + 10 * DAY)])
+
+
+if __name__ == '__main__':
+    import xmlrunner
+    unittest.main(testRunner=xmlrunner.XMLTestRunner(output='test-reports'))
@@ -0,0 +1,163 @@
+from os import path, close, listdir, makedirs, unlink, utime
+from shutil import rmtree
+import sys
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+import ayeaye
+from ayeaye.attachments import AttachmentStore
+from ayeaye.purge import PurgeService
+import json
+import sqlite3
+from tempfile import mkstemp, mkdtemp
+from time import time
+import unittest
+
+
+class PurgeServiceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.databaseFd, self.databasePath = mkstemp(suffix='.test.db')
+        ayeaye.initializeDatabase(self.databasePath)
+        self.database = sqlite3.connect(self.databasePath)
+        self.database.row_factory = sqlite3.Row
+        self.attachmentsDir = mkdtemp()
+        self.store = AttachmentStore(self.attachmentsDir)
+        self.purge = PurgeService(self.database, self.attachmentsDir, batchSize=10, pause=0)
+
+
+    def tearDown(self):
+        self.database.close()
+        close(self.databaseFd)
+        unlink(self.databasePath)
+        rmtree(self.attachmentsDir)
+
+
+    def count(self, table):
+        return self.database.execute('SELECT COUNT(*) FROM {}'.format(table)).fetchone()[0]
+
+
+    def storeFile(self, content, mtime):
+        (digest, size) = self.store.put([content])
+        utime(self.store.path(digest), (mtime, mtime))
+        return digest
+
+
+    def testCutoff(self):
+        self.assertAlmostEqual(time() - 30 * 86400, self.purge.cutoff('-30 days'), delta=5)
+        with self.assertRaises(ValueError):
+            self.purge.cutoff('thirty days')
+
+
+    def testPurgeArchive(self):
+        now = int(time())
+        self.database.executemany('''
+            INSERT INTO notification_archive (time, send_failed, topic, title, content)
+                VALUES (?, 0, 'ts', 'Test', 'Test')
+            ''', [(now - 100 + i, ) for i in range(100)])
+        self.database.commit()
+
+        counts = self.purge.purge(now - 50)
+
+        # Deleted in batches of 10 up to and including the cutoff.
+        self.assertEqual(51, counts['notification_archive'])
+        self.assertEqual(49, self.count('notification_archive'))
+        self.assertEqual(now - 49, self.database.execute(
+            'SELECT MIN(time) FROM notification_archive').fetchone()[0])
+
+
+    def testPurgeQueue(self):
+        now = int(time())
+        cur = self.database.cursor()
+        for state in ['sent', 'failed', 'pending', 'sending']:
+            cur.execute('''
+                INSERT INTO notification_queue (time, topic, notification, state)
+                    VALUES (?, 'ts', '{}', ?)
+                ''', (now - 100, state, ))
+            cur.execute('INSERT INTO notification_attempt (queue_id, time) VALUES (?, ?)',
+                    (cur.lastrowid, now - 100, ))
+        self.database.commit()
+        cur.close()
+
+        counts = self.purge.purge(now - 50)
+
+        self.assertEqual(2, counts['notification_queue'])
+        self.assertEqual(['pending', 'sending'], sorted([r[0] for r in
+            self.database.execute('SELECT state FROM notification_queue')]))
+        self.assertEqual(2, self.count('notification_attempt'))
+
+
+    def testPurgeAttachments(self):
+        now = int(time())
+        archived = self.storeFile(b'archived', now - 100)
+        expired = self.storeFile(b'expired', now - 100)
+        queued = self.storeFile(b'queued', now - 100)
+        recent = self.storeFile(b'recent', now)
+
+        self.store.record(self.database, 'ts', now - 10, [('a.log', archived, 8)])
+        self.store.record(self.database, 'ts', now - 100, [('e.log', expired, 7)])
+        self.database.execute('''
+            INSERT INTO notification_queue (time, topic, notification, state)
+                VALUES (?, 'ts', ?, 'pending')
+            ''', (now - 100, json.dumps({'title': 'Test', 'content': 'Test',
+                'attachments': [{'filename': 'q.log', 'sha256': queued}]}), ))
+        self.database.commit()
+
+        counts = self.purge.purge(now - 50)
+
+        self.assertEqual(1, counts['notification_attachment'])
+        self.assertEqual(1, counts['attachments'])
+        self.assertFalse(path.exists(self.store.path(expired)))
+        for digest in [archived, queued, recent]:
+            self.assertTrue(path.exists(self.store.path(digest)))
+
+
+    def testPurgeTopicDirectories(self):
+        # Attachments archived per topic before the store.
+        now = int(time())
+        for (topic, name, mtime) in [('ts', 'old.csv', now - 100), ('irb', 'old.csv', now - 100),
+                ('irb', 'new.csv', now)]:
+            makedirs(path.join(self.attachmentsDir, topic), exist_ok=True)
+            with open(path.join(self.attachmentsDir, topic, name), 'wb') as f:
+                f.write(b'a,b,c')
+            utime(path.join(self.attachmentsDir, topic, name), (mtime, mtime))
+        recent = self.storeFile(b'recent', now)
+
+        self.assertEqual(2, self.purge.purgeAttachments(now - 50))
+        self.assertFalse(path.exists(path.join(self.attachmentsDir, 'ts')))
+        self.assertEqual(['new.csv'], listdir(path.join(self.attachmentsDir, 'irb')))
+        self.assertTrue(path.exists(self.store.path(recent)))
+
+
+    def testAttachmentBatchesUseIndex(self):
+        plan = self.database.execute('''
+            EXPLAIN QUERY PLAN
+                SELECT id FROM notification_attachment WHERE time <= ? ORDER BY time LIMIT ?
+            ''', (0, 10, )).fetchall()
+        self.assertIn('INDEX notification_attachment_time', plan[0]['detail'])
+
+
+    def testPutKeepsStoredObject(self):
+        digest = self.storeFile(b'reused', int(time()) - 100)
+        self.store.put([b'reused'])
+
+        # Storing it again marks it as used.
+        self.assertEqual(0, self.purge.purgeAttachments(int(time()) - 50))
+        self.assertTrue(path.exists(self.store.path(digest)))
+
+
+    def testVacuum(self):
+        self.database.executemany('''
+            INSERT INTO notification_archive (time, send_failed, topic, title, content)
+                VALUES (0, 0, 'ts', 'Test', ?)
+            ''', [('x' * 4096, ) for i in range(100)])
+        self.database.commit()
+        self.purge.purge(int(time()))
+        self.assertGreater(self.database.execute('PRAGMA freelist_count').fetchone()[0], 0)
+
+        self.assertGreater(self.purge.vacuum(pages=10), 0)
+        self.assertEqual(0, self.database.execute('PRAGMA freelist_count').fetchone()[0])
+
+
+if __name__ == '__main__':
+    import xmlrunner
+    unittest.main(testRunner=xmlrunner.XMLTestRunner(output='test-reports'))
@@ -0,0 +1,39 @@
+from os import path
+import sys
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+from ratelimit import TokenBucket
+from time import sleep
+import unittest
+
+
+class TokenBucketTestCase(unittest.TestCase):
+
+    def testBurst(self):
+        bucket = TokenBucket(rate=10, burst=3)
+
+        self.assertEqual([0, 0, 0], [bucket.reserve() for i in range(3)])
+        self.assertAlmostEqual(0.1, bucket.reserve(), delta=0.01)
+        # Reserved tokens are taken, the next caller waits longer.
+        self.assertAlmostEqual(0.2, bucket.reserve(), delta=0.01)
+
+
+    def testRefill(self):
+        bucket = TokenBucket(rate=10, burst=1)
+        bucket.reserve()
+        sleep(0.1)
+
+        self.assertAlmostEqual(0, bucket.reserve(), delta=0.01)
+
+
+    def testMaxWait(self):
+        bucket = TokenBucket(rate=1, burst=1)
+        bucket.reserve()
+
+        self.assertIsNone(bucket.reserve(maxWait=0.5))
+        self.assertAlmostEqual(1, bucket.reserve(maxWait=1), delta=0.01)
+
+
+if __name__ == '__main__':
+    import xmlrunner
+    unittest.main(testRunner=xmlrunner.XMLTestRunner(output='test-reports'))
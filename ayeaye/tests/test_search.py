@@ -0,0 +1,139 @@
+from os import path, close, unlink
+import sys
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+import ayeaye
+from ayeaye.appsvc import NotificationService
+from ayeaye.archive import insertNotifications
+from ayeaye.error import BadRequestError
+from ayeaye.partition import ARCHIVE_PARTITIONS
+from ayeaye.purge import PurgeService
+import sqlite3
+from tempfile import mkstemp
+import unittest
+
+DAY = 86400
+# 2024-01-01T00:00:00Z
+START = 1704067200
+
+
+class SearchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.databaseFd, self.databasePath = mkstemp(suffix='.test.db')
+        ayeaye.initializeDatabase(self.databasePath)
+        self.database = sqlite3.connect(self.databasePath)
+        self.database.row_factory = sqlite3.Row
+        self.ns = NotificationService(database=self.database)
+
+
+    def tearDown(self):
+        ARCHIVE_PARTITIONS.configure('none')
+        self.database.close()
+        close(self.databaseFd)
+        unlink(self.databasePath)
+
+
+    def archive(self, rows):
+        cur = self.database.cursor()
+        insertNotifications(cur, rows)
+        self.database.commit()
+        cur.close()
+
+
+    def titles(self, *args, **kwargs):
+        (notifications, nextOffset) = self.ns.searchNotifications(*args, **kwargs)
+        return [n['title'] for n in notifications]
+
+
+    def testRanked(self):
+        self.archive([
+            (START, 'icu', 'Pump alarm', 'Infusion pump of bed 3 stopped', False),
+            (START + 1, 'icu', 'Door', 'Door of room 2 opened', False),
+            (START + 2, 'ward', 'Pump alarm', 'Pump pump pump', False)])
+
+        self.assertEqual(['Pump alarm', 'Pump alarm'], self.titles('pump'))
+        self.assertEqual('Pump pump pump',
+                self.ns.searchNotifications('pump')[0][0]['content'])
+        self.assertEqual(['Door'], self.titles('room AND opened'))
+        self.assertEqual(['Pump alarm'], self.titles('pump', topic='ICU'))
+        self.assertEqual(['Pump alarm'], self.titles('pump', fromTime=START + 1))
+        self.assertEqual([], self.titles('ventilator'))
+
+
+    def testPages(self):
+        self.archive([(START + i, 'icu', 'Alarm {}'.format(i), 'Alarm', False)
+            for i in range(5)])
+
+        (notifications, nextOffset) = self.ns.searchNotifications('alarm', limit=2)
+        self.assertEqual(2, nextOffset)
+        (notifications, nextOffset) = self.ns.searchNotifications('alarm', offset=4, limit=2)
+        self.assertEqual(1, len(notifications))
+        self.assertIsNone(nextOffset)
+
+
+    def testInvalidQuery(self):
+        for (query, kwargs) in [('"pump', {}), ('pump AND', {}), (' ', {}),
+                ('pump', {'limit': 0}), ('pump', {'offset': 'first'})]:
+            with self.assertRaises(BadRequestError):
+                self.ns.searchNotifications(query, **kwargs)
+
+
+    def testIndexFollowsPurge(self):
+        self.archive([(START, 'icu', 'Pump alarm', 'Bed 3', False),
+            (START + 2 * DAY, 'icu', 'Pump alarm', 'Bed 4', False)])
+        PurgeService(self.database, pause=0).purge(START + DAY)
+
+        self.assertEqual(['Bed 4'], [n['content'] for n in
+            self.ns.searchNotifications('pump')[0]])
+        self.assertEqual(1, self.database.execute(
+            'SELECT COUNT(*) FROM notification_archive_fts').fetchone()[0])
+
+
+    def testIndexHoldsNoCopy(self):
+        self.archive([(START, 'icu', 'Pump alarm', 'Bed 3', False)])
+
+        self.assertEqual([(None, None)], [tuple(r) for r in self.database.execute(
+            'SELECT title, content FROM notification_archive_fts')])
+        self.ns.deleteAllNotifications()
+        self.assertEqual([], self.titles('pump'))
+        self.assertEqual(0, self.database.execute(
+            'SELECT COUNT(*) FROM notification_archive_fts').fetchone()[0])
+
+
+    def testPartitions(self):
+        ARCHIVE_PARTITIONS.configure('day')
+        self.archive([(START + d * DAY, 'icu', 'Pump alarm', 'Day {}'.format(d), False)
+            for d in range(3)])
+
+        self.assertEqual(3, len(self.titles('pump')))
+        self.assertEqual(['Day 1'], [n['content'] for n in self.ns.searchNotifications(
+            'pump', fromTime=START + DAY, toTime=START + DAY)[0]])
+
+        PurgeService(self.database, pause=0).purge(START + DAY)
+        self.assertEqual(['Day 2'], [n['content'] for n in
+            self.ns.searchNotifications('pump')[0]])
+        self.assertEqual(0, self.database.execute('''
+            SELECT COUNT(*) FROM sqlite_master WHERE name LIKE 'notification_archive_20240101%'
+            ''').fetchone()[0])
+
+
+    def testMigration(self):
+        # An archive of schema version 2, without the index.
+        self.database.execute('DROP TRIGGER notification_archive_fts_insert')
+        self.database.execute('DROP TRIGGER notification_archive_fts_delete')
+        self.database.execute('DROP TABLE notification_archive_fts')
+        self.database.execute('''
+            INSERT INTO notification_archive (time, topic, title, content, send_failed)
+                VALUES (?, 'icu', 'Pump alarm', 'Bed 3', 0)
+            ''', (START, ))
+        self.database.execute('PRAGMA user_version = 2')
+        self.database.commit()
+
+        ayeaye.initializeDatabase(self.databasePath)
+        self.assertEqual(['Pump alarm'], self.titles('pump'))
+
+
+if __name__ == '__main__':
+    import xmlrunner
+    unittest.main(testRunner=xmlrunner.XMLTestRunner(output='test-reports'))
@@ -0,0 +1,33 @@
+from os import path
+import sys
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+from ayeaye.server import gunicornApplication
+from argparse import Namespace
+import unittest
+
+try:
+    import gunicorn
+except ImportError:
+    gunicorn = None
+
+
+@unittest.skipIf(gunicorn is None, 'gunicorn is not installed')
+class GunicornApplicationTestCase(unittest.TestCase):
+
+    def testConfig(self):
+        args = Namespace(listen='127.0.0.1', port=5000, processes=3, threads=8,
+                maxRequests=1000, timeout=20)
+        app = gunicornApplication(args)
+
+        self.assertEqual(['127.0.0.1:5000'], app.cfg.bind)
+        self.assertEqual(3, app.cfg.workers)
+        self.assertEqual(8, app.cfg.threads)
+        self.assertEqual(1000, app.cfg.max_requests)
+        self.assertEqual(100, app.cfg.max_requests_jitter)
+        self.assertEqual(20, app.cfg.graceful_timeout)
+
+
+if __name__ == '__main__':
+    import xmlrunner
+    unittest.main(testRunner=xmlrunner.XMLTestRunner(output='test-reports'))
@@ -5,7 +5,8 @@ from os import path
 from os import remove
 sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
 
-from ayeaye import initializeDatabase
+from ayeaye import initializeDatabase, SCHEMA_VERSION
+import sqlite3
 
 
 TEST_DB = '/tmp/ayeaye-test.db'
@@ -32,6 +33,67 @@ class TestStartup(unittest.TestCase):
         self.assertTrue(self._fileExists(TEST_DB))
 
 
+    def testMigrateQueue(self):
+        # The delivery queue before retries were added.
+        db = sqlite3.connect(TEST_DB)
+        db.executescript('''
+            CREATE TABLE notification_archive (id INTEGER PRIMARY KEY, time INTEGER,
+              send_failed BOOLEAN, topic VARCHAR(32), title VARCHAR(1024), content TEXT);
+            CREATE TABLE notification_queue (id INTEGER PRIMARY KEY, time INTEGER,
+              topic VARCHAR(32), notification TEXT, state VARCHAR(16) DEFAULT 'pending',
+              claimed INTEGER);
+            PRAGMA user_version = 1;
+        ''')
+        db.close()
+
+        self.assertTrue(initializeDatabase(TEST_DB))
+
+        db = sqlite3.connect(TEST_DB)
+        columns = [r[1] for r in db.execute('PRAGMA table_info(notification_queue)')]
+        db.close()
+        self.assertIn('attempts', columns)
+        self.assertIn('next_attempt', columns)
+
+
+    def testMigrateDatabase(self):
+        # The notification archive as created by the very first schema.
+        db = sqlite3.connect(TEST_DB)
+        db.executescript('''
+            CREATE TABLE notification_archive (
+              id INTEGER PRIMARY KEY,
+              time INTEGER,
+              send_failed BOOLEAN,
+              topic VARCHAR(32),
+              title VARCHAR(1024),
+              content TEXT
+            );
+            INSERT INTO notification_archive (time, topic, title, content)
+                VALUES (10, 'ts', 'N1', 'C1');
+        ''')
+        db.close()
+
+        self.assertTrue(initializeDatabase(TEST_DB))
+
+        db = sqlite3.connect(TEST_DB)
+        indexes = [r[0] for r in db.execute('''
+            SELECT name FROM sqlite_master
+                WHERE type = 'index' AND tbl_name = 'notification_archive'
+            ''')]
+        version = db.execute('PRAGMA user_version').fetchone()[0]
+        count = db.execute('SELECT count(*) FROM notification_archive').fetchone()[0]
+        db.close()
+
+        db = sqlite3.connect(TEST_DB)
+        columns = [r[1] for r in db.execute('PRAGMA table_info(notification_queue)')]
+        db.close()
+
+        self.assertIn('next_attempt', columns)
+        self.assertIn('notification_archive_topic_time', indexes)
+        self.assertIn('notification_archive_time', indexes)
+        self.assertEqual(SCHEMA_VERSION, version)
+        self.assertEqual(1, count)
+
+
 if __name__ == '__main__':
     import xmlrunner
     unittest.main(testRunner=xmlrunner.XMLTestRunner(output='test-reports'))
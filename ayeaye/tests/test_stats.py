@@ -0,0 +1,104 @@
+from os import path, close, unlink
+import sys
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+import ayeaye
+from ayeaye.appsvc import NotificationService
+from ayeaye.archive import insertNotifications
+from ayeaye.error import BadRequestError
+from ayeaye.purge import PurgeService
+import sqlite3
+from tempfile import mkstemp
+import unittest
+
+HOUR = 3600
+# 2024-01-01T00:00:00Z
+START = 1704067200
+
+
+class StatsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.databaseFd, self.databasePath = mkstemp(suffix='.test.db')
+        ayeaye.initializeDatabase(self.databasePath)
+        self.database = sqlite3.connect(self.databasePath)
+        self.database.row_factory = sqlite3.Row
+        self.ns = NotificationService(database=self.database)
+
+        # Two notifications of icu and one of ward every 20 minutes for 30
+        # hours, every third of icu failed.
+        rows = []
+        for i in range(90):
+            t = START + i * 20 * 60
+            rows.append((t, 'icu', 'Alarm', 'Bed 3', i % 3 == 0))
+            rows.append((t + 1, 'icu', 'Alarm', 'Bed 4', False))
+            rows.append((t + 2, 'ward', 'Status', 'OK', False))
+        cur = self.database.cursor()
+        # In several batches, like the archive writer commits them.
+        for i in range(0, len(rows), 50):
+            insertNotifications(cur, rows[i:i + 50])
+        self.database.commit()
+        cur.close()
+
+
+    def tearDown(self):
+        self.database.close()
+        close(self.databaseFd)
+        unlink(self.databasePath)
+
+
+    def testHourly(self):
+        stats = self.ns.aNotificationStats(topic='ICU', fromTime=START + 30 * 60,
+                toTime=START + HOUR)
+
+        # The range is extended to whole hours.
+        self.assertEqual([
+            {'topic': 'icu', 'time': START, 'count': 6, 'failed': 1},
+            {'topic': 'icu', 'time': START + HOUR, 'count': 6, 'failed': 1}], stats)
+
+
+    def testDaily(self):
+        stats = self.ns.aNotificationStats(interval='day')
+
+        self.assertEqual([('icu', START, 144, 24), ('ward', START, 72, 0),
+            ('icu', START + 24 * HOUR, 36, 6), ('ward', START + 24 * HOUR, 18, 0)],
+            [(s['topic'], s['time'], s['count'], s['failed']) for s in stats])
+
+
+    def testTotal(self):
+        stats = self.ns.aNotificationStats(interval='total', fromTime=str(START + 24 * HOUR))
+
+        self.assertEqual([{'topic': 'icu', 'count': 36, 'failed': 6},
+            {'topic': 'ward', 'count': 18, 'failed': 0}], stats)
+
+
+    def testInvalidArguments(self):
+        for kwargs in [{'interval': 'week'}, {'fromTime': 'yesterday'}]:
+            with self.assertRaises(BadRequestError):
+                self.ns.aNotificationStats(**kwargs)
+
+
+    def testKeptByPurge(self):
+        PurgeService(self.database, pause=0).purge(START + 24 * HOUR)
+        self.assertEqual(270, sum([s['count'] for s in
+            self.ns.aNotificationStats(interval='total')]))
+
+        self.ns.deleteAllNotifications()
+        self.assertEqual([], self.ns.aNotificationStats())
+
+
+    def testMigration(self):
+        # An archive of schema version 3, without statistics.
+        self.database.execute('DROP TABLE notification_stats')
+        self.database.execute('PRAGMA user_version = 3')
+        self.database.commit()
+
+        ayeaye.initializeDatabase(self.databasePath)
+        self.assertEqual([{'topic': 'icu', 'count': 180, 'failed': 30},
+            {'topic': 'ward', 'count': 90, 'failed': 0}],
+            self.ns.aNotificationStats(interval='total'))
+
+
+if __name__ == '__main__':
+    import xmlrunner
+    unittest.main(testRunner=xmlrunner.XMLTestRunner(output='test-reports'))
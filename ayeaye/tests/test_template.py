@@ -0,0 +1,71 @@
+from os import path
+import sys
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+from ayeaye.error import BadRequestError
+from ayeaye.mtemail import EmailNotificationService, SMTP_POOL
+from ayeaye.template import MessageTemplate, Template
+import email
+import unittest
+from unittest import mock
+
+SETTINGS = dict(server='127.0.0.1', port=2525, toAddr=['a@medicustek.com', 'b@medicustek.com'],
+        fromAddr='test@medicustek.com', ssl=0, auth=0, starttls=0)
+
+
+class TemplateTestCase(unittest.TestCase):
+
+    def testRender(self):
+        notification = dict(title='Check-In', content='Patient 1233 checked in')
+
+        self.assertEqual('[IRB] Check-In', Template('[IRB] {title}').render(notification))
+        self.assertEqual('Check-In: Patient 1233 checked in\n--\nayeaye',
+                Template('{title}: {content}\n--\nayeaye').render(notification))
+        self.assertEqual('No placeholders', Template('No placeholders').render(notification))
+        self.assertEqual('{literal}', Template('{{literal}}').render(notification))
+        # A single placeholder returns the field itself.
+        self.assertIs(notification['content'], Template('{content}').render(notification))
+
+
+    def testInvalidTemplate(self):
+        for invalid in ['{topic}', '{title!r}', '{title:>10}', '{title', 42]:
+            with self.assertRaises(BadRequestError):
+                Template(invalid)
+
+
+    def testMessageTemplate(self):
+        template = MessageTemplate.fromSettings(dict(SETTINGS, subjectTemplate='[IRB] {title}',
+            headers={'Reply-To': 'it@medicustek.com', 'X-Priority': '1'}))
+        msg = template.render(dict(title='Check-In', content='Patient 1233 checked in'))
+
+        self.assertEqual('[IRB] Check-In', msg['Subject'])
+        self.assertEqual('test@medicustek.com', msg['From'])
+        self.assertEqual('a@medicustek.com, b@medicustek.com', msg['To'])
+        self.assertEqual('it@medicustek.com', msg['Reply-To'])
+        self.assertEqual('1', msg['X-Priority'])
+        self.assertEqual('Patient 1233 checked in', msg.get_payload()[0].get_payload())
+
+
+    def testInvalidHeaders(self):
+        for invalid in [['Reply-To'], {'Subject': 'Spoofed'}, {'X-Priority': 1},
+                {'X-Tag': 'a\r\nBcc: b@medicustek.com'}]:
+            with self.assertRaises(BadRequestError):
+                MessageTemplate.fromSettings(dict(SETTINGS, headers=invalid))
+
+
+    def testSendBytes(self):
+        handler = EmailNotificationService(dict(SETTINGS, bodyTemplate='{content}\n--\nayeaye'))
+        with mock.patch.object(SMTP_POOL, 'sendmail') as sendmail:
+            handler.sendNotification(dict(title='Check-In', content='Patient 1233 checked in'))
+
+        self.assertIsInstance(sendmail.call_args[0][1], bytes)
+        msg = email.message_from_bytes(sendmail.call_args[0][1])
+        self.assertEqual('Check-In', msg['Subject'])
+        # Lines end with CRLF on the wire.
+        self.assertEqual('Patient 1233 checked in\r\n--\r\nayeaye',
+                msg.get_payload()[0].get_payload())
+
+
+if __name__ == '__main__':
+    import xmlrunner
+    unittest.main(testRunner=xmlrunner.XMLTestRunner(output='test-reports'))
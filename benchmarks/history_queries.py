@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+''' Measure the latency of notification history queries.
+
+Fills a scratch database with the requested number of archived notifications
+spread over the given number of days and times the queries done by the
+NotificationService as well as the retention purge of ayeaye-purge. Use
+--noIndexes to compare against a database without the archive indexes.
+
+    $ PYTHONPATH=. python3 benchmarks/history_queries.py --rows 1000000
+    $ PYTHONPATH=. python3 benchmarks/history_queries.py --rows 10000000
+'''
+
+from ayeaye import initializeDatabase
+from ayeaye.appsvc import NotificationService
+from argparse import ArgumentParser
+from os import close, unlink
+import random
+import sqlite3
+from tempfile import mkstemp
+from time import perf_counter
+
+
+TOPICS = ['ts', 'irb', 'cra', 'status', 'alarm', 'report', 'audit', 'backup']
+NOW = 1500000000
+
+
+def fillDatabase(db, rows, days):
+    start = NOW - days * 86400
+    step = days * 86400 / rows
+    batch = []
+    for i in range(rows):
+        batch.append((int(start + i * step), random.choice(TOPICS),
+            'Title {}'.format(i), 'Content of notification {}'.format(i), False))
+        if len(batch) == 100000:
+            db.executemany('''
+                INSERT INTO notification_archive (time, topic, title, content, send_failed)
+                    VALUES (?, ?, ?, ?, ?)''', batch)
+            batch = []
+    if batch:
+        db.executemany('''
+            INSERT INTO notification_archive (time, topic, title, content, send_failed)
+                VALUES (?, ?, ?, ?, ?)''', batch)
+    db.commit()
+
+
+def measure(name, func, repeat):
+    timings = []
+    for i in range(repeat):
+        start = perf_counter()
+        result = func()
+        timings.append(perf_counter() - start)
+    timings.sort()
+    print('{:<45} {:>10.2f} ms {:>10} rows'.format(
+        name, timings[len(timings) // 2] * 1000, len(result)))
+
+
+def explain(db, qry, params):
+    for row in db.execute('EXPLAIN QUERY PLAN ' + qry, params):
+        print('    {}'.format(row[-1]))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-r', '--rows', type=int, default=1000000,
+            help='Number of archived notifications')
+    parser.add_argument('--days', type=int, default=30,
+            help='Number of days the notifications are spread over')
+    parser.add_argument('--repeat', type=int, default=5,
+            help='Number of runs per query, the median is reported')
+    parser.add_argument('--noIndexes', action='store_true',
+            help='Drop the notification_archive indexes before measuring')
+    args = parser.parse_args()
+
+    fd, databasePath = mkstemp(suffix='.bench.db')
+    try:
+        initializeDatabase(databasePath)
+        db = sqlite3.connect(databasePath)
+        db.row_factory = sqlite3.Row
+        if args.noIndexes:
+            db.execute('DROP INDEX notification_archive_topic_time')
+            db.execute('DROP INDEX notification_archive_time')
+
+        start = perf_counter()
+        fillDatabase(db, args.rows, args.days)
+        db.execute('ANALYZE')
+        print('Inserted {} rows in {:.1f} s'.format(args.rows, perf_counter() - start))
+
+        hourAgo = NOW - 3600
+        dayAgo = NOW - 86400
+        ns = NotificationService('alarm', db)
+
+        measure('topic, last hour',
+                lambda: ns.aNotificationHistoryByTopicAndTime('alarm', fromTime=hourAgo),
+                args.repeat)
+        measure('topic, last day',
+                lambda: ns.aNotificationHistoryByTopicAndTime('alarm', fromTime=dayAgo),
+                args.repeat)
+        measure('all topics, last hour',
+                lambda: ns.aNotificationHistoryByTime(fromTime=hourAgo),
+                args.repeat)
+        measure('all topics, newest 100',
+                lambda: ns.aNotificationHistoryByTime(limit=100),
+                args.repeat)
+        measure('all topics, last day, page 10 of 100',
+                lambda: ns.aNotificationHistoryByTime(fromTime=dayAgo, limit=100, offset=900),
+                args.repeat)
+        deepOffset = args.rows // 2
+        measure('all topics, page at offset {}'.format(deepOffset),
+                lambda: ns.aNotificationHistoryByTime(limit=100, offset=deepOffset),
+                args.repeat)
+        row = db.execute('''SELECT time, id FROM notification_archive
+            ORDER BY time DESC, id DESC LIMIT 1 OFFSET ?''', (deepOffset - 1, )).fetchone()
+        measure('all topics, page after cursor at same offset',
+                lambda: ns.aNotificationHistoryPage(
+                    after='{},{}'.format(row['time'], row['id']), limit=100)[0],
+                args.repeat)
+
+        print('Query plans:')
+        explain(db, '''SELECT time, topic, title, content, send_failed
+            FROM notification_archive WHERE topic = ? and time >= ?''', ('alarm', hourAgo))
+        explain(db, '''SELECT id, time, topic, title, content, send_failed
+            FROM notification_archive ORDER BY time DESC LIMIT ? OFFSET ?''', (100, 0))
+
+        # Purges the oldest day, like ayeaye-purge does with its retention period.
+        cutoff = NOW - (args.days - 1) * 86400
+        start = perf_counter()
+        cur = db.execute('DELETE FROM notification_archive WHERE time <= ?', (cutoff, ))
+        db.commit()
+        print('{:<45} {:>10.2f} ms {:>10} rows'.format(
+            'purge oldest day', (perf_counter() - start) * 1000, cur.rowcount))
+
+        db.close()
+    finally:
+        close(fd)
+        unlink(databasePath)